@@ -0,0 +1,128 @@
+"""古いpostのアーカイブ
+
+ARCHIVE_AFTER_DAYS より古いpostをLikeと一緒に ArchivedPost / ArchivedLike へ移し、
+posts と Like の表を小さく保つ (archive_posts コマンドをcronで定期的に実行する)。
+アーカイブしたpostは同じidのまま詳細ページと投稿履歴から読めるが、Like・更新・削除はできず、
+タイムラインの受信箱と検索の索引、そのpostへの通知からは外れる。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.http import Http404
+from django.utils import timezone
+
+from . import search, shards, timeline
+from .models import ArchivedLike, ArchivedPost, Like, Post
+
+
+DEFAULT_AFTER_DAYS = 365
+DEFAULT_BATCH_SIZE = 1000
+
+
+def after_days():
+    return getattr(settings, 'ARCHIVE_AFTER_DAYS', DEFAULT_AFTER_DAYS)
+
+
+def batch_size():
+    return getattr(settings, 'ARCHIVE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def archive_posts(post_ids):
+    """postをLikeと一緒にアーカイブへ移す。移した件数を返す"""
+    with transaction.atomic():
+        # 移している間に付いたLikeを取りこぼさないよう、postの行をロックする
+        rows = list(
+            Post.objects.select_for_update().filter(pk__in=post_ids)
+            .values_list('id', 'author_id', 'content', 'created_at', 'like_count', 'version')
+        )
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        now = timezone.now()
+        ArchivedPost.objects.bulk_create([
+            ArchivedPost(
+                id=pk, author_id=author_id, content=content, created_at=created_at,
+                like_count=like_count, version=version, archived_at=now,
+            )
+            for pk, author_id, content, created_at, like_count, version in rows
+        ], ignore_conflicts=True)
+
+        # 人気のpostはLikeが多いので、idのキーセットで少しずつ写す
+        likes = Like.objects.filter(post_id__in=ids).order_by('id').values_list('id', 'user_id', 'post_id', 'created_at')
+        last_id = 0
+        while True:
+            chunk = list(likes.filter(id__gt=last_id)[:batch_size()])
+            if not chunk:
+                break
+            ArchivedLike.objects.bulk_create([
+                ArchivedLike(user_id=user_id, post_id=post_id, created_at=created_at)
+                for _, user_id, post_id, created_at in chunk
+            ], ignore_conflicts=True)
+            last_id = chunk[-1][0]
+
+        search.remove_posts(ids)
+        # Like、受信箱、ハッシュタグ、メンション、通知はpostと一緒に消える
+        Post.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def archive_older_than(cutoff, limit=None):
+    """cutoffより前のpostをバッチごとに移す。移した件数を返す"""
+    # 最大idのpostは残す。自動採番を最大id+1から再開するDB (再起動後のMySQLなど) で、
+    # アーカイブ済みのidが新しいpostに振り直されないようにする
+    newest_id = Post.objects.aggregate(newest=Max('id'))['newest']
+    if newest_id is None:
+        return 0
+    candidates = Post.objects.filter(created_at__lt=cutoff, id__lt=newest_id).order_by('id')
+    archived = 0
+    last_id = 0
+    while limit is None or archived < limit:
+        size = batch_size() if limit is None else min(batch_size(), limit - archived)
+        ids = list(candidates.filter(id__gt=last_id).values_list('id', flat=True)[:size])
+        if not ids:
+            break
+        archived += archive_posts(ids)
+        last_id = ids[-1]
+    return archived
+
+
+def cutoff(now=None, days=None):
+    """これより前に作られたpostをアーカイブする"""
+    if days is None:
+        days = after_days()
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def get_post_or_404(pk):
+    """postを通常の表、なければアーカイブから読む"""
+    post = shards.get_post(pk)
+    if post is None:
+        post = ArchivedPost.objects.select_related('author').filter(pk=pk).first()
+    if post is None:
+        raise Http404('this post does not exist')
+    return post
+
+
+def history(user, cursor=None, limit=None):
+    """userのpostをアーカイブも含めて新しい順に1ページ分返す。戻り値は (posts, next_cursor)"""
+    limit = limit or timeline.page_size()
+    decoded = timeline.decode_cursor(cursor) if cursor else None
+    rows = []
+    # アーカイブは古い方にあるが、日時を指定して作ったpostもあるので両方から読んで混ぜる
+    for posts in (shards.posts_by_author(user.pk), ArchivedPost.objects.filter(author=user).select_related('author')):
+        if decoded:
+            posts = posts.filter(timeline.before_cursor(decoded))
+        rows.extend(shards.attach_authors(list(posts.order_by('-created_at', '-id')[:limit + 1])))
+    rows.sort(key=lambda post: (post.created_at, post.pk), reverse=True)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = timeline.encode_cursor(rows[-1].created_at, rows[-1].pk)
+    return rows, next_cursor
+
+
+def liked_post_ids(user, post_ids):
+    """アーカイブしたpostのうちuserがLikeしていたもの"""
+    return set(ArchivedLike.objects.filter(user=user, post_id__in=post_ids).values_list('post_id', flat=True))
@@ -0,0 +1,350 @@
+"""負荷試験ハーネス
+
+Django のテストクライアントでシナリオを繰り返し実行し、レイテンシ、スループット、
+リクエストあたりのクエリ数とDB時間を集計する。
+run_wsgi / run_asgi はサーバを立てずにWSGI/ASGIアプリを直接呼び、同時接続数を上げたときの
+スループットを比べる。
+"""
+import asyncio
+import io
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from .models import Like
+from user.models import Follow
+
+
+def percentile(values, p):
+    """線形補間したパーセンタイル。空ならNone"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+class QueryRecorder:
+    """このスレッドのDB接続で実行されたクエリの数と時間を数える"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+@contextmanager
+def record_queries():
+    """全DBエイリアスのクエリを QueryRecorder で数える"""
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        yield recorder
+
+
+def make_client(user=None):
+    host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'
+    # INTERNAL_IPS外のアドレスにしてdebug_toolbarを動かさない
+    client = Client(SERVER_NAME=host, REMOTE_ADDR='10.0.0.1')
+    client.user = user
+    if user is not None:
+        client.force_login(user)
+    return client
+
+
+class Scenario:
+    """1回分のリクエスト列。run(client, rng) が1回の試行を行う
+
+    prepare(client) は計測前にクライアントごとに1回呼ばれる。
+    """
+
+    def __init__(self, name, run, prepare=None):
+        self.name = name
+        self.run = run
+        self.prepare = prepare
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise AssertionError(f'{response.status_code} {response.request["PATH_INFO"]}')
+    return response
+
+
+def default_scenarios(users, post_ids):
+    """ホームタイムライン、Like切り替え、フォロー切り替え、フォロー一覧"""
+
+    def home(client, rng):
+        check(client.get(reverse('blog:home')))
+
+    # 切り替え系は2回目で元の状態に戻るよう、もとの状態に応じて順番を入れ替える
+    def toggle(client, first, second, kwargs):
+        check(client.post(reverse(first, kwargs=kwargs)))
+        check(client.post(reverse(second, kwargs=kwargs)))
+
+    def prepare_like(client):
+        client.liked = set(
+            Like.objects.filter(user=client.user, post_id__in=post_ids).values_list('post_id', flat=True)
+        )
+
+    def like_toggle(client, rng):
+        pk = rng.choice(post_ids)
+        if pk in client.liked:
+            toggle(client, 'blog:unlike', 'blog:like', {'pk': pk})
+        else:
+            toggle(client, 'blog:like', 'blog:unlike', {'pk': pk})
+
+    def prepare_follow(client):
+        client.following = set(
+            Follow.objects.filter(following=client.user).values_list('follower__username', flat=True)
+        )
+
+    def follow_toggle(client, rng):
+        # 自分自身は403になるので選ばない
+        username = rng.choice([user for user in users if user != client.user]).username
+        if username in client.following:
+            toggle(client, 'user:unfollow', 'user:follow', {'username': username})
+        else:
+            toggle(client, 'user:follow', 'user:unfollow', {'username': username})
+
+    def follow_list(client, rng):
+        username = rng.choice(users).username
+        check(client.get(reverse('user:following', kwargs={'username': username})))
+        check(client.get(reverse('user:follower', kwargs={'username': username})))
+
+    scenarios = [
+        Scenario('home_timeline', home),
+        Scenario('like_toggle', like_toggle, prepare_like),
+        Scenario('follow_list', follow_list),
+    ]
+    if len(users) > 1:
+        scenarios.append(Scenario('follow_toggle', follow_toggle, prepare_follow))
+    return scenarios
+
+
+def run_scenario(scenario, users, iterations, threads=1, seed=0):
+    """scenario を threads 並列で合計 iterations 回実行して集計する"""
+    latencies = []
+    queries = []
+    db_times = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(seed + index)
+        client = make_client(users[index % len(users)])
+        if scenario.prepare:
+            scenario.prepare(client)
+        for _ in range(count):
+            with record_queries() as recorder:
+                started = time.perf_counter()
+                try:
+                    scenario.run(client, rng)
+                except Exception as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed * 1000)
+                queries.append(recorder.count)
+                db_times.append(recorder.duration * 1000)
+
+    def thread_worker(index, count):
+        try:
+            worker(index, count)
+        finally:
+            connections.close_all()
+
+    per_thread = [iterations // threads + (i < iterations % threads) for i in range(threads)]
+    started = time.perf_counter()
+    if threads == 1:
+        worker(0, iterations)
+    else:
+        workers = [threading.Thread(target=thread_worker, args=(i, n)) for i, n in enumerate(per_thread)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'iterations': iterations,
+        'threads': threads,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'throughput_per_sec': len(latencies) / elapsed if elapsed else None,
+        'latency_ms': summarize(latencies),
+        'queries_per_iteration': summarize(queries),
+        'db_time_ms': summarize(db_times),
+    }
+
+
+# compare_auth で比べるセッションと認証の設定
+AUTH_CONFIGS = {
+    'db': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'AUTHENTICATION_BACKENDS': ['django.contrib.auth.backends.ModelBackend'],
+    },
+    'cached': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db',
+        'AUTHENTICATION_BACKENDS': ['user.backends.CachedModelBackend'],
+    },
+}
+
+
+def compare_auth(users, post_ids, iterations, threads=1, seed=0):
+    """ホームを AUTH_CONFIGS の設定ごとに計測し、{設定名: run_scenario の結果} を返す"""
+    home = next(scenario for scenario in default_scenarios(users, post_ids) if scenario.name == 'home_timeline')
+    # 先に各スレッドのユーザのタイムラインをキャッシュに載せ、どの設定も同じ条件で測る
+    run_scenario(home, users, threads, threads, seed)
+    results = {}
+    for name, overrides in AUTH_CONFIGS.items():
+        # クライアントは設定ごとに作り直すので、ログインもその設定のセッションで行う
+        with override_settings(**overrides):
+            results[name] = run_scenario(home, users, iterations, threads, seed)
+    return results
+
+
+def server_requests(users, post_ids, count, seed=0):
+    """ホーム、詳細、フォロー一覧への GET を [(path, user)] で count 件作る"""
+    rng = random.Random(seed)
+    paths = [
+        lambda: reverse('blog:home'),
+        lambda: reverse('blog:detail', kwargs={'pk': rng.choice(post_ids)}),
+        lambda: reverse('user:following', kwargs={'username': rng.choice(users).username}),
+        lambda: reverse('user:follower', kwargs={'username': rng.choice(users).username}),
+    ]
+    return [(paths[i % len(paths)](), rng.choice(users)) for i in range(count)]
+
+
+def session_cookies(users):
+    """{user.pk: Cookieヘッダの値}。ログイン済みセッションを作る"""
+    cookies = {}
+    for user in users:
+        client = make_client(user)
+        cookies[user.pk] = f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+    return cookies
+
+
+def _host():
+    return settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'
+
+
+def _result(latencies, statuses, elapsed):
+    errors = sum(1 for status in statuses if status >= 400)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_per_sec': len(latencies) / elapsed if elapsed else None,
+        'latency_ms': summarize(latencies),
+    }
+
+
+def run_wsgi(application, requests, cookies, concurrency):
+    """WSGIアプリに concurrency 本のスレッドから requests を投げる (スレッドプールのWSGIサーバ相当)"""
+    host = _host()
+
+    def call(path, user):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '10.0.0.1',
+            'HTTP_COOKIE': cookies[user.pk],
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': io.StringIO(),
+            'wsgi.url_scheme': 'http',
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.version': (1, 0),
+        }
+        status = []
+        started = time.perf_counter()
+        body = application(environ, lambda value, headers, exc_info=None: status.append(int(value.split()[0])))
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return (time.perf_counter() - started) * 1000, status[0]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda request: call(*request), requests))
+    elapsed = time.perf_counter() - started
+    return _result([latency for latency, _ in results], [status for _, status in results], elapsed)
+
+
+async def run_asgi(application, requests, cookies, concurrency):
+    """ASGIアプリに同時に concurrency 件までの requests を投げる"""
+    host = _host()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(path, user):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'root_path': '',
+            'query_string': b'',
+            'headers': [(b'host', host.encode()), (b'cookie', cookies[user.pk].encode())],
+            'client': ('10.0.0.1', 50000),
+            'server': (host, 80),
+        }
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        status = []
+
+        async def receive():
+            return messages.pop() if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        async with semaphore:
+            started = time.perf_counter()
+            await application(scope, receive, send)
+            return (time.perf_counter() - started) * 1000, status[0]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(call(path, user) for path, user in requests))
+    elapsed = time.perf_counter() - started
+    return _result([latency for latency, _ in results], [status for _, status in results], elapsed)
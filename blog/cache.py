@@ -0,0 +1,120 @@
+"""描画済みpost断片とタイムラインページのキャッシュ
+
+post断片は (id, version, created_at) をキーにするので、更新時はversionを上げるだけで
+古い断片は参照されなくなる。タイムラインページはユーザごとのバージョントークンを
+キーに含め、トークンを差し替えることでまとめて無効化する。
+"""
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from twitter import metrics
+
+
+DEFAULT_FRAGMENT_TIMEOUT = 60 * 60 * 24
+DEFAULT_TIMELINE_TIMEOUT = 15
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _record(name, hits, misses):
+    with _stats_lock:
+        _stats[f'{name}_hit'] += hits
+        _stats[f'{name}_miss'] += misses
+    metrics.record_cache(name, hits, misses)
+
+
+def get_stats():
+    """キャッシュ種別ごとのヒット/ミス数"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def fragment_timeout():
+    return getattr(settings, 'POST_FRAGMENT_CACHE_TIMEOUT', DEFAULT_FRAGMENT_TIMEOUT)
+
+
+def timeline_timeout():
+    return getattr(settings, 'TIMELINE_CACHE_TIMEOUT', DEFAULT_TIMELINE_TIMEOUT)
+
+
+def fragment_key(post):
+    return f'post:{post.pk}:{post.version}:{post.created_at.timestamp():.6f}'
+
+
+def attach_fragments(posts):
+    """各postに描画済みの本文断片 post.fragment を付ける。ミスした分だけ描画する"""
+    keys = {fragment_key(post): post for post in posts}
+    cached = cache.get_many(list(keys))
+    missed = {}
+    for key, post in keys.items():
+        if key in cached:
+            html = cached[key]
+        else:
+            html = missed[key] = render_to_string('blog/post_body.html', {'post': post})
+        post.fragment = mark_safe(html)
+    if missed:
+        cache.set_many(missed, fragment_timeout())
+    _record('fragment', len(keys) - len(missed), len(missed))
+    return posts
+
+
+def invalidate_post(post):
+    cache.delete(fragment_key(post))
+
+
+def _version_key(user_id):
+    return f'timeline:version:{user_id}'
+
+
+def timeline_page_key(user_id, cursor):
+    """現在のバージョンでのページのキー。TTLが0ならNone (キャッシュしない)"""
+    timeout = timeline_timeout()
+    if not timeout:
+        return None
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        # 同時の invalidate_timelines が置いたバージョンを上書きしないよう add で置き、置かれた方を使う
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(user_id), version, timeout):
+            version = cache.get(_version_key(user_id)) or version
+    return f'timeline:{user_id}:{version}:{cursor or ""}'
+
+
+def get_timeline_page(key):
+    """キャッシュ済みのタイムラインページ。無ければNone"""
+    if key is None:
+        return None
+    page = cache.get(key)
+    _record('timeline', page is not None, page is None)
+    return page
+
+
+def set_timeline_page(key, page):
+    # 読み出し後に無効化されていれば、古いバージョンのキーに書くだけで参照されない
+    if key is not None:
+        cache.set(key, page, timeline_timeout())
+
+
+def invalidate_timelines(user_ids):
+    """ユーザのタイムラインページを全カーソル分まとめて無効化する
+
+    トランザクションの中ならコミットしてから行う。先に行うと、その間に読んだリクエストが
+    コミット前の行で作ったページを新しいバージョンでキャッシュしてしまう。
+    """
+    timeout = timeline_timeout()
+    if timeout:
+        versions = {_version_key(user_id): uuid.uuid4().hex for user_id in user_ids}
+        transaction.on_commit(lambda: cache.set_many(versions, timeout))
@@ -0,0 +1,34 @@
+"""Post.like_count カウンタ。Likeの作成・削除と同じトランザクションで更新する"""
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Post, Like
+
+
+def like_added(post_id, using=None):
+    """更新した行数を返す (0ならpostが存在しない)。using はpostのシャード (blog.shards)"""
+    return Post.objects.using(using).filter(pk=post_id).update(like_count=F('like_count') + 1)
+
+
+def like_removed(post_id, using=None):
+    return Post.objects.using(using).filter(pk=post_id, like_count__gt=0).update(like_count=F('like_count') - 1)
+
+
+def like_count(post_id, using=None):
+    return Post.objects.using(using).values_list('like_count', flat=True).get(pk=post_id)
+
+
+def reconcile(start, stop):
+    """idが [start, stop) の範囲のPost.like_countを実数に合わせる。修正した行数を返す"""
+    actual = Coalesce(
+        Subquery(
+            Like.objects.filter(post=OuterRef('pk')).order_by()
+            .values('post').annotate(count=Count('id')).values('count')
+        ),
+        Value(0),
+    )
+    return (
+        Post.objects.filter(id__gte=start, id__lt=stop)
+        .exclude(like_count=actual)
+        .update(like_count=actual)
+    )
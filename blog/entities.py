@@ -0,0 +1,66 @@
+"""postの本文からハッシュタグと @メンション を取り出して保存する"""
+import re
+import unicodedata
+
+from django.contrib.auth.models import User
+
+from . import trending
+from .models import Hashtag, Mention, PostHashtag
+from user import notifications
+
+
+# 英数字や日本語の直後の # や @ はタグとみなさない (メールアドレスなど)
+HASHTAG = re.compile(r'(?<!\w)#(\w+)')
+MENTION = re.compile(r'(?<![\w.@+-])@([\w.@+-]+)')
+
+
+def normalize_hashtag(name):
+    return unicodedata.normalize('NFKC', name).lower()
+
+
+def parse_hashtags(content):
+    """本文中のハッシュタグ名。数字だけのものは除く"""
+    text = unicodedata.normalize('NFKC', content)
+    return {name.lower() for name in HASHTAG.findall(text) if not name.isdigit()}
+
+
+def parse_mentions(content):
+    return {name.rstrip('.') for name in MENTION.findall(content)}
+
+
+def _hashtag_ids(names):
+    if not names:
+        return {}
+    Hashtag.objects.bulk_create([Hashtag(name=name) for name in names], ignore_conflicts=True)
+    return dict(Hashtag.objects.filter(name__in=names).values_list('name', 'id'))
+
+
+def update_entities(post, created=False, count_trending=True, notify=True):
+    """post本文のハッシュタグとメンションを保存し直す。増えたハッシュタグはトレンドに数え、
+    増えたメンションは通知する
+
+    created=True なら作ったばかりのpostとして既存の行を読まない。
+    """
+    hashtag_ids = _hashtag_ids(parse_hashtags(post.content))
+    current = set() if created else set(PostHashtag.objects.filter(post=post).values_list('hashtag_id', flat=True))
+    added = set(hashtag_ids.values()) - current
+    removed = current - set(hashtag_ids.values())
+    if removed:
+        PostHashtag.objects.filter(post=post, hashtag_id__in=removed).delete()
+    PostHashtag.objects.bulk_create(
+        [PostHashtag(post=post, hashtag_id=hashtag_id, created_at=post.created_at) for hashtag_id in added],
+        ignore_conflicts=True,
+    )
+    if count_trending:
+        trending.record(added)
+
+    user_ids = set(User.objects.filter(username__in=parse_mentions(post.content)).values_list('id', flat=True))
+    current = set() if created else set(Mention.objects.filter(post=post).values_list('user_id', flat=True))
+    if current - user_ids:
+        Mention.objects.filter(post=post, user_id__in=current - user_ids).delete()
+    Mention.objects.bulk_create(
+        [Mention(post=post, user_id=user_id, created_at=post.created_at) for user_id in user_ids - current],
+        ignore_conflicts=True,
+    )
+    if notify:
+        notifications.schedule_mentions(user_ids - current)
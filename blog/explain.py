@@ -0,0 +1,135 @@
+"""viewが投げるクエリの実行計画の確認 (index_advisor コマンド)
+
+querybudget の全ケースを実行して SELECT / UPDATE / DELETE を集め、同じトランザクションの中で
+EXPLAIN にかけて、表の全件走査とインデックスを使わない並べ替えを探す。
+SQLite は統計 (ANALYZE) が無ければ行数によらず同じ計画を選ぶので、小さなデータで確かめられる。
+PostgreSQL は小さな表では常に全件走査を選ぶので、enable_seqscan / enable_sort を切って
+「使えるインデックスがあるか」を見る。
+"""
+import re
+from collections import namedtuple
+from contextlib import ExitStack
+
+from django.core.cache import cache as default_cache
+from django.db import connections, transaction
+from django.test.utils import override_settings
+
+from . import querybudget
+from .benchmark import make_client
+
+
+# 表 -> 理由。全件走査や並べ替えがあっても問題にしない表
+ALLOWED_SCANS = {
+    'django_migrations': 'マイグレーションの管理表',
+}
+ALLOWED_SORTS = {
+    'post_search': '関連度 (bm25) 順はインデックスにできない。並べるのは一致したpostだけ',
+}
+
+Plan = namedtuple('Plan', 'alias sql lines problems')
+
+_EXPLAINED = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_SQLITE_TABLE = re.compile(r'^(SCAN|SEARCH) (?:TABLE )?(\w+)')
+_POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+_POSTGRES_TABLE = re.compile(r' on (\w+)')
+
+
+class QueryCollector:
+    """実行されたSQLをエイリアスごとに記録する execute wrapper"""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and _EXPLAINED.match(sql):
+            self.queries.append((self.alias, sql, params))
+        return execute(sql, params, many, context)
+
+
+def _sqlite_problems(lines):
+    problems = []
+    tables = set()
+    for line in lines:
+        match = _SQLITE_TABLE.match(line.strip())
+        if match:
+            tables.add(match.group(2))
+        if match and match.group(1) == 'SCAN' and 'INDEX' not in line and 'VIRTUAL TABLE' not in line:
+            if match.group(2) not in ALLOWED_SCANS:
+                problems.append(f'full scan of {match.group(2)}')
+        if 'USE TEMP B-TREE FOR' in line and not tables & set(ALLOWED_SORTS):
+            problems.append(line.strip().lower().replace('use temp b-tree for', 'sort without index for'))
+    return problems
+
+
+def _postgres_problems(lines):
+    problems = []
+    tables = {match.group(1) for line in lines for match in [_POSTGRES_TABLE.search(line)] if match}
+    for line in lines:
+        match = _POSTGRES_SCAN.search(line)
+        if match and match.group(1) not in ALLOWED_SCANS:
+            problems.append(f'full scan of {match.group(1)}')
+        if re.match(r'(->\s+)?Sort\b', line.strip()) and not tables & set(ALLOWED_SORTS):
+            problems.append('sort without index')
+    return problems
+
+
+def _mysql_problems(rows, columns):
+    problems = []
+    for row in rows:
+        row = dict(zip(columns, row))
+        if row.get('type') == 'ALL' and row.get('table') not in ALLOWED_SCANS:
+            problems.append(f"full scan of {row.get('table')}")
+        if 'Using filesort' in (row.get('Extra') or '') and row.get('table') not in ALLOWED_SORTS:
+            problems.append(f"sort without index on {row.get('table')}")
+    return problems
+
+
+def explain(alias, sql, params):
+    """1つのクエリの実行計画と、その中の問題のリストを返す"""
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            lines = [row[-1] for row in cursor.fetchall()]
+            return Plan(alias, sql, lines, _sqlite_problems(lines))
+        if connection.vendor == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_sort = off')
+            cursor.execute(f'EXPLAIN {sql}', params)
+            lines = [row[0] for row in cursor.fetchall()]
+            return Plan(alias, sql, lines, _postgres_problems(lines))
+        cursor.execute(f'EXPLAIN {sql}', params)
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        lines = [' '.join(f'{name}={value}' for name, value in zip(columns, row)) for row in rows]
+        return Plan(alias, sql, lines, _mysql_problems(rows, columns))
+
+
+def explain_case(case, size):
+    """sizeのデータでcaseを1回実行し、投げたクエリの実行計画のリストを返す。データはロールバックする"""
+    collectors = [QueryCollector(alias) for alias in connections]
+    with override_settings(CACHES=querybudget.BUDGET_CACHES, JOBS_EAGER=False), transaction.atomic():
+        default_cache.clear()
+        fixture = querybudget.build(size)
+        client = make_client(fixture.viewer if case.login else None)
+        with ExitStack() as stack:
+            for collector in collectors:
+                stack.enter_context(connections[collector.alias].execute_wrapper(collector))
+            case.request(client, fixture)
+        plans = []
+        seen = set()
+        for collector in collectors:
+            for alias, sql, params in collector.queries:
+                # 同じ形のクエリは1回だけ見る
+                if (alias, sql) in seen:
+                    continue
+                seen.add((alias, sql))
+                plans.append(explain(alias, sql, params))
+        transaction.set_rollback(True)
+    return plans
+
+
+def advise(cases=None, size=querybudget.SIZES[-1]):
+    """{case.key: [Plan, ...]}"""
+    return {case.key: explain_case(case, size) for case in cases or querybudget.CASES}
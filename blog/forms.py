@@ -1,5 +1,6 @@
 from django import forms
 from .models import Post
+from . import entities
 
 
 class PostFormBase(forms.ModelForm):
@@ -14,6 +15,13 @@ class PostFormBase(forms.ModelForm):
             ),
         }
 
+    def save(self, commit=True):
+        created = self.instance.pk is None
+        post = super().save(commit)
+        if commit:
+            entities.update_entities(post, created=created)
+        return post
+
 
 class PostCreateForm(PostFormBase):
     pass
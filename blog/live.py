@@ -0,0 +1,134 @@
+"""ホーム画面へのServer-Sent Events
+
+フォロー中のユーザの新しいpost (トピック author:<id>) と、画面に出ているpostの
+Like数 (トピック post:<id>) を送る。Django 3.2 は非同期のストリーミングレスポンスを
+持たないので、twitter/asgi.py から STREAM_PATH だけこのASGIアプリに回す。
+"""
+import asyncio
+import json
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http import parse_cookie
+
+from . import timeline
+from user import graph
+from twitter.events import get_broker
+
+
+STREAM_PATH = '/blog/stream/'
+DEFAULT_HEARTBEAT_SECONDS = 15
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_MAX_POSTS = 100
+RETRY_MILLISECONDS = 5000
+
+_connections = 0
+
+
+def stream_url():
+    """ホーム画面が開くストリームのURL。SSE_ENABLED でなければNone"""
+    return STREAM_PATH if getattr(settings, 'SSE_ENABLED', False) else None
+
+
+def publish_post(post):
+    data = timeline.serialize_post(post, ())
+    del data['liked']
+    get_broker().publish(f'author:{post.author_id}', 'post', data)
+
+
+def publish_like_count(post_id, count):
+    # 同じpostのLike数は最新の値だけ送ればよい
+    get_broker().publish(f'post:{post_id}', 'like', {'id': post_id, 'count': count}, key=f'like:{post_id}')
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def _load_user(session_key):
+    try:
+        engine = import_module(settings.SESSION_ENGINE)
+        user = get_user(SimpleNamespace(session=engine.SessionStore(session_key)))
+        return user if user.is_authenticated else None
+    finally:
+        close_old_connections()
+
+
+def _topics(user, post_ids):
+    try:
+        authors = set(graph.following_ids(user.pk))
+    finally:
+        close_old_connections()
+    authors.add(user.pk)
+    return [f'author:{pk}' for pk in authors] + [f'post:{pk}' for pk in post_ids]
+
+
+def _post_ids(query_string):
+    values = parse_qs(query_string.decode()).get('posts', [''])[0]
+    post_ids = {int(pk) for pk in values.split(',') if pk.isdigit()}
+    return sorted(post_ids)[:getattr(settings, 'SSE_MAX_POSTS', DEFAULT_MAX_POSTS)]
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _watch_disconnect(receive, subscription, closed):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    closed.append(True)
+    subscription.ready.set()
+
+
+async def stream_app(scope, receive, send):
+    global _connections
+    if scope['method'] != 'GET':
+        return await _respond(send, 405, b'method not allowed')
+    headers = dict(scope['headers'])
+    cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+    session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+    user = await sync_to_async(_load_user)(session_key) if session_key else None
+    if user is None:
+        return await _respond(send, 403, b'login required')
+    if _connections >= getattr(settings, 'SSE_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS):
+        return await _respond(send, 503, b'too many connections')
+
+    topics = await sync_to_async(_topics)(user, _post_ids(scope.get('query_string', b'')))
+    broker = get_broker()
+    subscription = broker.subscribe(topics)
+    closed = []
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, subscription, closed))
+    heartbeat = getattr(settings, 'SSE_HEARTBEAT_SECONDS', DEFAULT_HEARTBEAT_SECONDS)
+    _connections += 1
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': f'retry: {RETRY_MILLISECONDS}\n\n'.encode(), 'more_body': True})
+        while not closed:
+            try:
+                await asyncio.wait_for(subscription.ready.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                body = ': ping\n\n'
+            else:
+                if closed:
+                    break
+                body = ''.join(format_event(name, data) for name, data in subscription.drain())
+            # 送れるまで待つ間に届いたイベントは subscription の上限付きキューに溜まる
+            await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+    finally:
+        _connections -= 1
+        broker.unsubscribe(subscription)
+        watcher.cancel()
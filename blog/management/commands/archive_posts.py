@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from blog import archive, shards
+from blog.models import Post
+from twitter import db_router
+
+
+class Command(BaseCommand):
+    help = 'ARCHIVE_AFTER_DAYS より古いpostをLikeと一緒にアーカイブ表へ移す (cronで定期的に実行する)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='この日数より古いpostを移す (既定は ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--limit', type=int, help='1回で移す最大件数')
+        parser.add_argument('--dry-run', action='store_true', help='移す件数だけを表示する')
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('archive_posts')
+        cutoff = archive.cutoff(days=options['days'])
+        if options['dry_run']:
+            count = Post.objects.filter(created_at__lt=cutoff).count()
+            self.stdout.write(f'{count} posts older than {cutoff.isoformat()}')
+            return
+        # 移す直前のLikeを読むのでレプリカを使わない
+        token = db_router.begin_request(True)
+        try:
+            archived = archive.archive_older_than(cutoff, options['limit'])
+        finally:
+            db_router.end_request(token)
+        self.stdout.write(f'archived {archived} posts older than {cutoff.isoformat()}')
@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from blog import benchmark
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'generate_dataset で作ったデータに対して主要エンドポイントの負荷試験をしてJSONに書き出す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='bench', help='generate_dataset の --prefix')
+        parser.add_argument('--iterations', type=int, default=200, help='シナリオごとの試行回数')
+        parser.add_argument('--threads', type=int, default=1)
+        parser.add_argument('--scenario', action='append', help='実行するシナリオ (複数指定可)')
+        parser.add_argument('--sample-users', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--compare-auth', action='store_true',
+            help='シナリオの代わりに、ホームをDBのセッション/認証とキャッシュしたもの (cached_db, user.backends) で比べる',
+        )
+        parser.add_argument('--output', help='結果のJSONファイル (省略時は benchmarks/<日時>.json)')
+
+    def _git_revision(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _write_result(self, name, result):
+        latency = result['latency_ms']
+        self.stdout.write(
+            f"{name}: {result['throughput_per_sec']:.1f}/s "
+            f"p50={latency.get('p50', 0):.1f}ms p95={latency.get('p95', 0):.1f}ms "
+            f"p99={latency.get('p99', 0):.1f}ms "
+            f"queries={result['queries_per_iteration'].get('mean', 0):.1f} errors={result['errors']}"
+        )
+
+    def handle(self, *args, **options):
+        users = list(User.objects.filter(username__startswith=options['prefix']).order_by('id')[:options['sample_users']])
+        post_ids = list(Post.objects.filter(author__in=users).values_list('id', flat=True)[:10000])
+        if not users or not post_ids:
+            raise CommandError('no dataset found. run generate_dataset first')
+
+        scenarios = benchmark.default_scenarios(users, post_ids)
+        if options['scenario']:
+            scenarios = [scenario for scenario in scenarios if scenario.name in options['scenario']]
+        if options['compare_auth']:
+            scenarios = []
+
+        report = {
+            'started_at': timezone.now().isoformat(),
+            'revision': self._git_revision(),
+            'iterations': options['iterations'],
+            'threads': options['threads'],
+            'scenarios': {},
+        }
+        for scenario in scenarios:
+            result = benchmark.run_scenario(
+                scenario, users, options['iterations'], options['threads'], options['seed'],
+            )
+            report['scenarios'][scenario.name] = result
+            self._write_result(scenario.name, result)
+        if options['compare_auth']:
+            results = benchmark.compare_auth(
+                users, post_ids, options['iterations'], options['threads'], options['seed'],
+            )
+            for name, result in results.items():
+                report['scenarios'][f'home_timeline[{name}]'] = result
+                self._write_result(f'home_timeline[{name}]', result)
+            db, cached = results['db'], results['cached']
+            report['auth_savings'] = {
+                'queries_per_request': db['queries_per_iteration'].get('mean', 0)
+                - cached['queries_per_iteration'].get('mean', 0),
+                'p50_ms': db['latency_ms'].get('p50', 0) - cached['latency_ms'].get('p50', 0),
+            }
+            self.stdout.write(
+                f"cached session/auth saves {report['auth_savings']['queries_per_request']:.1f} queries "
+                f"and {report['auth_savings']['p50_ms']:.2f}ms p50 per request"
+            )
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'benchmarks', timezone.now().strftime('%Y%m%d-%H%M%S.json'),
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f'wrote {output}')
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from blog import benchmark
+from blog.models import Post
+
+
+# (ASYNC_VIEWS, ASGIか)。asgi_sync は同期viewのままASGIで動かす比較用
+MODES = {
+    'wsgi': (False, False),
+    'asgi_sync': (False, True),
+    'asgi': (True, True),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'generate_dataset で作ったデータに対して、同期view+WSGIと非同期view+ASGIの'
+        '高い同時接続数でのスループットを比べてJSONに書き出す'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='bench', help='generate_dataset の --prefix')
+        parser.add_argument('--requests', type=int, default=2000, help='モードごとのリクエスト数')
+        parser.add_argument('--concurrency', type=int, default=64, help='同時リクエスト数 (WSGIではスレッド数)')
+        parser.add_argument('--db-latency-ms', type=float, default=0,
+                            help='SQLごとに足す待ち時間。ネットワーク越しのDBを模す')
+        parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                            help='比べるモード (複数指定可。省略時は wsgi と asgi)')
+        parser.add_argument('--sample-users', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='結果のJSONファイル (省略時は benchmarks/servers-<日時>.json)')
+        # 子プロセスとして1つのモードを測ってJSONを標準出力に書く
+        parser.add_argument('--child', action='store_true', help='(内部用)')
+
+    def handle(self, *args, **options):
+        if options['child']:
+            return self._run_child(options)
+        modes = options['mode'] or ['wsgi', 'asgi']
+        report = {
+            'started_at': timezone.now().isoformat(),
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'db_latency_ms': options['db_latency_ms'],
+            'modes': {},
+        }
+        for mode in modes:
+            # ASYNC_VIEWS はURLconfの読み込み時に決まるので、モードごとにプロセスを分ける
+            result = self._spawn(mode, options)
+            report['modes'][mode] = result
+            latency = result['latency_ms']
+            self.stdout.write(
+                f"{mode}: {result['throughput_per_sec']:.1f}/s "
+                f"p50={latency.get('p50', 0):.1f}ms p95={latency.get('p95', 0):.1f}ms "
+                f"p99={latency.get('p99', 0):.1f}ms errors={result['errors']}"
+            )
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'benchmarks', timezone.now().strftime('servers-%Y%m%d-%H%M%S.json'),
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f'wrote {output}')
+
+    def _spawn(self, mode, options):
+        async_views, _ = MODES[mode]
+        command = [
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_servers', '--child',
+            '--mode', mode,
+            '--prefix', options['prefix'],
+            '--requests', str(options['requests']),
+            '--concurrency', str(options['concurrency']),
+            '--db-latency-ms', str(options['db_latency_ms']),
+            '--sample-users', str(options['sample_users']),
+            '--seed', str(options['seed']),
+        ]
+        # debug_toolbarのような同期専用ミドルウェアが入るとASGIでもview全体が1本のスレッドに回るので、
+        # 本番相当の DEBUG = False で測る
+        env = dict(
+            os.environ,
+            TWITTER_ASYNC_VIEWS='1' if async_views else '0',
+            TWITTER_DEBUG='0',
+            TWITTER_ALLOWED_HOSTS=os.environ.get('TWITTER_ALLOWED_HOSTS') or 'localhost',
+        )
+        process = subprocess.run(command, env=env, capture_output=True, text=True)
+        if process.returncode:
+            raise CommandError(f'{mode} failed:\n{process.stderr}')
+        return json.loads(process.stdout)
+
+    def _run_child(self, options):
+        mode = (options['mode'] or ['wsgi'])[0]
+        async_views, use_asgi = MODES[mode]
+        if settings.ASYNC_VIEWS != async_views:
+            raise CommandError(f'{mode} needs TWITTER_ASYNC_VIEWS={int(async_views)}')
+        users = list(User.objects.filter(username__startswith=options['prefix']).order_by('id')[:options['sample_users']])
+        post_ids = list(Post.objects.filter(author__in=users).values_list('id', flat=True)[:10000])
+        if not users or not post_ids:
+            raise CommandError('no dataset found. run generate_dataset first')
+        cookies = benchmark.session_cookies(users)
+        requests = benchmark.server_requests(users, post_ids, options['requests'], options['seed'])
+
+        if options['db_latency_ms']:
+            delay = options['db_latency_ms'] / 1000
+
+            def slow_execute(execute, sql, params, many, context):
+                time.sleep(delay)
+                return execute(sql, params, many, context)
+
+            def add_latency(sender, connection, **kwargs):
+                # 同じ接続オブジェクトが再接続するたびに呼ばれる
+                if slow_execute not in connection.execute_wrappers:
+                    connection.execute_wrappers.append(slow_execute)
+            connection_created.connect(add_latency, weak=False)
+
+        if use_asgi:
+            from twitter.asgi import application
+
+            async def run():
+                # 非同期viewが別スレッドで投げるクエリ用。WSGIのスレッド数と揃える
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(options['concurrency']))
+                return await benchmark.run_asgi(application, requests, cookies, options['concurrency'])
+            result = asyncio.run(run())
+        else:
+            from twitter.wsgi import application
+            result = benchmark.run_wsgi(application, requests, cookies, options['concurrency'])
+        result['mode'] = mode
+        self.stdout.write(json.dumps(result))
@@ -0,0 +1,30 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from blog import transfer
+from twitter import db_router
+from user import recommendations
+
+
+class Command(BaseCommand):
+    help = 'フォローのおすすめをフォローのグラフから計算して Recommendation の表に書く (cronで定期的に実行する)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', help='前回からフォローを変えたユーザだけを計算する')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-size', type=int, default=recommendations.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--progress-every', type=int, default=transfer.DEFAULT_PROGRESS_EVERY)
+
+    def handle(self, *args, **options):
+        progress = transfer.Progress(self.stdout.write, options['progress_every'])
+        # 計算の基準にした時刻より前のフォローを読み落とさないようレプリカを使わない
+        token = db_router.begin_request(True)
+        try:
+            computed = recommendations.run(
+                incremental=options['incremental'], processes=options['processes'],
+                chunk_size=options['chunk_size'], progress=progress,
+            )
+        finally:
+            db_router.end_request(token)
+        self.stdout.write(f'computed recommendations for {computed} users')
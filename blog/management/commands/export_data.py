@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+
+from blog import shards, transfer
+
+
+class Command(BaseCommand):
+    help = (
+        'ユーザ、post、Like、フォローをNDJSON (.gz なら gzip) に書き出す。'
+        'idのキーセットで少しずつ読むので行数によらずメモリは一定'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="書き出すファイル。'-' なら標準出力")
+        parser.add_argument('--model', action='append', choices=list(transfer.SPECS),
+                            help='書き出すモデル (複数指定可。省略時は全部)')
+        parser.add_argument('--gzip', action='store_true', default=None, help='拡張子によらずgzipで圧縮する')
+        parser.add_argument('--chunk-size', type=int, default=transfer.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--progress-every', type=int, default=transfer.DEFAULT_PROGRESS_EVERY,
+                            help='進捗を表示する行数の間隔 (0なら表示しない)')
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('export_data')
+        # 標準出力にデータを書くことがあるので、進捗は標準エラーに出す
+        progress = transfer.Progress(self.stderr.write, options['progress_every'])
+        alias = router.db_for_read(User)
+        with transfer.open_stream(options['path'], 'w', options['gzip']) as stream, transaction.atomic(using=alias):
+            # 全テーブルを1つのスナップショットから読み、Likeの参照先のpostが書き出されていない、などを防ぐ
+            if connections[alias].vendor == 'postgresql':
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            counts = transfer.export(stream, options['model'], options['chunk_size'], alias, progress)
+        self.stderr.write('exported ' + ', '.join(f'{count} {name}s' for name, count in counts.items()))
@@ -0,0 +1,110 @@
+import random
+import time
+from array import array
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from blog import shards, timeline
+from blog.models import Post, Like
+from user.models import Follow
+
+
+class Command(BaseCommand):
+    help = '負荷試験用のデータ (フォロワー数がべき分布のソーシャルグラフ、投稿、Like) を一括投入する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=20000)
+        parser.add_argument('--likes', type=int, default=50000)
+        parser.add_argument('--avg-following', type=int, default=50, help='1ユーザあたりの平均フォロー数')
+        parser.add_argument('--alpha', type=float, default=1.2, help='人気度 (Zipf) の指数。大きいほど偏る')
+        parser.add_argument('--days', type=int, default=30, help='投稿日時を散らばらせる日数')
+        parser.add_argument('--prefix', default='bench', help='作成するユーザ名の接頭辞')
+        parser.add_argument('--password', default='bench-password')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-timelines', action='store_true', help='受信箱の構築を省略する')
+
+    def _progress(self, label, done, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{label}: {done} rows in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.0f} rows/s)')
+
+    def _bulk_insert(self, model, rows, batch_size, label):
+        started = time.perf_counter()
+        done = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                model.objects.bulk_create(batch, ignore_conflicts=True)
+                done += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch, ignore_conflicts=True)
+            done += len(batch)
+        self._progress(label, done, started)
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('generate_dataset')
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        prefix = options['prefix']
+        now = timezone.now()
+
+        # PBKDF2は1回だけ計算して全ユーザで使い回す
+        password = make_password(options['password'])
+        self._bulk_insert(User, (
+            User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password=password)
+            for i in range(options['users'])
+        ), batch_size, 'users')
+        user_ids = array('q', User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+        if not user_ids:
+            return
+
+        # i番目のユーザの人気度を 1 / (i+1)^alpha とする (Zipf分布)
+        popularity = list(accumulate(1 / (rank + 1) ** options['alpha'] for rank in range(len(user_ids))))
+
+        def follows():
+            for user_id in user_ids:
+                count = min(int(rng.expovariate(1 / options['avg_following'])), len(user_ids) - 1)
+                followees = set(rng.choices(user_ids, cum_weights=popularity, k=count))
+                followees.discard(user_id)
+                for followee in followees:
+                    yield Follow(following_id=user_id, follower_id=followee, created_at=now)
+        self._bulk_insert(Follow, follows(), batch_size, 'follows')
+
+        seconds = options['days'] * 24 * 60 * 60
+
+        def posts():
+            for _ in range(options['posts']):
+                author = rng.choices(user_ids, cum_weights=popularity)[0]
+                created_at = now - timedelta(seconds=rng.uniform(0, seconds))
+                yield Post(author_id=author, content=f'tweet {rng.getrandbits(32):08x}', created_at=created_at)
+        self._bulk_insert(Post, posts(), batch_size, 'posts')
+
+        post_ids = array('q', (
+            Post.objects.filter(author__username__startswith=prefix)
+            .order_by('-created_at').values_list('id', flat=True)
+        ))
+
+        def likes():
+            for _ in range(options['likes']):
+                # 新しいpostほどLikeされやすくする
+                index = int(len(post_ids) * rng.random() ** 3)
+                yield Like(user_id=rng.choice(user_ids), post_id=post_ids[index], created_at=now)
+        if post_ids:
+            self._bulk_insert(Like, likes(), batch_size, 'likes')
+
+        call_command('reconcile_counters', chunk_size=batch_size, stdout=self.stdout)
+        call_command('rebuild_search_index', chunk_size=batch_size, stdout=self.stdout)
+        if not options['skip_timelines']:
+            started = time.perf_counter()
+            for user in User.objects.filter(username__startswith=prefix).iterator(chunk_size=batch_size):
+                timeline.rebuild(user)
+            self._progress('timelines', len(user_ids), started)
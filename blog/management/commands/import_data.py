@@ -0,0 +1,44 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from blog import shards, transfer
+from twitter import db_router
+
+
+class Command(BaseCommand):
+    help = (
+        'export_data で書き出したNDJSONを bulk_create で取り込む。idは既存の最大idの後ろにずらし、'
+        'ユーザ名が既にあるユーザは既存のユーザに付け替える'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="読み込むファイル。'-' なら標準入力")
+        parser.add_argument('--gzip', action='store_true', default=None, help='拡張子によらずgzipとして読む')
+        parser.add_argument('--batch-size', type=int, default=transfer.DEFAULT_CHUNK_SIZE)
+        parser.add_argument('--progress-every', type=int, default=transfer.DEFAULT_PROGRESS_EVERY,
+                            help='進捗を表示する行数の間隔 (0なら表示しない)')
+        parser.add_argument('--skip-derived', action='store_true',
+                            help='カウンタ、検索索引、ハッシュタグ、タイムラインを作り直さない')
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('import_data')
+        progress = transfer.Progress(self.stdout.write, options['progress_every'])
+        # 既存の最大idやユーザ名はプライマリで見る
+        token = db_router.begin_request(True)
+        try:
+            with transfer.open_stream(options['path'], 'r', options['gzip']) as stream:
+                counts = transfer.load(stream, DEFAULT_DB_ALIAS, options['batch_size'], progress)
+        except transfer.TransferError as e:
+            raise CommandError(f'import stopped: {e}')
+        finally:
+            db_router.end_request(token)
+        self.stdout.write('imported ' + ', '.join(f'{count} {name}s' for name, count in counts.items()))
+
+        # like_count などは取り込んだ値をそのまま入れているので、付け替えで変わった分を数え直す
+        if counts and not options['skip_derived']:
+            batch_size = options['batch_size']
+            call_command('reconcile_counters', chunk_size=batch_size, stdout=self.stdout)
+            call_command('rebuild_search_index', chunk_size=batch_size, stdout=self.stdout)
+            call_command('rebuild_entities', chunk_size=batch_size, stdout=self.stdout)
+            call_command('rebuild_timeline', stdout=self.stdout)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from blog import explain, querybudget
+
+
+class Command(BaseCommand):
+    help = (
+        'テスト用DBで全URLのリクエストを実行し、投げたクエリをEXPLAINして'
+        '全件走査とインデックスを使わない並べ替えを表示する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=querybudget.SIZES[-1], help='querybudget のデータの大きさ')
+        parser.add_argument('--case', action='append', help='対象のURL名 (複数指定可。省略時は全部)')
+        parser.add_argument('--all', action='store_true', help='問題の無いクエリの実行計画も表示する')
+        parser.add_argument('--check', action='store_true', help='問題があれば終了コードを0以外にする')
+
+    def handle(self, *args, **options):
+        cases = [case for case in querybudget.CASES if not options['case'] or case.name in options['case']]
+        if not cases:
+            raise CommandError('no such case')
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            results = explain.advise(cases, options['size'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        flagged = 0
+        for key, plans in results.items():
+            bad = [plan for plan in plans if plan.problems]
+            flagged += len(bad)
+            self.stdout.write(f'{key}: {len(plans)} queries, {len(bad)} flagged')
+            for plan in plans if options['all'] else bad:
+                self.stdout.write(f'  {plan.sql}')
+                for line in plan.lines:
+                    self.stdout.write(f'    {line}')
+                for problem in plan.problems:
+                    self.stdout.write(self.style.WARNING(f'    ! {problem}'))
+        if flagged and options['check']:
+            raise CommandError(f'{flagged} queries use full scans or sorts without an index')
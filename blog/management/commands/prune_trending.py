@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from blog import trending
+
+
+class Command(BaseCommand):
+    help = 'トレンド集計の窓から外れた1分ごとのバケットを消す (cronで定期的に実行する)'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'deleted {trending.prune()} buckets')
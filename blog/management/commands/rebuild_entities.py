@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blog import entities, shards
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = '既存のpostからハッシュタグとメンションを取り出し直す (トレンドには数えない)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('rebuild_entities')
+        updated = 0
+        last_id = 0
+        while True:
+            posts = list(
+                Post.objects.filter(id__gt=last_id).order_by('id')
+                .only('id', 'content', 'created_at')[:options['chunk_size']]
+            )
+            if not posts:
+                break
+            with transaction.atomic():
+                for post in posts:
+                    entities.update_entities(post, count_trending=False, notify=False)
+            updated += len(posts)
+            last_id = posts[-1].pk
+        self.stdout.write(f'updated entities for {updated} posts')
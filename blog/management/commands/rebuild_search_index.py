@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blog import search, shards
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'postsテーブルをid順に少しずつ読み、全文検索の索引を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('rebuild_search_index')
+        chunk_size = options['chunk_size']
+        started = time.perf_counter()
+        search.clear()
+        indexed = 0
+        last_id = 0
+        while True:
+            # idのキーセットで読むので、OFFSETと違って後半のチャンクも遅くならない
+            posts = list(
+                Post.objects.filter(id__gt=last_id).order_by('id').only('id', 'content')[:chunk_size]
+            )
+            if not posts:
+                break
+            with transaction.atomic():
+                search.index_posts(posts)
+            indexed += len(posts)
+            last_id = posts[-1].pk
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'indexed {indexed} posts ({indexed / max(elapsed, 1e-9):.0f} posts/s)')
+        self.stdout.write(f'rebuilt search index for {indexed} posts')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+
+from blog import timeline
+
+
+class Command(BaseCommand):
+    help = 'ユーザごとのタイムライン受信箱をPost/Followから作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='対象ユーザ (省略時は全員)')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        rebuilt = 0
+        for user in users.iterator(chunk_size=options['chunk_size']):
+            timeline.rebuild(user)
+            rebuilt += 1
+        self.stdout.write(f'rebuilt {rebuilt} timelines')
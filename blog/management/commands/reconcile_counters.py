@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max, Min
+
+from blog import counters as like_counters, shards, timeline
+from blog.models import Post
+from jobs import queue
+from user import counters as follow_counters
+from user.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Post.like_count と Profile のフォロー数を実数に合わせる'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def _reconcile(self, label, queryset, reconcile, chunk_size):
+        bounds = queryset.aggregate(start=Min('id'), stop=Max('id'))
+        if bounds['start'] is None:
+            return
+        fixed = 0
+        for start in range(bounds['start'], bounds['stop'] + 1, chunk_size):
+            with transaction.atomic():
+                fixed += reconcile(start, start + chunk_size)
+        self.stdout.write(f'{label}: fixed {fixed} rows')
+
+    def _reconcile_follows(self, start, stop):
+        # 直したことでpull対象から外れたユーザは、pull対象の間の投稿をフォロワーの受信箱へ配り直す
+        pulled = Profile.objects.filter(user_id__gte=start, user_id__lt=stop, follower_count__gt=timeline.fanout_threshold())
+        before = dict(pulled.values_list('user_id', 'follower_count'))
+        fixed = follow_counters.reconcile(start, stop)
+        if before:
+            after = Profile.objects.filter(user_id__in=before).values_list('user_id', 'follower_count')
+            for user_id, follower_count in after:
+                if timeline.left_pull(before[user_id], follower_count):
+                    queue.enqueue('timeline.backfill_followers', author_id=user_id)
+        return fixed
+
+    def handle(self, *args, **options):
+        shards.require_unsharded('reconcile_counters')
+        chunk_size = options['chunk_size']
+        self._reconcile('likes', Post.objects.all(), like_counters.reconcile, chunk_size)
+        self._reconcile('follows', User.objects.all(), self._reconcile_follows, chunk_size)
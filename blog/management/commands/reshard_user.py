@@ -0,0 +1,29 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from blog import shards
+
+
+class Command(BaseCommand):
+    help = 'ユーザのpostとLikeを別のシャードへ移す。最後の差分を写す間だけそのユーザの書き込みを止める'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('alias', help='移す先のシャード (POST_SHARDS のどれか)')
+        parser.add_argument('--chunk-size', type=int, default=shards.DEFAULT_MOVE_CHUNK_SIZE)
+        parser.add_argument('--grace', type=float,
+                            help='割り当てを変えた後に待つ秒数 (既定は POST_SHARD_CACHE_TIMEOUT)')
+
+    def handle(self, *args, **options):
+        if not shards.enabled():
+            raise CommandError('POST_SHARDS is not set')
+        if options['alias'] not in shards.aliases():
+            raise CommandError(f"{options['alias']} is not in POST_SHARDS ({', '.join(shards.aliases())})")
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f"user {options['username']!r} does not exist")
+        moved = shards.move_user(
+            user.pk, options['alias'], chunk_size=options['chunk_size'], grace=options['grace'],
+            report=self.stdout.write,
+        )
+        self.stdout.write(f"moved {moved} posts of {user.username} to {options['alias']}")
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from blog import querybudget
+
+
+class Command(BaseCommand):
+    help = 'テスト用DBで全URLのクエリ数を測り、query_budgets.json を書き換える'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='書き換えずに予算との差分だけ表示する')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            results = querybudget.measure_all()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        old = querybudget.load_budgets()
+        new = querybudget.to_budgets(results)
+        problems = []
+        for key, budget in new.items():
+            before = old.get(key, {}).get('queries')
+            self.stdout.write(f'{key}: {before} -> {budget["queries"]} queries ({budget["db_time_ms"]:.1f}ms)')
+            problems += querybudget.check(key, results[key], old.get(key) if options['check'] else budget)
+        for key in sorted(set(old) - set(new)):
+            self.stdout.write(f'{key}: removed')
+
+        if problems:
+            raise CommandError('\n'.join(problems))
+        if not options['check']:
+            querybudget.save_budgets(new)
+            self.stdout.write(f'wrote {querybudget.BUDGET_FILE}')
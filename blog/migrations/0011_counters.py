@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    Like = apps.get_model('blog', 'Like')
+    actual = Subquery(
+        Like.objects.filter(post=OuterRef('pk')).order_by()
+        .values('post').annotate(count=Count('id')).values('count')
+    )
+    Post.objects.update(like_count=Coalesce(actual, Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0010_timeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
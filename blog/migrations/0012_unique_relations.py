@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:06
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def dedupe_likes(apps, schema_editor):
+    """同じ (user, post) のLikeは最も古い1行だけ残し、like_countを数え直す"""
+    Post = apps.get_model('blog', 'Post')
+    Like = apps.get_model('blog', 'Like')
+    duplicates = (
+        Like.objects.order_by().values('user', 'post')
+        .annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    )
+    post_ids = set()
+    for row in duplicates.iterator():
+        Like.objects.filter(user=row['user'], post=row['post']).exclude(id=row['keep']).delete()
+        post_ids.add(row['post'])
+    actual = Subquery(
+        Like.objects.filter(post=OuterRef('pk')).order_by()
+        .values('post').annotate(count=Count('id')).values('count')
+    )
+    post_ids = sorted(post_ids)
+    for i in range(0, len(post_ids), 500):
+        Post.objects.filter(id__in=post_ids[i:i + 500]).update(like_count=Coalesce(actual, Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('blog', '0011_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_likes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='like',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='like_user', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='like_unique_user_post'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_fts_table(apps, schema_editor):
+    # FTS5付きのSQLiteでだけ作る。無ければ blog.search は search_term を使う
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+            return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS post_search '
+        'USING fts5(terms, tokenize = "unicode61 remove_diacritics 0")'
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS post_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0013_post_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=2)),
+                ('count', models.PositiveSmallIntegerField(default=1)),
+                ('post', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='blog.post')),
+            ],
+            options={
+                'db_table': 'search_term',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='searchterm',
+            index=models.Index(fields=['post'], name='search_term_post_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='searchterm',
+            constraint=models.UniqueConstraint(fields=('term', 'post'), name='search_term_unique_term_post'),
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -6,7 +6,11 @@ from django.contrib.auth.models import User
 class Post(models.Model):
     content = models.TextField(max_length=140)
     created_at = models.DateTimeField(default=timezone.now)
-    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    # シャーディングするとユーザとpostが別のDBになるので、postとLike、postを指す外部キーには
+    # DBの制約を付けない (blog.shards)
+    author = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False, db_constraint=False)
+    like_count = models.PositiveIntegerField(default=0)
+    version = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return self.content
@@ -14,12 +18,194 @@ class Post(models.Model):
     class Meta:
         db_table = 'posts'
         ordering = ['-created_at']
+        indexes = [
+            # 投稿履歴、フォロー直後の取り込み、pull対象の読み出し (authorだけの検索も兼ねる)
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_created_idx'),
+            # Meta.ordering の並べ替えとアーカイブ対象の絞り込み
+            models.Index(fields=['-created_at', '-id'], name='post_created_idx'),
+        ]
 
 
 class Like(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='like_user')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='like_user', db_index=False, db_constraint=False)
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='like_post')
     created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"{self.user} liked {self.post.pk}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='like_unique_user_post'),
+        ]
+        indexes = [
+            # 通知の集計でpostごとに新しいLikeだけを読む
+            models.Index(fields=['post', 'created_at'], name='like_post_created_idx'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """ユーザごとのホームタイムライン (fan-out-on-writeで書き込む)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries', db_constraint=False)
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.post.pk} in {self.user}'s timeline"
+
+    class Meta:
+        db_table = 'timeline'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='timeline_unique_user_post'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post'], name='timeline_user_created_idx'),
+            models.Index(fields=['user', 'author'], name='timeline_user_author_idx'),
+        ]
+
+
+class SearchTerm(models.Model):
+    """FTS5が使えないDB向けの転置インデックス (blog.search を参照)"""
+    term = models.CharField(max_length=2)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', db_index=False, db_constraint=False)
+    count = models.PositiveSmallIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.term} in {self.post_id}"
+
+    class Meta:
+        db_table = 'search_term'
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'post'], name='search_term_unique_term_post'),
+        ]
+        indexes = [
+            models.Index(fields=['post'], name='search_term_post_idx'),
+        ]
+
+
+class Hashtag(models.Model):
+    """NFKC正規化して小文字にしたハッシュタグ名 (#は含まない)"""
+    name = models.CharField(max_length=140, unique=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"#{self.name}"
+
+    class Meta:
+        db_table = 'hashtag'
+
+
+class PostHashtag(models.Model):
+    """postに含まれるハッシュタグ。created_atはハッシュタグタイムライン用にpostから写す"""
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    hashtag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name='+', db_index=False)
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.hashtag} in {self.post_id}"
+
+    class Meta:
+        db_table = 'post_hashtag'
+        constraints = [
+            models.UniqueConstraint(fields=['hashtag', 'post'], name='post_hashtag_unique_hashtag_post'),
+        ]
+        indexes = [
+            models.Index(fields=['hashtag', '-created_at', '-post'], name='post_hashtag_created_idx'),
+        ]
+
+
+class Mention(models.Model):
+    """postの中の @username"""
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mentions', db_index=False)
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user} mentioned in {self.post_id}"
+
+    class Meta:
+        db_table = 'mention'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='mention_unique_user_post'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post'], name='mention_user_created_idx'),
+        ]
+
+
+class HashtagBucket(models.Model):
+    """ハッシュタグの1分ごとの使用回数 (トレンド集計用)"""
+    hashtag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name='+')
+    minute = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.hashtag} at {self.minute}: {self.count}"
+
+    class Meta:
+        db_table = 'hashtag_bucket'
+        constraints = [
+            models.UniqueConstraint(fields=['minute', 'hashtag'], name='hashtag_bucket_unique_minute_hashtag'),
+        ]
+
+
+class ArchivedPost(models.Model):
+    """archive_posts で posts から移した古いpost。idは元のpostのまま (URLを変えない)"""
+    id = models.BigIntegerField(primary_key=True)
+    content = models.TextField(max_length=140)
+    created_at = models.DateTimeField()
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    like_count = models.PositiveIntegerField(default=0)
+    version = models.PositiveIntegerField(default=1)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    # テンプレートやJSONで通常のpostと見分ける
+    archived = True
+
+    def __str__(self):
+        return self.content
+
+    class Meta:
+        db_table = 'archived_posts'
+        indexes = [
+            models.Index(fields=['author', '-created_at', '-id'], name='archived_post_author_idx'),
+        ]
+
+
+class ArchivedLike(models.Model):
+    """アーカイブしたpostへのLike"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    post = models.ForeignKey(ArchivedPost, on_delete=models.CASCADE, related_name='likes')
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user} liked {self.post_id}"
+
+    class Meta:
+        db_table = 'archived_like'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='archived_like_unique_user_post'),
+        ]
+
+
+class ShardAssignment(models.Model):
+    """作者のpostを置くシャード。行の無い作者は author_id % シャード数 で決める (blog.shards)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    alias = models.CharField(max_length=100)
+    # 別のシャードへ移している最中は、その作者のpostとLikeへの書き込みを止める
+    moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.alias}"
+
+    class Meta:
+        db_table = 'shard_assignment'
+
+
+class PostIdTicket(models.Model):
+    """シャードをまたいで一意なpostのidを採番する表。最後の1行だけを残す"""
+
+    class Meta:
+        db_table = 'post_id_ticket'
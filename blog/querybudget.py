@@ -0,0 +1,228 @@
+"""URLごとのSQLクエリ数の予算
+
+blog/urls.py と user/urls.py の全URLについて、データ量を変えながら1リクエストあたりの
+クエリ数とDB時間を測る。クエリ数がデータ量とともに増える (N+1) か、予算ファイル
+query_budgets.json を超えるとテストが落ちる。予算は update_query_budgets コマンドで更新する。
+"""
+import json
+from datetime import timedelta
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache as default_cache
+from django.db import transaction
+from django.test.utils import override_settings
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+
+from . import archive, counters as like_counters, entities, search, timeline
+from .benchmark import make_client, record_queries
+from .models import Post, Like
+from user import counters as follow_counters, notifications
+from user.models import Follow, Notification
+
+
+BUDGET_FILE = Path(__file__).resolve().parent / 'query_budgets.json'
+SIZES = (1, 5, 20)
+APP_NAMESPACES = ('blog', 'user')
+PASSWORD = 'budget-password'
+
+# 測定ごとに空にするので、設定されているキャッシュとは別のものを使う
+BUDGET_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'query-budget',
+    }
+}
+
+
+@lru_cache(maxsize=None)
+def _password_hash():
+    return make_password(PASSWORD)
+
+
+def build(size):
+    """viewerがsize人と相互フォローし、その全員のpostをLikeし、全員から自分のpostをLikeされているデータ"""
+    # PBKDF2は1回だけ計算して使い回す
+    password = _password_hash()
+    names = ['viewer', 'stranger'] + [f'other{i}' for i in range(size)]
+    User.objects.bulk_create([User(username=name, email=f'{name}@example.com', password=password) for name in names])
+    users = User.objects.in_bulk(names, field_name='username')
+    viewer, stranger = users['viewer'], users['stranger']
+    others = [users[name] for name in names[2:]]
+    Follow.objects.bulk_create(
+        [Follow(following=viewer, follower=other) for other in others]
+        + [Follow(following=other, follower=viewer) for other in others]
+    )
+    posts = []
+    for i in range(size):
+        post = Post.objects.create(author=others[i], content=f'post {i} #tag')
+        entities.update_entities(post, created=True, notify=False)
+        timeline.fan_out(post)
+        search.index_post(post)
+        posts.append(post)
+    # viewerの古いpostをsize件アーカイブしておく (投稿履歴用)
+    old = [Post.objects.create(author=viewer, content=f'old {i}', created_at=timezone.now() - timedelta(days=i + 1)) for i in range(size)]
+    own = Post.objects.create(author=viewer, content='own post')
+    timeline.fan_out(own)
+    Like.objects.bulk_create(
+        [Like(user=viewer, post=post) for post in posts + old] + [Like(user=other, post=own) for other in others]
+    )
+    archive.archive_posts([post.pk for post in old])
+    notifications.flush(Notification.LIKE, own.pk)
+    notifications.flush(Notification.FOLLOW, viewer.pk)
+    follow_counters.reconcile(min(u.pk for u in users.values()), max(u.pk for u in users.values()) + 1)
+    like_counters.reconcile(posts[0].pk, own.pk + 1)
+    return SimpleNamespace(viewer=viewer, others=others, stranger=stranger, posts=posts, own=own)
+
+
+class Case:
+    """1つのURLへの1種類のリクエスト
+
+    kwargs, data は build() の戻り値を受け取る関数。login=False なら未ログインで送る。
+    """
+
+    def __init__(self, name, method='get', kwargs=None, data=None, login=True):
+        self.name = name
+        self.method = method
+        self.kwargs = kwargs
+        self.data = data
+        self.login = login
+
+    @property
+    def key(self):
+        return f'{self.name} {self.method.upper()}'
+
+    def request(self, client, fixture):
+        url = reverse(self.name, kwargs=self.kwargs(fixture) if self.kwargs else None)
+        data = self.data(fixture) if self.data else None
+        return getattr(client, self.method)(url, data)
+
+
+def _own(fixture):
+    return {'pk': fixture.own.pk}
+
+
+def _other(fixture):
+    return {'username': fixture.others[0].username}
+
+
+def _viewer(fixture):
+    return {'username': fixture.viewer.username}
+
+
+CASES = [
+    Case('blog:home'),
+    Case('blog:timeline'),
+    Case('blog:like_state', data=lambda f: {'ids': ','.join(str(post.pk) for post in f.posts)}),
+    Case('blog:search', data=lambda f: {'q': 'post'}),
+    Case('blog:trending'),
+    Case('blog:hashtag', kwargs=lambda f: {'name': 'tag'}),
+    Case('blog:history', kwargs=_viewer),
+    Case('blog:create'),
+    Case('blog:create', 'post', data=lambda f: {'content': 'new post #tag #new @other0'}),
+    Case('blog:detail', kwargs=_own),
+    Case('blog:update', kwargs=_own),
+    Case('blog:update', 'post', kwargs=_own, data=lambda f: {'content': 'updated #tag @other0'}),
+    Case('blog:delete', kwargs=_own),
+    Case('blog:delete', 'post', kwargs=_own),
+    Case('blog:like', 'post', kwargs=_own),
+    Case('blog:unlike', 'post', kwargs=lambda f: {'pk': f.posts[0].pk}),
+    Case('user:signup', login=False),
+    Case('user:signup', 'post', login=False, data=lambda f: {
+        'username': 'newcomer', 'email': 'newcomer@example.com',
+        'password1': 'Budget-Passw0rd', 'password2': 'Budget-Passw0rd',
+    }),
+    Case('user:login', login=False),
+    Case('user:login', 'post', login=False, data=lambda f: {'username': 'viewer', 'password': PASSWORD}),
+    Case('user:logout'),
+    Case('user:follow_index', kwargs=_other),
+    Case('user:following', kwargs=_viewer),
+    Case('user:follower', kwargs=_viewer),
+    Case('user:following_json', kwargs=_viewer),
+    Case('user:follower_json', kwargs=_viewer),
+    Case('user:follow', kwargs=lambda f: {'username': f.stranger.username}),
+    Case('user:unfollow', kwargs=_other),
+    Case('user:notifications'),
+    Case('user:notifications_read', 'post'),
+]
+
+
+def url_names():
+    """blog と user の名前付きURLすべて"""
+    resolver = get_resolver()
+    names = set()
+    for namespace in APP_NAMESPACES:
+        _, sub_resolver = resolver.namespace_dict[namespace]
+        names.update(f'{namespace}:{name}' for name in sub_resolver.reverse_dict if isinstance(name, str))
+    return names
+
+
+def measure(case, size):
+    """sizeのデータでcaseを1回実行し (クエリ数, DB時間ms) を返す。データはロールバックする
+
+    積んだジョブはワーカーの仕事なので、JOBS_EAGER でもリクエストの中では実行しない。
+    """
+    with override_settings(CACHES=BUDGET_CACHES, JOBS_EAGER=False), transaction.atomic():
+        default_cache.clear()
+        fixture = build(size)
+        client = make_client(fixture.viewer if case.login else None)
+        with record_queries() as recorder:
+            response = case.request(client, fixture)
+        transaction.set_rollback(True)
+    if response.status_code >= 400:
+        raise AssertionError(f'{case.key} returned {response.status_code}')
+    return recorder.count, recorder.duration * 1000
+
+
+def measure_all(cases=None, sizes=SIZES):
+    """{key: {'queries': {size: n}, 'db_time_ms': {size: ms}}}"""
+    results = {}
+    for case in cases or CASES:
+        result = results[case.key] = {'queries': {}, 'db_time_ms': {}}
+        for size in sizes:
+            result['queries'][size], result['db_time_ms'][size] = measure(case, size)
+    return results
+
+
+def check(key, result, budget):
+    """予算違反の説明のリスト。問題無ければ空"""
+    problems = []
+    queries = result['queries']
+    sizes = sorted(queries)
+    if queries[sizes[-1]] > queries[sizes[0]]:
+        counts = ', '.join(f'{size}: {queries[size]}' for size in sizes)
+        problems.append(f'{key}: query count grows with result size ({counts})')
+    if budget is None:
+        problems.append(f'{key}: no budget; run manage.py update_query_budgets')
+    elif max(queries.values()) > budget['queries']:
+        problems.append(f'{key}: {max(queries.values())} queries exceeds budget of {budget["queries"]}')
+    return problems
+
+
+def load_budgets(path=BUDGET_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def to_budgets(results):
+    """測定結果を予算ファイルの形にする。DB時間は参考値"""
+    return {
+        key: {
+            'queries': max(result['queries'].values()),
+            'db_time_ms': round(max(result['db_time_ms'].values()), 1),
+        }
+        for key, result in sorted(results.items())
+    }
+
+
+def save_budgets(budgets, path=BUDGET_FILE):
+    with open(path, 'w') as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,208 @@
+"""postの全文検索
+
+形態素解析を使わず、NFKC正規化した文字bigramで転置インデックスを作る。語の最後の1文字も
+単独のtermとして入れるので、1文字の検索語は前方一致で探せる。
+SQLiteでFTS5が使えれば仮想テーブル post_search を、使えなければ SearchTerm テーブルを使う。
+FTS5では検索語の各語をフレーズとして照合し、SearchTermでは全termを含むpostを返す。
+"""
+import base64
+import binascii
+import re
+import unicodedata
+from collections import Counter
+from functools import reduce
+from operator import add, or_
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db import connections, router
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, IntegerField, Max, Q, Sum, Value, When
+
+from . import shards
+from .models import Post, SearchTerm
+
+
+FTS_TABLE = 'post_search'
+DEFAULT_PAGE_SIZE = 20
+MAX_QUERY_LENGTH = 140
+
+# 「_」はFTS5のunicode61では区切り文字なので語に含めない
+_WORD = re.compile(r'[^\W_]+')
+
+
+def page_size():
+    return getattr(settings, 'SEARCH_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def _words(text):
+    return _WORD.findall(unicodedata.normalize('NFKC', text).lower())
+
+
+def tokenize(text):
+    """索引に入れるterm列 (語ごとのbigramと最後の1文字)"""
+    for word in _words(text):
+        for i in range(len(word) - 1):
+            yield word[i:i + 2]
+        yield word[-1]
+
+
+def parse_query(query):
+    """検索語を [(bigramのタプル, 前方一致する1文字)] にする。語ごとにどちらか一方"""
+    units = []
+    for word in _words(query):
+        if len(word) == 1:
+            units.append(((), word))
+        else:
+            units.append((tuple(word[i:i + 2] for i in range(len(word) - 1)), None))
+    return units
+
+
+def encode_cursor(score, pk):
+    raw = f'{score!r}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        score, pk = base64.urlsafe_b64decode(padded).decode().split('|')
+        return float(score), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest('invalid cursor')
+
+
+_fts_tables = {}
+
+
+def fts_enabled(alias):
+    """aliasのDBで post_search を使うか。SEARCH_BACKEND = 'table' ならFTS5を使わない"""
+    if getattr(settings, 'SEARCH_BACKEND', None) == 'table':
+        return False
+    if alias not in _fts_tables:
+        connection = connections[alias]
+        _fts_tables[alias] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[alias]
+
+
+def _write_alias():
+    return router.db_for_write(Post)
+
+
+def index_posts(posts):
+    """postの索引を作り直す (作成・更新時)"""
+    posts = list(posts)
+    if not posts:
+        return
+    alias = _write_alias()
+    if fts_enabled(alias):
+        rows = [(post.pk, ' '.join(tokenize(post.content))) for post in posts]
+        with connections[alias].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk, _ in rows])
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, terms) VALUES (%s, %s)', rows)
+        return
+    SearchTerm.objects.filter(post__in=posts).delete()
+    SearchTerm.objects.bulk_create([
+        SearchTerm(term=term, post_id=post.pk, count=count)
+        for post in posts
+        for term, count in Counter(tokenize(post.content)).items()
+    ])
+
+
+def index_post(post):
+    index_posts([post])
+
+
+def remove_post(post):
+    remove_posts([post.pk])
+
+
+def remove_posts(post_ids):
+    """postを索引から外す。SearchTermはpostの削除で一緒に消える"""
+    alias = _write_alias()
+    if fts_enabled(alias):
+        with connections[alias].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in post_ids])
+    else:
+        SearchTerm.objects.filter(post_id__in=post_ids).delete()
+
+
+def clear():
+    alias = _write_alias()
+    if fts_enabled(alias):
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    SearchTerm.objects.all().delete()
+
+
+def _search_fts(alias, units, after, limit):
+    match = ' '.join(
+        f'"{prefix}"*' if prefix else '"{}"'.format(' '.join(bigrams))
+        for bigrams, prefix in units
+    )
+    sql = (
+        f'SELECT id, score FROM ('
+        f'SELECT rowid AS id, -bm25({FTS_TABLE}) AS score FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+        f')'
+    )
+    params = [match]
+    if after:
+        sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY score DESC, id DESC LIMIT %s'
+    params.append(limit + 1)
+    with connections[alias].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _search_table(alias, units, after, limit):
+    # 語ごとに、そのbigramを全部含むか、1文字で始まるtermを含むものを条件にする
+    lookups = []
+    for bigrams, prefix in units:
+        lookups += [('term__startswith', prefix)] if prefix else [('term', bigram) for bigram in bigrams]
+    conditions = [Q(**{lookup: value}) for lookup, value in dict.fromkeys(lookups)]
+    terms = SearchTerm.objects.using(alias).filter(reduce(or_, conditions))
+    # 出現postが少ない条件ほど重くする (tf / df)
+    df = terms.aggregate(**{
+        f'df{i}': Count('post', distinct=True, filter=condition) for i, condition in enumerate(conditions)
+    })
+    if not all(df.values()):
+        return []
+    matched = {
+        f'has{i}': Max(Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField()))
+        for i, condition in enumerate(conditions)
+    }
+    score = reduce(add, [
+        Sum(ExpressionWrapper(F('count') * Value(1 / df[f'df{i}']), output_field=FloatField()), filter=condition)
+        for i, condition in enumerate(conditions)
+    ])
+    rows = (
+        terms.values('post_id')
+        .annotate(score=score, **matched)
+        .filter(**{name: 1 for name in matched})
+    )
+    if after:
+        rows = rows.filter(Q(score__lt=after[0]) | Q(score=after[0], post_id__lt=after[1]))
+    return list(rows.order_by('-score', '-post_id').values_list('post_id', 'score')[:limit + 1])
+
+
+def search(query, cursor=None, limit=None):
+    """関連度の高い順に1ページ分のpostを返す。戻り値は (posts, next_cursor)"""
+    if len(query) > MAX_QUERY_LENGTH:
+        raise BadRequest(f'query must be at most {MAX_QUERY_LENGTH} characters')
+    limit = limit or page_size()
+    after = decode_cursor(cursor) if cursor else None
+    units = parse_query(query)
+    if not units:
+        return [], None
+    alias = router.db_for_read(Post)
+    if fts_enabled(alias):
+        rows = _search_fts(alias, units, after, limit)
+    else:
+        rows = _search_table(alias, units, after, limit)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    posts = shards.in_bulk([pk for pk, _ in rows])
+    return [posts[pk] for pk, _ in rows if pk in posts], next_cursor
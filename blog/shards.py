@@ -0,0 +1,438 @@
+"""postとLikeの作者ごとのシャーディング
+
+POST_SHARDS にDBエイリアスを並べると、Post と Like を作者ごとにそのどれかへ置く
+(Likeはpostと同じシャード)。空なら今まで通り全部 default に置き、ここの関数は
+シャーディングしていないときと同じクエリを投げるだけになる。
+
+- 作者のシャードは ShardAssignment の行があればそれ、なければ author_id % シャード数。
+  割り当ては default に置き、POST_SHARD_CACHE_TIMEOUT 秒キャッシュする。
+- postのidはシャードをまたいで一意になるよう default の PostIdTicket で採番するので、
+  作者を移してもidもURLも変わらない。
+- ユーザ、受信箱、ハッシュタグ、通知などは default に残る。postへの外部キーにはDBの制約が
+  無いので、postを消すときは delete_post() で default 側の行も消す。
+- idしか分からないpostは全シャードに問い合わせ (scatter-gather)、複数の作者のpostは
+  シャードごとに新しい順に読んでから k-way merge する。
+- move_user() で作者の行を書き込みを止めずに別のシャードへ写し、最後に短い間だけ
+  書き込みを止めて差分を写してから切り替える (reshard_user コマンド)。
+
+シャードにはレプリカを置かない。集計やデータ移行の管理コマンド (archive_posts,
+export_data, reconcile_counters など) は default だけを見るので、シャーディング中は動かさない。
+"""
+import heapq
+import time
+from contextlib import nullcontext
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.http import Http404, HttpResponse
+from django.utils import timezone
+
+from .models import Like, Mention, Post, PostHashtag, PostIdTicket, SearchTerm, ShardAssignment, TimelineEntry
+from twitter import db_router
+
+
+DEFAULT_CACHE_TIMEOUT = 60
+DEFAULT_MOVE_CHUNK_SIZE = 1000
+# 書き込みを止めている作者へのリクエストに返す Retry-After (秒)
+RETRY_AFTER = 5
+
+
+class ShardMoving(Exception):
+    """作者の行を別のシャードへ移している最中で、書き込めない"""
+
+
+def aliases():
+    return getattr(settings, 'POST_SHARDS', [])
+
+
+def enabled():
+    return bool(aliases())
+
+
+def cache_timeout():
+    return getattr(settings, 'POST_SHARD_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def require_unsharded(command):
+    """default のpostだけを見る管理コマンドの最初に呼ぶ"""
+    if enabled():
+        raise CommandError(f'{command} reads posts only from the default database and cannot run while POST_SHARDS is set')
+
+
+def _assignment_key(author_id):
+    return f'shard:author:{author_id}'
+
+
+def _assignments(author_ids):
+    """{author_id: (alias, moving)}"""
+    keys = {_assignment_key(author_id): author_id for author_id in author_ids}
+    cached = cache.get_many(list(keys))
+    result = {keys[key]: value for key, value in cached.items()}
+    missing = [author_id for author_id in keys.values() if author_id not in result]
+    if missing:
+        shards = aliases()
+        found = {
+            user_id: (alias, moving)
+            for user_id, alias, moving in ShardAssignment.objects.filter(user_id__in=missing)
+            .values_list('user_id', 'alias', 'moving')
+        }
+        loaded = {author_id: found.get(author_id, (shards[author_id % len(shards)], False)) for author_id in missing}
+        cache.set_many({_assignment_key(author_id): value for author_id, value in loaded.items()}, cache_timeout())
+        result.update(loaded)
+    return result
+
+
+def for_author(author_id):
+    """作者のpostを置くシャード。シャーディングしていなければNone (ルータに任せる)"""
+    if not enabled():
+        return None
+    return _assignments([author_id])[author_id][0]
+
+
+def for_write(author_id):
+    """作者のpostとLikeに書き込むシャード。移している最中なら ShardMoving"""
+    if not enabled():
+        return None
+    alias, moving = _assignments([author_id])[author_id]
+    if moving:
+        raise ShardMoving(author_id)
+    return alias
+
+
+def atomic(alias):
+    """シャードのトランザクション。alias が None (シャーディングしていない) なら何もしない"""
+    return transaction.atomic(using=alias) if alias else nullcontext()
+
+
+def atomic_for_author(author_id):
+    return atomic(for_author(author_id))
+
+
+def next_post_id():
+    """シャードをまたいで一意なpostのid。シャーディングしていなければNone (各DBの自動採番)"""
+    if not enabled():
+        return None
+    ticket = PostIdTicket.objects.create()
+    PostIdTicket.objects.filter(pk__lt=ticket.pk).delete()
+    return ticket.pk
+
+
+def _post_author_key(post_id):
+    return f'shard:post:{post_id}:author'
+
+
+def post_author(post_id):
+    """postの作者のid。無ければNone"""
+    if not enabled():
+        return Post.objects.filter(pk=post_id).values_list('author_id', flat=True).first()
+    # postの作者は変わらないのでずっとキャッシュしてよい
+    author_id = cache.get(_post_author_key(post_id))
+    if author_id is None:
+        for alias in aliases():
+            author_id = Post.objects.using(alias).filter(pk=post_id).values_list('author_id', flat=True).first()
+            if author_id is not None:
+                cache.set(_post_author_key(post_id), author_id, None)
+                break
+    return author_id
+
+
+def for_post_write(post_id):
+    """Likeなどpostに書き込むシャード。postが無ければ404、作者を移している最中なら ShardMoving"""
+    if not enabled():
+        return None
+    author_id = post_author(post_id)
+    if author_id is None:
+        raise Http404('this post does not exist')
+    return for_write(author_id)
+
+
+def _attach_authors(posts):
+    """シャードからはユーザの表を引けないので、post.author を default から読んで付ける"""
+    users = User.objects.in_bulk({post.author_id for post in posts})
+    for post in posts:
+        post.author = users[post.author_id]
+    return posts
+
+
+def _pick(copies):
+    """移している途中で複数のシャードにあるpostは、割り当て先のものを使う"""
+    result = {}
+    duplicated = []
+    for alias, posts in copies:
+        for pk, post in posts.items():
+            if pk in result:
+                duplicated.append(pk)
+            result.setdefault(pk, []).append((alias, post))
+    if duplicated:
+        assigned = _assignments({result[pk][0][1].author_id for pk in duplicated})
+    chosen = {}
+    for pk, candidates in result.items():
+        if len(candidates) == 1:
+            chosen[pk] = candidates[0][1]
+        else:
+            alias = assigned[candidates[0][1].author_id][0]
+            chosen[pk] = next((post for a, post in candidates if a == alias), candidates[0][1])
+    return chosen
+
+
+def in_bulk(post_ids):
+    """{id: post} (post.author 付き)"""
+    if not enabled():
+        return Post.objects.select_related('author').in_bulk(post_ids)
+    post_ids = list(post_ids)
+    if not post_ids:
+        return {}
+    posts = _pick((alias, Post.objects.using(alias).in_bulk(post_ids)) for alias in aliases())
+    _attach_authors(list(posts.values()))
+    return posts
+
+
+def get_post(pk):
+    """post (post.author 付き)。無ければNone"""
+    if not enabled():
+        return Post.objects.select_related('author').filter(pk=pk).first()
+    return in_bulk([pk]).get(pk)
+
+
+def posts_by_author(author_id):
+    """作者のpostのクエリセット。シャーディング中は評価した後に attach_authors を呼ぶ"""
+    if not enabled():
+        return Post.objects.filter(author_id=author_id).select_related('author')
+    return Post.objects.using(for_author(author_id)).filter(author_id=author_id)
+
+
+def attach_authors(posts):
+    if enabled():
+        _attach_authors(posts)
+    return posts
+
+
+def newest_by_authors(author_ids, before=None, limit=None):
+    """作者たちのpostの (created_at, id) を新しい順に最大limit件。before は絞り込むQ
+
+    シャードごとに (author, created_at, id) インデックスで新しい順に読み、k-way merge する。
+    """
+    if enabled():
+        groups = {}
+        for author_id, (alias, _) in _assignments(author_ids).items():
+            groups.setdefault(alias, []).append(author_id)
+    else:
+        groups = {None: list(author_ids)}
+    streams = []
+    for alias, group in groups.items():
+        posts = Post.objects.using(alias).filter(author__in=group)
+        if before is not None:
+            posts = posts.filter(before)
+        streams.append(list(posts.order_by('-created_at', '-id').values_list('created_at', 'id')[:limit]))
+    if len(streams) == 1:
+        return streams[0]
+    return list(heapq.merge(*streams, reverse=True))[:limit]
+
+
+def liked_post_ids(user_id, post_ids):
+    """post_idsのうちuserがLikeしているもの"""
+    if not enabled():
+        return set(Like.objects.filter(user_id=user_id, post_id__in=post_ids).values_list('post_id', flat=True))
+    post_ids = list(post_ids)
+    if not post_ids:
+        return set()
+    liked = set()
+    for alias in aliases():
+        liked.update(Like.objects.using(alias).filter(user_id=user_id, post_id__in=post_ids).values_list('post_id', flat=True))
+    return liked
+
+
+def like_counts(post_ids):
+    """[(id, like_count)]"""
+    if not enabled():
+        return list(Post.objects.filter(pk__in=post_ids).order_by().values_list('pk', 'like_count'))
+    counts = {}
+    for alias in aliases():
+        counts.update(Post.objects.using(alias).filter(pk__in=post_ids).order_by().values_list('pk', 'like_count'))
+    return list(counts.items())
+
+
+def delete_post(post):
+    """postを消す。シャーディング中は default にある受信箱などの行も消す"""
+    if enabled():
+        for model in (TimelineEntry, SearchTerm, PostHashtag, Mention):
+            model.objects.filter(post_id=post.pk).delete()
+        # user.models は blog.models を参照するので、ここで読み込む
+        from user.models import Notification
+        Notification.objects.filter(post_id=post.pk).delete()
+        cache.delete(_post_author_key(post.pk))
+    post.delete()
+
+
+def unavailable_while_moving(view):
+    """ShardMoving を 503 (Retry-After付き) にするデコレータ"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except ShardMoving:
+            response = HttpResponse('this account is being moved. try again shortly', status=503)
+            response['Retry-After'] = str(RETRY_AFTER)
+            return response
+    return wrapper
+
+
+def _set_assignment(author_id, alias, moving):
+    ShardAssignment.objects.update_or_create(
+        user_id=author_id, defaults={'alias': alias, 'moving': moving, 'updated_at': timezone.now()},
+    )
+    cache.set(_assignment_key(author_id), (alias, moving), cache_timeout())
+
+
+def _fingerprints(alias, post_ids):
+    """{id: (version, like_count, Likeの数, user_idの合計, 最新のLikeの日時)}。写し直しが要るかの比較用"""
+    likes = {
+        row[0]: row[1:]
+        for row in Like.objects.using(alias).filter(post_id__in=post_ids).values('post_id')
+        .annotate(count=Count('id'), users=Sum('user_id'), last=Max('created_at')).order_by()
+        .values_list('post_id', 'count', 'users', 'last')
+    }
+    return {
+        pk: (version, like_count, *likes.get(pk, (0, None, None)))
+        for pk, version, like_count in Post.objects.using(alias).filter(pk__in=post_ids)
+        .values_list('id', 'version', 'like_count')
+    }
+
+
+def _copy_posts(source, target, posts, chunk_size):
+    """postsをLikeごとtargetに写す。targetにある同じidの行は置き換える"""
+    post_ids = [post.pk for post in posts]
+    with transaction.atomic(using=target):
+        Post.objects.using(target).filter(pk__in=post_ids).delete()
+        Post.objects.using(target).bulk_create(posts)
+        likes = Like.objects.using(source).filter(post_id__in=post_ids).order_by('id')
+        last_id = 0
+        while True:
+            chunk = list(likes.filter(id__gt=last_id).values_list('id', 'user_id', 'post_id', 'created_at')[:chunk_size])
+            if not chunk:
+                break
+            # Likeのidはシャードごとの採番なので、移した先で振り直す
+            Like.objects.using(target).bulk_create([
+                Like(user_id=user_id, post_id=post_id, created_at=created_at)
+                for _, user_id, post_id, created_at in chunk
+            ])
+            last_id = chunk[-1][0]
+
+
+def _sync(author_id, source, target, chunk_size, only_changed):
+    """作者のpostをidのキーセットで少しずつ写す。写したpostの数を返す"""
+    posts = Post.objects.using(source).filter(author_id=author_id).order_by('id')
+    copied = 0
+    last_id = 0
+    while True:
+        chunk = list(posts.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1].pk
+        if only_changed:
+            post_ids = [post.pk for post in chunk]
+            before = _fingerprints(source, post_ids)
+            after = _fingerprints(target, post_ids)
+            chunk = [post for post in chunk if before[post.pk] != after.get(post.pk)]
+        if chunk:
+            _copy_posts(source, target, chunk, chunk_size)
+            copied += len(chunk)
+    if only_changed:
+        _delete_missing(author_id, source, target, chunk_size)
+    return copied
+
+
+def _delete_missing(author_id, source, target, chunk_size):
+    """移している間に元のシャードで消されたpostを、写した先からも消す"""
+    ids = Post.objects.using(target).filter(author_id=author_id).order_by('id').values_list('id', flat=True)
+    last_id = 0
+    while True:
+        chunk = list(ids.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1]
+        kept = set(Post.objects.using(source).filter(pk__in=chunk).values_list('id', flat=True))
+        Post.objects.using(target).filter(pk__in=[pk for pk in chunk if pk not in kept]).delete()
+
+
+def move_user(author_id, target, chunk_size=DEFAULT_MOVE_CHUNK_SIZE, grace=None, report=lambda message: None):
+    """作者のpostとLikeをtargetのシャードへ移す。移したpostの数を返す
+
+    1. 書き込みを止めずに全部写す
+    2. 書き込みを止め、変わったpostだけを写し直す
+    3. 割り当てをtargetに切り替えて書き込みを戻し、元のシャードの行を消す
+    割り当てはキャッシュされるので、2と3の前に grace 秒 (既定は POST_SHARD_CACHE_TIMEOUT) 待つ。
+    キャッシュを全プロセスで共有していれば0でよい。
+    """
+    if target not in aliases():
+        raise ValueError(f'{target} is not in POST_SHARDS')
+    source = for_author(author_id)
+    if source == target:
+        return 0
+    if grace is None:
+        grace = cache_timeout()
+    token = db_router.begin_request(True)
+    try:
+        started = time.perf_counter()
+        moved = _sync(author_id, source, target, chunk_size, only_changed=False)
+        report(f'copied {moved} posts from {source} to {target} in {time.perf_counter() - started:.1f}s')
+
+        _set_assignment(author_id, source, moving=True)
+        time.sleep(grace)
+        started = time.perf_counter()
+        changed = _sync(author_id, source, target, chunk_size, only_changed=True)
+        _set_assignment(author_id, target, moving=False)
+        report(f'writes paused for {time.perf_counter() - started:.1f}s to copy {changed} changed posts')
+
+        # 切り替え前の割り当てを覚えているプロセスが読み終わるのを待ってから消す
+        time.sleep(grace)
+        ids = Post.objects.using(source).filter(author_id=author_id).order_by('id').values_list('id', flat=True)
+        deleted = 0
+        while True:
+            chunk = list(ids[:chunk_size])
+            if not chunk:
+                break
+            Post.objects.using(source).filter(pk__in=chunk).delete()
+            deleted += len(chunk)
+        report(f'deleted {deleted} posts from {source}')
+    finally:
+        db_router.end_request(token)
+    return moved
+
+
+class ShardRouter:
+    """Post/Like のインスタンスの読み書きを、そのインスタンスのシャードか作者のシャードへ送る
+
+    インスタンスの無いクエリは、呼び出し側が shards の関数か using() でシャードを指定する。
+    """
+
+    def _route(self, model, hints):
+        if model not in (Post, Like) or not enabled():
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db in aliases():
+            return instance._state.db
+        if isinstance(instance, Post):
+            author_id = instance.author_id
+        elif isinstance(instance, Like):
+            author_id = post_author(instance.post_id)
+        else:
+            return None
+        return None if author_id is None else for_author(author_id)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        alias = self._route(model, hints)
+        if alias is not None:
+            # default に書かなくても、続く読み出しはプライマリに固定する
+            db_router.mark_wrote(model)
+        return alias
@@ -0,0 +1,32 @@
+"""blogのバックグラウンドジョブ (jobs.queue.enqueue で積む)"""
+from django.contrib.auth.models import User
+
+from jobs.queue import job
+
+from . import search, shards, timeline
+from .models import Post
+
+
+@job('timeline.fan_out', concurrency=4)
+def fan_out(post_id):
+    """投稿をフォロワーの受信箱に配る。本人の受信箱には投稿時に入れてある"""
+    post = shards.get_post(post_id)
+    if post is not None:
+        timeline.fan_out_to_followers(post)
+
+
+@job('timeline.backfill_followers', concurrency=4)
+def backfill_followers(author_id):
+    timeline.backfill_followers(User(pk=author_id))
+
+
+@job('timeline.invalidate_readers', concurrency=4)
+def invalidate_readers(post_id, author_id):
+    timeline.invalidate_readers(Post(pk=post_id, author_id=author_id))
+
+
+@job('search.index')
+def index_post(post_id):
+    post = shards.get_post(post_id)
+    if post is not None:
+        search.index_post(post)
@@ -1,10 +1,41 @@
-from django.test import TestCase
+from django.test import AsyncClient, AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
-from .models import Post, Like
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+from .models import ArchivedLike, ArchivedPost, Post, Like, TimelineEntry, Hashtag, PostHashtag, Mention, HashtagBucket, ShardAssignment
+from . import archive, benchmark, cache, counters, entities, explain, live, querybudget, search, shards, timeline, transfer, trending, views
+from user.models import Follow
+from user import counters as follow_counters
+from twitter import db_router, events, metrics
+from twitter.db import insert_ignore
+from jobs import queue
+from jobs.models import Job
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.conf import settings
+from django.db import connections, router
+from django.db.backends.signals import connection_created
+from django.http import Http404
+from django.core.cache import cache as default_cache
+from io import StringIO
+import tempfile
+import asyncio
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
 
 import time
+from datetime import timedelta
 import json
+import threading
+from contextlib import ExitStack
+import os
+
+
+def run_jobs():
+    '''積まれたジョブを実行しきる (run_jobs ワーカーの代わり)'''
+    queue.work(once=True)
 
 
 class CreateTweetTest(TestCase):
@@ -43,11 +74,15 @@ class CreateTweetTest(TestCase):
 class TweetListTest(TestCase):
 
     def setUp(self):
+        default_cache.clear()
         self.user1 = User.objects.create_user('user1', 'example@gmail.com', 'example13046')
         self.user2 = User.objects.create_user('user2', 'example@gmail.com', 'example13046')
         self.user1_tweet = Post.objects.create(content='user1', author=self.user1)
         time.sleep(0.1)
         self.user2_tweet = Post.objects.create(content='user2', author=self.user2)
+        Follow.objects.create(following=self.user1, follower=self.user2)
+        timeline.fan_out(self.user1_tweet)
+        timeline.fan_out(self.user2_tweet)
         self.url = reverse('blog:home')
 
     def test_tweet_list(self):
@@ -64,6 +99,156 @@ class TweetListTest(TestCase):
         self.assertContains(response, self.user2.username)
         self.assertContains(response, self.user2_tweet.content)
 
+    def test_exclude_not_followed_user(self):
+        '''
+        フォローしていないユーザの投稿はタイムラインに出ない
+        '''
+        self.client.login(username='user2', password='example13046')
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context['post_list'], ['<Post: user2>'])
+
+
+@override_settings(TIMELINE_PAGE_SIZE=2)
+class TimelinePaginationTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+        created_at = timezone.now()
+        # 同時刻の投稿もidで順序が決まる
+        self.posts = [
+            Post.objects.create(content=f'tweet{i}', author=self.user, created_at=created_at)
+            for i in range(5)
+        ]
+        for post in self.posts:
+            timeline.fan_out(post)
+
+    def test_home_load_more(self):
+        response = self.client.get(reverse('blog:home'))
+        self.assertQuerysetEqual(response.context['post_list'], ['<Post: tweet4>', '<Post: tweet3>'])
+        cursor = response.context['next_cursor']
+        response = self.client.get(reverse('blog:home'), {'cursor': cursor})
+        self.assertQuerysetEqual(response.context['post_list'], ['<Post: tweet2>', '<Post: tweet1>'])
+
+    def test_json_timeline(self):
+        contents = []
+        cursor = None
+        for _ in range(3):
+            params = {'cursor': cursor} if cursor else {}
+            data = json.loads(self.client.get(reverse('blog:timeline'), params).content)
+            contents += [post['content'] for post in data['posts']]
+            cursor = data['next_cursor']
+        self.assertEqual(contents, ['tweet4', 'tweet3', 'tweet2', 'tweet1', 'tweet0'])
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('blog:timeline'), {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(JOBS_EAGER=False)
+class FanOutTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'example@gmail.com', 'example13046')
+        self.reader = User.objects.create_user('reader', 'example@gmail.com', 'example13046')
+        Follow.objects.create(following=self.reader, follower=self.author)
+        follow_counters.follow_added(self.reader.pk, self.author.pk)
+
+    def _timeline(self, user):
+        return [post.content for post in timeline.home_timeline(user)[0]]
+
+    def test_create_fan_out_to_followers(self):
+        self.client.login(username='author', password='example13046')
+        self.client.post(reverse('blog:create'), {'content': 'hello'})
+        # 本人の受信箱にはすぐ入り、フォロワーにはジョブで配る
+        self.assertEqual(TimelineEntry.objects.count(), 1)
+        run_jobs()
+        self.assertEqual(TimelineEntry.objects.count(), 2)
+        self.assertEqual(self._timeline(self.reader), ['hello'])
+        self.assertEqual(self._timeline(self.author), ['hello'])
+
+    def test_live_event_from_web_process(self):
+        '''新しいpostのイベントは購読者のいるwebのプロセスからコミット後に送り、ワーカーからは送らない'''
+        self.client.login(username='author', password='example13046')
+        with mock.patch('blog.live.publish_post') as publish:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.client.post(reverse('blog:create'), {'content': 'hello'})
+            publish.assert_not_called()
+            for callback in callbacks:
+                callback()
+            publish.assert_called_once()
+            with self.captureOnCommitCallbacks(execute=True):
+                run_jobs()
+        publish.assert_called_once()
+        self.assertEqual(publish.call_args[0][0].content, 'hello')
+
+    def test_delete_retract_entries(self):
+        post = Post.objects.create(content='hello', author=self.author)
+        timeline.fan_out(post)
+        self.client.login(username='author', password='example13046')
+        self.client.post(reverse('blog:delete', kwargs={'pk': post.pk}))
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_unfollow_and_follow(self):
+        post = Post.objects.create(content='hello', author=self.author)
+        timeline.fan_out(post)
+        self.client.login(username='reader', password='example13046')
+        self.client.post(reverse('user:unfollow', kwargs={'username': 'author'}))
+        self.assertEqual(self._timeline(self.reader), [])
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+        run_jobs()
+        self.assertEqual(self._timeline(self.reader), ['hello'])
+
+    @override_settings(TIMELINE_FANOUT_THRESHOLD=0)
+    def test_pull_mode_above_threshold(self):
+        '''
+        フォロワーが閾値を超えると受信箱には書かず、読み出し時に取りに行く
+        '''
+        own = Post.objects.create(content='own', author=self.reader)
+        timeline.fan_out(own)
+        time.sleep(0.1)
+        post = Post.objects.create(content='celebrity', author=self.author)
+        timeline.fan_out(post)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader, post=post).exists())
+        self.assertEqual(self._timeline(self.reader), ['celebrity', 'own'])
+
+    @override_settings(TIMELINE_FANOUT_THRESHOLD=1)
+    def test_back_below_threshold(self):
+        '''
+        フォロワーが閾値を下回っても、pull対象だった間の投稿がフォロワーのホームから消えない
+        '''
+        other = User.objects.create_user('other', 'example@gmail.com', 'example13046')
+        Follow.objects.create(following=other, follower=self.author)
+        follow_counters.follow_added(other.pk, self.author.pk)
+        post = Post.objects.create(content='celebrity', author=self.author)
+        timeline.fan_out(post)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader, post=post).exists())
+        self.client.login(username='other', password='example13046')
+        self.client.post(reverse('user:unfollow', kwargs={'username': 'author'}))
+        self.assertEqual(Job.objects.filter(kind='timeline.backfill_followers').count(), 1)
+        run_jobs()
+        self.assertTrue(TimelineEntry.objects.filter(user=self.reader, post=post).exists())
+        self.assertEqual(self._timeline(self.reader), ['celebrity'])
+        self.assertEqual(self._timeline(other), [])
+
+    @override_settings(TIMELINE_FANOUT_THRESHOLD=1)
+    def test_reconcile_below_threshold(self):
+        '''カウンタの修正で一度に閾値を下回っても配り直す'''
+        others = [User.objects.create_user(f'other{i}', 'example@gmail.com', 'example13046') for i in range(2)]
+        for other in others:
+            Follow.objects.create(following=other, follower=self.author)
+            follow_counters.follow_added(other.pk, self.author.pk)
+        post = Post.objects.create(content='celebrity', author=self.author)
+        timeline.fan_out(post)
+        # カウンタを通さずにまとめて消す
+        Follow.objects.filter(following__in=others).delete()
+        call_command('reconcile_counters', stdout=StringIO())
+        self.assertEqual(Job.objects.filter(kind='timeline.backfill_followers').count(), 1)
+        run_jobs()
+        self.assertEqual(self._timeline(self.reader), ['celebrity'])
+
 
 class DetailTweetTest(TestCase):
 
@@ -159,6 +344,17 @@ class LikeTest(TestCase):
         '''
         response = self.client.post(reverse('blog:like', kwargs={'pk': 100}), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(response.status_code, 404)
+        self.assertFalse(Like.objects.exists())
+
+    def test_like_is_idempotent(self):
+        '''
+        連打しても一意制約でLikeは1行、カウンタも1のまま
+        '''
+        self.assertTrue(insert_ignore(Like, user_id=self.user.pk, post_id=self.post.pk))
+        self.assertFalse(insert_ignore(Like, user_id=self.user.pk, post_id=self.post.pk))
+        self.client.post(self.url)
+        self.client.post(self.url)
+        self.assertEqual(Like.objects.count(), 1)
 
     def test_with_twice_like(self):
         self.client.post(self.url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
@@ -204,3 +400,1039 @@ class UnlikeTest(TestCase):
         '''
         response = self.client.post(reverse('blog:unlike', kwargs={'pk': 100}), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(response.status_code, 404)
+
+
+class LikeCounterTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+        self.post = Post.objects.create(content='counter', author=self.user)
+
+    def test_like_and_unlike_update_counter(self):
+        self.client.post(reverse('blog:like', kwargs={'pk': self.post.pk}))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.client.post(reverse('blog:unlike', kwargs={'pk': self.post.pk}))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+
+    def test_reconcile_counters(self):
+        Like.objects.create(user=self.user, post=self.post)
+        Post.objects.filter(pk=self.post.pk).update(like_count=10)
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertIn('likes: fixed 1 rows', out.getvalue())
+
+
+class LikeStateTest(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+        self.liked = Post.objects.create(content='liked', author=self.user, like_count=1)
+        self.other = Post.objects.create(content='other', author=self.user)
+        Like.objects.create(user=self.user, post=self.liked)
+        self.url = reverse('blog:like_state')
+
+    def test_batch_like_state(self):
+        # ユーザ、Like、カウンタ (セッションはキャッシュから読む)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'ids': f'{self.liked.pk},{self.other.pk},999'})
+        self.assertEqual(json.loads(response.content)['posts'], {
+            str(self.liked.pk): {'liked': True, 'count': 1},
+            str(self.other.pk): {'liked': False, 'count': 0},
+        })
+
+    def test_invalid_ids(self):
+        self.assertEqual(self.client.get(self.url, {'ids': 'a,b'}).status_code, 400)
+        ids = ','.join(str(i) for i in range(101))
+        self.assertEqual(self.client.get(self.url, {'ids': ids}).status_code, 400)
+
+    def test_home_liked_list_only_page_posts(self):
+        timeline.fan_out(self.other)
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual(response.context['liked_list'], set())
+
+
+class CacheTest(TestCase):
+    def setUp(self):
+        default_cache.clear()
+        cache.reset_stats()
+        self.author = User.objects.create_user('author', 'example@gmail.com', 'example13046')
+        self.reader = User.objects.create_user('reader', 'example@gmail.com', 'example13046')
+        self.client.login(username='reader', password='example13046')
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+
+    def _post_as_author(self, content):
+        self.client.login(username='author', password='example13046')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('blog:create'), {'content': content})
+            run_jobs()
+        self.client.login(username='reader', password='example13046')
+
+    def test_fragment_hit_and_miss(self):
+        self._post_as_author('hello')
+        self.client.get(reverse('blog:home'))
+        self.client.get(reverse('blog:home'))
+        stats = cache.get_stats()
+        self.assertEqual(stats['fragment_miss'], 1)
+        self.assertEqual(stats['fragment_hit'], 1)
+        self.assertEqual(stats['timeline_hit'], 1)
+
+    def test_create_invalidates_follower_timeline(self):
+        self._post_as_author('first')
+        self.assertContains(self.client.get(reverse('blog:home')), 'first')
+        self._post_as_author('second')
+        self.assertContains(self.client.get(reverse('blog:home')), 'second')
+
+    def test_version_miss_does_not_overwrite_invalidation(self):
+        '''バージョンが無いと読んだ直後に無効化されても、無効化で置いたバージョンを使う'''
+        default_cache.delete(cache._version_key(self.reader.pk))
+        get = default_cache.get
+        calls = []
+
+        def get_then_invalidate(key, *args, **kwargs):
+            value = get(key, *args, **kwargs)
+            if not calls:
+                with self.captureOnCommitCallbacks(execute=True):
+                    cache.invalidate_timelines([self.reader.pk])
+                calls.append(get(key))
+            return value
+        with mock.patch.object(cache.cache, 'get', side_effect=get_then_invalidate):
+            key = cache.timeline_page_key(self.reader.pk, None)
+        self.assertEqual(key, f'timeline:{self.reader.pk}:{calls[0]}:')
+        self.assertEqual(key, cache.timeline_page_key(self.reader.pk, None))
+
+    def test_update_renders_new_fragment(self):
+        self._post_as_author('before')
+        post = Post.objects.get()
+        self.client.get(reverse('blog:home'))
+        self.client.login(username='author', password='example13046')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('blog:update', kwargs={'pk': post.pk}), {'content': 'after'})
+            run_jobs()
+        post.refresh_from_db()
+        self.assertEqual(post.version, 2)
+        self.client.login(username='reader', password='example13046')
+        response = self.client.get(reverse('blog:home'))
+        self.assertContains(response, 'after')
+        self.assertNotContains(response, 'before')
+
+    def test_like_invalidates_own_timeline(self):
+        self._post_as_author('hello')
+        post = Post.objects.get()
+        self.client.get(reverse('blog:home'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('blog:like', kwargs={'pk': post.pk}))
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual(response.context['post_list'][0].like_count, 1)
+
+    def test_invalidate_after_commit(self):
+        '''コミット前に読んだページが新しいバージョンでキャッシュされないよう、無効化はコミット後に行う'''
+        key = cache.timeline_page_key(self.reader.pk, None)
+        with self.captureOnCommitCallbacks() as callbacks:
+            cache.invalidate_timelines([self.reader.pk])
+        self.assertEqual(cache.timeline_page_key(self.reader.pk, None), key)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.timeline_page_key(self.reader.pk, None), key)
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            caches = {'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': location,
+            }}
+            with self.settings(CACHES=caches):
+                self._post_as_author('file')
+                self.client.get(reverse('blog:home'))
+                self.assertContains(self.client.get(reverse('blog:home')), 'file')
+        self.assertEqual(cache.get_stats()['fragment_hit'], 1)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        # リクエストの外の書き込みでは固定しないので、ログインもレプリカから読む
+        self._replicate(User)
+        self.client.login(username='ytaisei', password='example13046')
+        self._replicate(User, Session)
+
+    def _replicate(self, *models):
+        """プライマリの内容をレプリカへ写す (レプリケーションの代わり)"""
+        for model in models:
+            model.objects.using('replica').all().delete()
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+
+    def test_read_from_replica(self):
+        post = Post.objects.using('default').create(content='not replicated', author=self.user)
+        response = self.client.get(reverse('blog:detail', kwargs={'pk': post.pk}))
+        self.assertEqual(response.status_code, 404)
+        self._replicate(Post)
+        response = self.client.get(reverse('blog:detail', kwargs={'pk': post.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_read_your_writes(self):
+        '''
+        書き込んだ直後はレプリカに無くても自分の投稿が見える
+        '''
+        response = self.client.post(reverse('blog:create'), {'content': 'my tweet'})
+        self.assertIn('primary_pin', response.cookies)
+        self.assertFalse(Post.objects.using('replica').exists())
+        self.assertContains(self.client.get(reverse('blog:home')), 'my tweet')
+        post = Post.objects.using('default').get()
+        response = self.client.get(reverse('blog:detail', kwargs={'pk': post.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_content_writes_pin(self):
+        '''セッションやジョブへの書き込みでは固定せず、リクエストの外では状態を残さない'''
+        token = db_router.begin_request(False)
+        router.db_for_write(Session)
+        router.db_for_write(Job)
+        self.assertEqual(router.db_for_read(Post), 'replica')
+        router.db_for_write(Like)
+        self.assertEqual(router.db_for_read(Post), 'default')
+        self.assertTrue(db_router.end_request(token))
+        router.db_for_write(Post)
+        self.assertEqual(router.db_for_read(Post), 'replica')
+
+    def test_pin_expired(self):
+        self.client.post(reverse('blog:create'), {'content': 'my tweet'})
+        self.client.cookies['primary_pin'] = str(time.time() - 1)
+        post = Post.objects.using('default').get()
+        response = self.client.get(reverse('blog:detail', kwargs={'pk': post.pk}))
+        self.assertEqual(response.status_code, 404)
+
+
+class BenchmarkTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        call_command(
+            'generate_dataset', users=6, posts=20, likes=30, avg_following=3, batch_size=7, stdout=StringIO(),
+        )
+        self.users = list(User.objects.filter(username__startswith='bench'))
+        self.post_ids = list(Post.objects.values_list('id', flat=True))
+
+    def test_generate_dataset(self):
+        '''生成したデータのカウンタと受信箱が実データと一致する'''
+        self.assertEqual(len(self.users), 6)
+        self.assertEqual(len(self.post_ids), 20)
+        for post in Post.objects.all():
+            self.assertEqual(post.like_count, Like.objects.filter(post=post).count())
+        for user in self.users:
+            profile = follow_counters.get_profile(user)
+            self.assertEqual(profile.following_count, Follow.objects.filter(following=user).count())
+            own = TimelineEntry.objects.filter(user=user, author=user).count()
+            self.assertEqual(own, Post.objects.filter(author=user).count())
+
+    def test_run_scenarios(self):
+        '''全シナリオがエラー無しで回り、切り替え系はデータを元に戻す'''
+        likes = set(Like.objects.values_list('user_id', 'post_id'))
+        follows = set(Follow.objects.values_list('following_id', 'follower_id'))
+        for scenario in benchmark.default_scenarios(self.users, self.post_ids):
+            result = benchmark.run_scenario(scenario, self.users, iterations=4)
+            self.assertEqual(result['errors'], 0, result['error_samples'])
+            self.assertGreater(result['queries_per_iteration']['max'], 0)
+        self.assertEqual(set(Like.objects.values_list('user_id', 'post_id')), likes)
+        self.assertEqual(set(Follow.objects.values_list('following_id', 'follower_id')), follows)
+
+    def test_compare_auth(self):
+        '''キャッシュしたセッションとユーザはホームの1リクエストあたりのクエリを減らす'''
+        results = benchmark.compare_auth(self.users, self.post_ids, iterations=4)
+        self.assertEqual(results['db']['errors'] + results['cached']['errors'], 0)
+        saved = results['db']['queries_per_iteration']['mean'] - results['cached']['queries_per_iteration']['mean']
+        self.assertGreaterEqual(saved, 1)
+        out = StringIO()
+        call_command('benchmark', compare_auth=True, iterations=2, output=os.devnull, stdout=out)
+        self.assertIn('cached session/auth saves', out.getvalue())
+
+    def test_percentile(self):
+        self.assertIsNone(benchmark.percentile([], 50))
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(benchmark.percentile([5], 99), 5)
+
+
+class QueryBudgetTest(TestCase):
+
+    def test_every_url_has_case(self):
+        '''blog/user の全URLにクエリ数の測定ケースがある'''
+        covered = {case.name for case in querybudget.CASES}
+        self.assertEqual(querybudget.url_names() - covered, set())
+
+    def test_query_budgets(self):
+        '''クエリ数がデータ量とともに増えず、予算ファイルを超えない'''
+        budgets = querybudget.load_budgets()
+        for case in querybudget.CASES:
+            with self.subTest(case.key):
+                result = querybudget.measure_all([case])[case.key]
+                self.assertEqual(querybudget.check(case.key, result, budgets.get(case.key)), [])
+
+    def test_check_detects_growth(self):
+        result = {'queries': {1: 4, 5: 8}, 'db_time_ms': {1: 0.1, 5: 0.2}}
+        problems = querybudget.check('blog:home GET', result, {'queries': 4})
+        self.assertEqual(len(problems), 2)
+        self.assertIn('grows with result size', problems[0])
+
+
+class IndexAdvisorTest(TestCase):
+
+    def test_views_use_indexes(self):
+        '''全URLのクエリが全件走査もインデックスを使わない並べ替えもしない'''
+        for key, plans in explain.advise(size=1).items():
+            for plan in plans:
+                with self.subTest(key, sql=plan.sql):
+                    self.assertEqual(plan.problems, [], plan.lines)
+
+    def test_detects_problems(self):
+        lines = ['SCAN posts', 'SEARCH auth_user USING INTEGER PRIMARY KEY (rowid=?)', 'USE TEMP B-TREE FOR ORDER BY']
+        self.assertEqual(explain._sqlite_problems(lines), ['full scan of posts', 'sort without index for order by'])
+        self.assertEqual(explain._sqlite_problems(['SCAN post_search VIRTUAL TABLE INDEX 0:M1', 'USE TEMP B-TREE FOR ORDER BY']), [])
+        lines = ['Limit', '  ->  Sort', '        ->  Seq Scan on posts']
+        self.assertEqual(explain._postgres_problems(lines), ['sort without index', 'full scan of posts'])
+
+
+class MetricsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        timeline.fan_out(Post.objects.create(author=cls.user, content='hello'))
+
+    def setUp(self):
+        default_cache.clear()
+        metrics.reset()
+        self.client.login(username='ytaisei', password='example13046')
+
+    def test_records_view_metrics(self):
+        '''view名ごとに処理時間、SQL、テンプレート、キャッシュ、サイズが記録される'''
+        self.client.get(reverse('blog:home'))
+        home = metrics.snapshot()['views']['blog:home']
+        self.assertEqual(home['request_duration_seconds']['count'], 1)
+        self.assertGreater(home['request_sql_queries']['sum'], 0)
+        self.assertGreater(home['request_template_duration_seconds']['sum'], 0)
+        self.assertGreater(home['response_size_bytes']['sum'], 0)
+        counters = {tuple(c['labels']): c['value'] for c in metrics.snapshot()['counters']}
+        self.assertEqual(counters[('blog:home', '200')], 1)
+        self.assertEqual(counters[('blog:home', 'fragment', 'miss')], 1)
+
+    def test_prometheus_and_json(self):
+        self.client.get(reverse('blog:home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('twitter_request_duration_seconds_count{view="blog:home"} 1', text)
+        self.assertIn('twitter_requests_total{view="blog:home",status="200"} 1', text)
+        response = self.client.get(reverse('metrics'), {'format': 'json'})
+        self.assertIn('blog:home', response.json()['views'])
+
+    def test_restricted_to_staff_or_internal_ips(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0)
+    def test_slow_trace(self):
+        '''遅いリクエストはSQL付きでトレースが残る'''
+        self.client.get(reverse('blog:home'))
+        trace = metrics.snapshot()['slow_traces'][-1]
+        self.assertEqual(trace['view'], 'blog:home')
+        self.assertEqual(len(trace['queries']), trace['sql_count'])
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+
+    def _create(self, *contents):
+        posts = [Post.objects.create(author=self.user, content=content) for content in contents]
+        search.index_posts(posts)
+        return posts
+
+    def _search(self, query, **params):
+        response = self.client.get(reverse('blog:search'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def _ids(self, query):
+        return {post['id'] for post in self._search(query)['posts']}
+
+    def _test_search(self):
+        tokyo, kyoto, tower, full_width = self._create(
+            '東京都に行きました', '京都の紅葉', '東京タワーが見える', 'ＤＪＡＮＧＯで作った',
+        )
+        self.assertEqual(self._ids('東京'), {tokyo.pk, tower.pk})
+        self.assertEqual(self._ids('京都'), {tokyo.pk, kyoto.pk})
+        self.assertEqual(self._ids('東京 タワー'), {tower.pk})
+        self.assertEqual(self._ids('django'), {full_width.pk})
+        self.assertEqual(self._ids('紅'), {kyoto.pk})
+        self.assertEqual(self._ids('大阪'), set())
+        self.assertEqual(self._ids('!!'), set())
+
+    def test_search(self):
+        '''bigramで日本語を検索でき、NFKCで全角英数も一致する'''
+        self.assertTrue(search.fts_enabled('default'))
+        self._test_search()
+
+    @override_settings(SEARCH_BACKEND='table')
+    def test_search_table(self):
+        '''FTS5が無いときの索引テーブルでも同じ結果になる'''
+        self._test_search()
+
+    def _test_cursor(self):
+        posts = self._create(*[f'猫 {i}' for i in range(5)])
+        seen = []
+        cursor = ''
+        while True:
+            page = self._search('猫', cursor=cursor) if cursor else self._search('猫')
+            seen += [post['id'] for post in page['posts']]
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertCountEqual(seen, [post.pk for post in posts])
+
+    @override_settings(SEARCH_PAGE_SIZE=2)
+    def test_cursor(self):
+        self._test_cursor()
+
+    @override_settings(SEARCH_PAGE_SIZE=2, SEARCH_BACKEND='table')
+    def test_cursor_table(self):
+        self._test_cursor()
+
+    def test_ranking(self):
+        '''検索語を多く含むpostが先に来る'''
+        once, twice = self._create('猫が好き', '猫猫ねこ猫猫')
+        self.assertEqual([post['id'] for post in self._search('猫猫')['posts']], [twice.pk])
+        self.assertEqual([post['id'] for post in self._search('猫')['posts']], [twice.pk, once.pk])
+
+    def test_views_maintain_index(self):
+        '''作成、更新、削除で索引が更新される'''
+        self.client.post(reverse('blog:create'), {'content': 'りんごを食べた'})
+        run_jobs()
+        post = Post.objects.get()
+        self.assertEqual(self._ids('りんご'), {post.pk})
+        self.client.post(reverse('blog:update', kwargs={'pk': post.pk}), {'content': 'みかんを食べた'})
+        run_jobs()
+        self.assertEqual(self._ids('りんご'), set())
+        self.assertEqual(self._ids('みかん'), {post.pk})
+        self.client.post(reverse('blog:delete', kwargs={'pk': post.pk}))
+        self.assertEqual(self._ids('みかん'), set())
+
+    def test_invalid_query(self):
+        response = self.client.get(reverse('blog:search'), {'q': 'a' * 141})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('blog:search'), {'q': '猫', 'cursor': '!!!'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rebuild_command(self):
+        posts = [Post.objects.create(author=self.user, content=f'犬 {i}') for i in range(5)]
+        out = StringIO()
+        call_command('rebuild_search_index', chunk_size=2, stdout=out)
+        self.assertIn('rebuilt search index for 5 posts', out.getvalue())
+        self.assertEqual(self._ids('犬'), {post.pk for post in posts})
+
+
+class HashtagTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.friend = User.objects.create_user('friend', 'friend@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+
+    def _tags(self, post):
+        return set(PostHashtag.objects.filter(post=post).values_list('hashtag__name', flat=True))
+
+    def test_parse(self):
+        self.assertEqual(entities.parse_hashtags('#Django と ＃東京 a#b #123 #a_b'), {'django', '東京', 'a_b'})
+        self.assertEqual(entities.parse_mentions('@friend と a@b.com @ghost.'), {'friend', 'ghost'})
+
+    def test_create_and_update(self):
+        '''作成・更新時にハッシュタグとメンションを保存し直す'''
+        self.client.post(reverse('blog:create'), {'content': '#python #django @friend @ghost'})
+        post = Post.objects.get()
+        self.assertEqual(self._tags(post), {'python', 'django'})
+        self.assertEqual(list(Mention.objects.values_list('user', flat=True)), [self.friend.pk])
+        self.client.post(reverse('blog:update', kwargs={'pk': post.pk}), {'content': '#python #rust'})
+        self.assertEqual(self._tags(post), {'python', 'rust'})
+        self.assertFalse(Mention.objects.exists())
+        counts = dict(HashtagBucket.objects.values_list('hashtag__name', 'count'))
+        self.assertEqual(counts, {'python': 1, 'django': 1, 'rust': 1})
+
+    def test_trending(self):
+        '''最近多く使われたものが上位になり、古い使用は減衰する'''
+        now = timezone.now()
+        old, new = Hashtag.objects.create(name='old'), Hashtag.objects.create(name='new')
+        for _ in range(3):
+            trending.record([old.pk], now=now - timedelta(minutes=45))
+        for _ in range(2):
+            trending.record([new.pk], now=now)
+        trending.record([old.pk], now=now - timedelta(minutes=120))
+        ranked = trending.compute(now=now)
+        self.assertEqual([tag['name'] for tag in ranked], ['new', 'old'])
+        self.assertEqual(ranked[1]['count'], 3)
+        self.assertEqual(trending.prune(now=now), 1)
+
+    def test_trending_view(self):
+        self.client.post(reverse('blog:create'), {'content': '#python'})
+        response = self.client.get(reverse('blog:trending'))
+        self.assertEqual(response.json()['hashtags'][0]['name'], 'python')
+
+    @override_settings(TIMELINE_PAGE_SIZE=2)
+    def test_hashtag_timeline(self):
+        '''ハッシュタグのpostを新しい順にカーソルで辿れる'''
+        for i in range(5):
+            self.client.post(reverse('blog:create'), {'content': f'{i} #Python'})
+        self.client.post(reverse('blog:create'), {'content': 'other #rust'})
+        url = reverse('blog:hashtag', kwargs={'name': 'PYTHON'})
+        seen = []
+        cursor = None
+        while True:
+            page = self.client.get(url, {'cursor': cursor} if cursor else {}).json()
+            seen += [post['content'] for post in page['posts']]
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, [f'{i} #Python' for i in reversed(range(5))])
+        response = self.client.get(reverse('blog:hashtag', kwargs={'name': 'none'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_rebuild_command(self):
+        post = Post.objects.create(author=self.user, content='#backfill')
+        call_command('rebuild_entities', stdout=StringIO())
+        self.assertEqual(self._tags(post), {'backfill'})
+        self.assertFalse(HashtagBucket.objects.exists())
+
+
+class EventBrokerTest(TestCase):
+
+    async def test_coalesce_and_overflow(self):
+        '''同じkeyは最新の値だけ残り、上限を超えるとresetだけになる'''
+        broker = events.Broker(max_pending=3)
+        subscription = broker.subscribe(['post:1'])
+        broker.publish('post:1', 'like', {'count': 1}, key='like:1')
+        broker.publish('post:1', 'like', {'count': 2}, key='like:1')
+        broker.publish('post:2', 'like', {'count': 5}, key='like:2')
+        self.assertEqual(subscription.drain(), [('like', {'count': 2})])
+        for i in range(4):
+            broker.publish('post:1', 'post', {'id': i})
+        self.assertEqual(subscription.drain(), [('reset', {})])
+        broker.unsubscribe(subscription)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    async def test_file_backend(self):
+        '''ファイル経由で別のブローカー (別ワーカー) の購読者に届く'''
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/events.log'
+            publisher = events.Broker(events.FileBackend(path, poll_interval=0.01))
+            reader = events.Broker(events.FileBackend(path, poll_interval=0.01))
+            subscription = reader.subscribe(['author:1'])
+            publisher.publish('author:1', 'post', {'id': 1, 'content': 'こんにちは'})
+            await asyncio.wait_for(subscription.ready.wait(), 2)
+            self.assertEqual(subscription.drain(), [('post', {'id': 1, 'content': 'こんにちは'})])
+            reader.backend.stop()
+
+
+@mock.patch('blog.live.close_old_connections', lambda: None)
+class LiveStreamTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.author = User.objects.create_user('author', 'author@gmail.com', 'example13046')
+        self.stranger = User.objects.create_user('stranger', 'stranger@gmail.com', 'example13046')
+        Follow.objects.create(following=self.user, follower=self.author)
+        self.post = Post.objects.create(author=self.author, content='hello')
+        self.client.login(username='ytaisei', password='example13046')
+        self.session_key = self.client.cookies['sessionid'].value
+
+    def test_stream_url_only_under_sse(self):
+        '''ストリームのURLは SSE_ENABLED のときだけホームに出す (WSGIでは開かない)'''
+        self.assertNotContains(self.client.get(reverse('blog:home')), 'data-stream-url')
+        with self.settings(SSE_ENABLED=True):
+            response = self.client.get(reverse('blog:home'))
+        self.assertContains(response, f'data-stream-url="{live.STREAM_PATH}"')
+
+    async def _open(self, query, cookie=True):
+        headers = [(b'cookie', f'sessionid={self.session_key}'.encode())] if cookie else []
+        scope = {'type': 'http', 'method': 'GET', 'path': live.STREAM_PATH, 'query_string': query, 'headers': headers}
+        self.messages = []
+        self.read = 0
+        self.received = asyncio.Event()
+        self.disconnected = asyncio.Event()
+
+        async def receive():
+            await self.disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            self.messages.append(message)
+            self.received.set()
+        return asyncio.ensure_future(live.stream_app(scope, receive, send))
+
+    async def _next_body(self):
+        """まだ読んでいない次の本文。届くまで待つ"""
+        while True:
+            while len(self.messages) <= self.read:
+                self.received.clear()
+                await asyncio.wait_for(self.received.wait(), 2)
+            message = self.messages[self.read]
+            self.read += 1
+            if 'body' in message:
+                return message['body'].decode()
+
+    async def test_stream(self):
+        '''フォロー中のユーザの新しいpostと、画面上のpostのLike数が届く'''
+        task = await self._open(f'posts={self.post.pk}'.encode())
+        self.assertIn('retry:', await self._next_body())
+        self.assertEqual(self.messages[0]['status'], 200)
+
+        await sync_to_async(live.publish_post)(self.post)
+        body = await self._next_body()
+        self.assertIn('event: post', body)
+        self.assertIn('"content": "hello"', body)
+
+        await sync_to_async(live.publish_like_count)(self.post.pk, 3)
+        self.assertIn('event: like\ndata: {"id": %d, "count": 3}' % self.post.pk, await self._next_body())
+
+        # フォローしていないユーザのpostは届かない
+        other = await sync_to_async(Post.objects.create)(author=self.stranger, content='other')
+        await sync_to_async(live.publish_post)(other)
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(self.messages), self.read)
+
+        self.disconnected.set()
+        await asyncio.wait_for(task, 2)
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    @override_settings(SSE_HEARTBEAT_SECONDS=0.01)
+    async def test_heartbeat(self):
+        task = await self._open(b'')
+        await self._next_body()
+        self.assertEqual(await self._next_body(), ': ping\n\n')
+        self.disconnected.set()
+        await asyncio.wait_for(task, 2)
+
+    async def test_login_required(self):
+        task = await self._open(b'', cookie=False)
+        await asyncio.wait_for(task, 2)
+        self.assertEqual(self.messages[0]['status'], 403)
+
+    def test_views_publish_after_commit(self):
+        with mock.patch.object(live, 'publish_like_count') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('blog:like', kwargs={'pk': self.post.pk}))
+        publish.assert_called_once_with(self.post.pk, 1)
+
+
+@override_settings(ASYNC_PARALLEL_QUERIES=False)
+class AsyncViewTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.author = User.objects.create_user('author', 'author@gmail.com', 'example13046')
+        Follow.objects.create(following=self.user, follower=self.author)
+        self.post = Post.objects.create(author=self.author, content='hello')
+        timeline.fan_out(self.post)
+        Like.objects.create(user=self.user, post=self.post)
+        self.factory = AsyncRequestFactory()
+
+    def _request(self, path, user=None, method='get'):
+        request = getattr(self.factory, method)(path)
+        request.user = user or self.user
+        return request
+
+    async def test_home_view_matches_sync_view(self):
+        '''非同期版のホームは同期版と同じ内容を描画する'''
+        await sync_to_async(self.client.force_login)(self.user)
+        expected = (await sync_to_async(self.client.get)(reverse('blog:home'))).context
+        response = await views.home_view(self._request(reverse('blog:home')))
+        await sync_to_async(response.render)()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data['post_list'], list(expected['post_list']))
+        self.assertEqual(response.context_data['liked_list'], {self.post.pk})
+        self.assertEqual(response.context_data['following_count'], expected['following_count'])
+        self.assertEqual(response.context_data['follower_count'], expected['follower_count'])
+        self.assertContains(response, 'hello')
+
+    async def test_login_and_method_required(self):
+        response = await views.home_view(self._request(reverse('blog:home'), AnonymousUser()))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(settings.LOGIN_URL))
+        response = await views.home_view(self._request(reverse('blog:home'), method='post'))
+        self.assertEqual(response.status_code, 405)
+
+    async def test_detail_view(self):
+        path = reverse('blog:detail', kwargs={'pk': self.post.pk})
+        response = await views.detail_view(self._request(path), pk=self.post.pk)
+        await sync_to_async(response.render)()
+        self.assertContains(response, 'hello')
+        with self.assertRaises(Http404):
+            await views.detail_view(self._request(path), pk=self.post.pk + 100)
+
+    async def test_metrics_count_queries_in_threads(self):
+        '''sync_to_async で回したクエリも、リクエストのSQLとして数えられる'''
+        metrics.reset()
+        await sync_to_async(self.client.force_login)(self.user)
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        response = await client.get(reverse('blog:home'))
+        self.assertEqual(response.status_code, 200)
+        home = metrics.snapshot()['views']['blog:home']
+        self.assertGreater(home['request_sql_queries']['sum'], 0)
+
+    async def test_pinning_from_thread(self):
+        '''別スレッドで書き込んでもリクエストの読み出しはプライマリに固定される'''
+        token = db_router.begin_request(False)
+        await sync_to_async(router.db_for_write)(Post)
+        self.assertEqual(router.db_for_read(Post), 'default')
+        self.assertTrue(db_router.end_request(token))
+
+
+class AsyncViewParallelTest(TransactionTestCase):
+    '''別スレッドの接続から読むので、コミット済みのデータで確かめる'''
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.author = User.objects.create_user('author', 'author@gmail.com', 'example13046')
+        Follow.objects.create(following=self.user, follower=self.author)
+        self.post = Post.objects.create(author=self.author, content='hello')
+        timeline.fan_out(self.post)
+        Like.objects.create(user=self.user, post=self.post)
+
+    @override_settings(ASYNC_PARALLEL_QUERIES=True)
+    def test_home_view_parallel(self):
+        request = AsyncRequestFactory().get(reverse('blog:home'))
+        request.user = self.user
+        response = async_to_sync(views.home_view)(request)
+        response.render()
+        self.assertEqual(response.context_data['post_list'], [self.post])
+        self.assertEqual(response.context_data['liked_list'], {self.post.pk})
+        self.assertEqual(response.context_data['following_count'], 1)
+
+    def _count_connections(self, conn_max_age):
+        """ホームを5回並列のクエリで開いた間に (開いた接続, 閉じた回数)"""
+        opened = []
+        closed = []
+        close = type(connections['default']).close
+
+        def record(sender, connection, **kwargs):
+            opened.append((threading.get_ident(), connection.alias))
+
+        def record_close(connection):
+            closed.append(connection.alias)
+            return close(connection)
+
+        async def requests():
+            for _ in range(5):
+                request = AsyncRequestFactory().get(reverse('blog:home'))
+                request.user = self.user
+                await views.home_view(request)
+
+        connection_created.connect(record)
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(override_settings(ASYNC_PARALLEL_QUERIES=True))
+                stack.enter_context(mock.patch.object(type(connections['default']), 'close', record_close))
+                for alias in connections:
+                    stack.enter_context(mock.patch.dict(connections.settings[alias], {'CONN_MAX_AGE': conn_max_age}))
+                async_to_sync(requests)()
+        finally:
+            connection_created.disconnect(record)
+        return opened, closed
+
+    def test_parallel_connections_are_reused(self):
+        '''CONN_MAX_AGE があれば、並列のスレッドは接続をリクエストごとに閉じて開き直さない'''
+        opened, closed = self._count_connections(60)
+        self.assertTrue(opened)
+        self.assertEqual(len(opened), len(set(opened)))
+        self.assertEqual(closed, [])
+        # CONN_MAX_AGE = 0 ではリクエストごとに閉じる (インメモリのSQLiteは実際には閉じない)
+        opened, closed = self._count_connections(0)
+        self.assertGreaterEqual(len(closed), 5)
+
+    def test_run_wsgi_and_asgi(self):
+        from twitter.asgi import application as asgi_application
+        from twitter.wsgi import application as wsgi_application
+        users = [self.user, self.author]
+        cookies = benchmark.session_cookies(users)
+        requests = benchmark.server_requests(users, [self.post.pk], 8)
+        result = benchmark.run_wsgi(wsgi_application, requests, cookies, 4)
+        self.assertEqual((result['requests'], result['errors']), (8, 0))
+        result = asyncio.run(benchmark.run_asgi(asgi_application, requests, cookies, 4))
+        self.assertEqual((result['requests'], result['errors']), (8, 0))
+
+
+class TransferTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.alice = User.objects.create_user('alice', 'alice@gmail.com', 'example13046')
+        self.bob = User.objects.create_user('bob', 'bob@gmail.com', 'example13046')
+        self.post = Post.objects.create(author=self.alice, content='hello #django @bob', like_count=1)
+        Like.objects.create(user=self.bob, post=self.post)
+        Follow.objects.create(following=self.bob, follower=self.alice)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = f'{self.tmp.name}/dump.ndjson.gz'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _export(self, **options):
+        err = StringIO()
+        call_command('export_data', self.path, chunk_size=1, progress_every=1, stderr=err, **options)
+        return err.getvalue()
+
+    def test_export(self):
+        '''参照される側から順に1行1レコードで書き出す'''
+        err = self._export()
+        self.assertIn('user: 2 rows in', err)
+        self.assertIn('rows/s', err)
+        with transfer.open_stream(self.path, 'r') as stream:
+            records = [json.loads(line) for line in stream]
+        self.assertEqual([record['model'] for record in records], ['user', 'user', 'post', 'like', 'follow'])
+        self.assertEqual(records[2]['author_id'], self.alice.pk)
+        self.assertEqual(timezone.datetime.fromisoformat(records[2]['created_at']), self.post.created_at)
+
+    def test_round_trip_into_empty_db(self):
+        '''空のDBにはidを変えずに取り込み、カウンタなども作り直す'''
+        self._export()
+        User.objects.all().delete()
+        call_command('import_data', self.path, batch_size=1, stdout=StringIO())
+        post = Post.objects.get()
+        self.assertEqual((post.pk, post.author.username, post.like_count), (self.post.pk, 'alice', 1))
+        self.assertTrue(User.objects.get(username='alice').check_password('example13046'))
+        self.assertTrue(Like.objects.filter(user__username='bob', post=post).exists())
+        self.assertTrue(Follow.objects.filter(following__username='bob', follower__username='alice').exists())
+        self.assertEqual(follow_counters.get_profile(User.objects.get(username='alice')).follower_count, 1)
+        self.assertTrue(Mention.objects.filter(post=post, user__username='bob').exists())
+        self.assertTrue(TimelineEntry.objects.filter(user__username='bob', post=post).exists())
+
+    def test_import_remaps_ids(self):
+        '''既存の行とidがぶつからないようずらし、同じユーザ名のユーザには付け替える'''
+        self._export()
+        carol = User.objects.create_user('carol')
+        with transfer.open_stream(self.path, 'r') as stream:
+            records = [json.loads(line) for line in stream]
+        records[1]['username'] = 'dave'
+        with transfer.open_stream(self.path, 'w') as stream:
+            stream.writelines(json.dumps(record) + '\n' for record in records)
+
+        out = StringIO()
+        call_command('import_data', self.path, skip_derived=True, stdout=out)
+        self.assertIn('imported 1 users, 1 posts, 1 likes, 1 follows', out.getvalue())
+        dave = User.objects.get(username='dave')
+        self.assertEqual(dave.pk, self.bob.pk + carol.pk)
+        copy = Post.objects.exclude(pk=self.post.pk).get()
+        self.assertEqual(copy.author, self.alice)
+        self.assertTrue(Like.objects.filter(user=dave, post=copy).exists())
+        self.assertTrue(Follow.objects.filter(following=dave, follower=self.alice).exists())
+
+    def test_invalid_input(self):
+        with open(self.path[:-3], 'w') as f:
+            f.write(json.dumps({'model': 'post', 'id': 1}) + '\n' + json.dumps({'model': 'user', 'id': 1}) + '\n')
+        with self.assertRaisesMessage(CommandError, 'user records must come before post records'):
+            call_command('import_data', self.path[:-3], skip_derived=True, stdout=StringIO())
+        with open(self.path[:-3], 'w') as f:
+            f.write('{oops\n')
+        with self.assertRaisesMessage(CommandError, 'line 1'):
+            call_command('import_data', self.path[:-3], stdout=StringIO())
+
+
+@override_settings(ARCHIVE_AFTER_DAYS=30, ARCHIVE_BATCH_SIZE=1)
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.fan = User.objects.create_user('fan', 'fan@gmail.com', 'example13046')
+        now = timezone.now()
+        self.old = [
+            Post.objects.create(author=self.user, content=f'old #tag {i}', created_at=now - timedelta(days=40 + i))
+            for i in range(2)
+        ]
+        self.new = Post.objects.create(author=self.user, content='new', created_at=now)
+        for post in self.old + [self.new]:
+            entities.update_entities(post, created=True, notify=False)
+            timeline.fan_out(post)
+            search.index_post(post)
+            Like.objects.create(user=self.fan, post=post)
+            counters.like_added(post.pk)
+        self.client.force_login(self.fan)
+
+    def test_archive_moves_posts_and_likes(self):
+        out = StringIO()
+        call_command('archive_posts', stdout=out)
+        self.assertIn('archived 2 posts', out.getvalue())
+        self.assertEqual(list(Post.objects.all()), [self.new])
+        self.assertEqual(Like.objects.count(), 1)
+        archived = ArchivedPost.objects.get(pk=self.old[0].pk)
+        self.assertEqual((archived.author, archived.content, archived.like_count), (self.user, 'old #tag 0', 1))
+        self.assertEqual(set(ArchivedLike.objects.values_list('post_id', flat=True)), {post.pk for post in self.old})
+        # 受信箱、検索、ハッシュタグからは外れる
+        self.assertFalse(TimelineEntry.objects.filter(post_id__in=[post.pk for post in self.old]).exists())
+        self.assertEqual(search.search('old')[0], [])
+        self.assertFalse(PostHashtag.objects.exclude(post=self.new).exists())
+
+    def test_keeps_newest_id(self):
+        '''最大idのpostは古くても残す'''
+        self.new.delete()
+        self.assertEqual(archive.archive_older_than(archive.cutoff()), 1)
+        self.assertEqual(list(Post.objects.all()), [self.old[1]])
+
+    def test_limit_and_dry_run(self):
+        out = StringIO()
+        call_command('archive_posts', dry_run=True, stdout=out)
+        self.assertIn('2 posts older than', out.getvalue())
+        self.assertEqual(Post.objects.count(), 3)
+        call_command('archive_posts', days=41, stdout=out)
+        self.assertEqual(ArchivedPost.objects.get().pk, self.old[1].pk)
+        self.assertEqual(archive.archive_older_than(archive.cutoff(), limit=5), 1)
+
+    def test_read_through(self):
+        '''アーカイブしたpostも同じURLと投稿履歴から読める'''
+        archive.archive_older_than(archive.cutoff())
+        response = self.client.get(reverse('blog:detail', kwargs={'pk': self.old[0].pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'アーカイブ済み')
+        with self.settings(ASYNC_PARALLEL_QUERIES=False):
+            response = async_to_sync(views.detail_view)(self._async_request(), pk=self.old[0].pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('blog:detail', kwargs={'pk': 0})).status_code, 404)
+        self.assertEqual(self.client.post(reverse('blog:like', kwargs={'pk': self.old[0].pk})).status_code, 404)
+
+        with self.settings(TIMELINE_PAGE_SIZE=2):
+            url = reverse('blog:history', kwargs={'username': 'ytaisei'})
+            first = self.client.get(url).json()
+            second = self.client.get(url, {'cursor': first['next_cursor']}).json()
+        posts = first['posts'] + second['posts']
+        self.assertEqual([post['id'] for post in posts], [self.new.pk, self.old[0].pk, self.old[1].pk])
+        self.assertEqual([post['archived'] for post in posts], [False, True, True])
+        self.assertTrue(all(post['liked'] for post in posts))
+        self.assertIsNone(second['next_cursor'])
+
+    def _async_request(self):
+        request = AsyncRequestFactory().get('/')
+        request.user = self.fan
+        return request
+
+
+@override_settings(POST_SHARDS=['shard0', 'shard1'])
+class ShardTest(TestCase):
+    databases = {'default', 'replica', 'shard0', 'shard1'}
+
+    def setUp(self):
+        default_cache.clear()
+        self.alice = User.objects.create_user('alice', 'alice@gmail.com', 'example13046')
+        self.bob = User.objects.create_user('bob', 'bob@gmail.com', 'example13046')
+        ShardAssignment.objects.create(user=self.alice, alias='shard0')
+        ShardAssignment.objects.create(user=self.bob, alias='shard1')
+        # alice は bob をフォローしている
+        Follow.objects.create(following=self.alice, follower=self.bob)
+        self.client.force_login(self.alice)
+
+    def _post(self, user, content):
+        self.client.force_login(user)
+        self.client.post(reverse('blog:create'), {'content': content})
+        run_jobs()
+        self.client.force_login(self.alice)
+        return Post.objects.using(shards.for_author(user.pk)).get(content=content)
+
+    def test_posts_are_stored_on_author_shard(self):
+        first = self._post(self.alice, 'from alice')
+        second = self._post(self.bob, 'from bob')
+        self.assertEqual(list(Post.objects.using('shard0').values_list('content', flat=True)), ['from alice'])
+        self.assertEqual(list(Post.objects.using('shard1').values_list('content', flat=True)), ['from bob'])
+        self.assertFalse(Post.objects.exists())
+        # idはシャードをまたいで一意
+        self.assertLess(first.pk, second.pk)
+
+    def test_reads_and_likes_across_shards(self):
+        mine = self._post(self.alice, 'from alice')
+        theirs = self._post(self.bob, 'from bob #tag')
+        response = self.client.get(reverse('blog:timeline'))
+        self.assertEqual([post['id'] for post in response.json()['posts']], [theirs.pk, mine.pk])
+
+        response = self.client.post(reverse('blog:like', kwargs={'pk': theirs.pk}))
+        self.assertEqual(response.json(), {'liked': True, 'count': 1})
+        self.assertEqual(Like.objects.using('shard1').get().user, self.alice)
+        self.assertFalse(Like.objects.using('shard0').exists())
+        response = self.client.get(reverse('blog:like_state'), {'ids': f'{mine.pk},{theirs.pk}'})
+        self.assertEqual(response.json()['posts'], {
+            str(mine.pk): {'liked': False, 'count': 0},
+            str(theirs.pk): {'liked': True, 'count': 1},
+        })
+        self.assertEqual(self.client.get(reverse('blog:detail', kwargs={'pk': theirs.pk})).status_code, 200)
+        self.assertEqual(search.search('bob')[0], [Post.objects.using('shard1').get()])
+        response = self.client.get(reverse('blog:hashtag', kwargs={'name': 'tag'}))
+        self.assertEqual([post['id'] for post in response.json()['posts']], [theirs.pk])
+
+        response = self.client.post(reverse('blog:unlike', kwargs={'pk': theirs.pk}))
+        self.assertEqual(response.json(), {'liked': False, 'count': 0})
+        self.assertEqual(self.client.post(reverse('blog:like', kwargs={'pk': 0})).status_code, 404)
+
+    def test_newest_by_authors_merges_shards(self):
+        now = timezone.now()
+        for i in range(4):
+            author = self.alice if i % 2 else self.bob
+            Post.objects.using(shards.for_author(author.pk)).create(
+                id=shards.next_post_id(), author=author, content=str(i), created_at=now - timedelta(minutes=i),
+            )
+        rows = shards.newest_by_authors([self.alice.pk, self.bob.pk], limit=3)
+        self.assertEqual([Post.objects.using('shard0').filter(pk=pk).exists() for _, pk in rows], [False, True, False])
+        self.assertEqual([created_at for created_at, _ in rows], [now - timedelta(minutes=i) for i in range(3)])
+
+    def test_delete_removes_rows_on_default(self):
+        post = self._post(self.alice, 'bye #tag @bob')
+        self.assertTrue(TimelineEntry.objects.filter(post_id=post.pk).exists())
+        self.client.post(reverse('blog:delete', kwargs={'pk': post.pk}))
+        self.assertFalse(Post.objects.using('shard0').exists())
+        for model in (TimelineEntry, PostHashtag, Mention):
+            self.assertFalse(model.objects.filter(post_id=post.pk).exists())
+        self.assertEqual(search.search('bye')[0], [])
+
+    def test_move_user(self):
+        post = self._post(self.alice, 'moving')
+        self.client.force_login(self.bob)
+        self.client.post(reverse('blog:like', kwargs={'pk': post.pk}))
+        out = StringIO()
+        call_command('reshard_user', 'alice', 'shard1', grace=0, stdout=out)
+        self.assertIn('moved 1 posts of alice to shard1', out.getvalue())
+        self.assertEqual(shards.for_author(self.alice.pk), 'shard1')
+        self.assertFalse(Post.objects.using('shard0').exists())
+        self.assertFalse(Like.objects.using('shard0').exists())
+        moved = Post.objects.using('shard1').get(pk=post.pk)
+        self.assertEqual((moved.like_count, Like.objects.using('shard1').get().user), (1, self.bob))
+        # idは変わらないので、同じURLで読めてLikeもできる
+        self.assertEqual(self.client.get(reverse('blog:detail', kwargs={'pk': post.pk})).status_code, 200)
+        response = self.client.post(reverse('blog:unlike', kwargs={'pk': post.pk}))
+        self.assertEqual(response.json(), {'liked': False, 'count': 0})
+
+    def test_writes_wait_while_moving(self):
+        post = self._post(self.alice, 'frozen')
+        ShardAssignment.objects.filter(user=self.alice).update(moving=True)
+        default_cache.clear()
+        response = self.client.post(reverse('blog:create'), {'content': 'blocked'})
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '5'))
+        self.assertEqual(self.client.post(reverse('blog:delete', kwargs={'pk': post.pk})).status_code, 503)
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.post(reverse('blog:like', kwargs={'pk': post.pk})).status_code, 503)
+        # 読むことはできる
+        self.assertEqual(self.client.get(reverse('blog:detail', kwargs={'pk': post.pk})).status_code, 200)
+        self.assertEqual(Post.objects.using('shard0').count(), 1)
+
+    def test_unsharded_commands_refuse(self):
+        with self.assertRaises(CommandError):
+            call_command('reconcile_counters', stdout=StringIO())
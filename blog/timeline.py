@@ -0,0 +1,287 @@
+"""ホームタイムライン
+
+投稿時にフォロワーの受信箱 (TimelineEntry) へ書き込み (fan-out-on-write)、
+読み出しは受信箱の (user, created_at, post) インデックスの範囲スキャンで行う。
+フォロワー数が TIMELINE_FANOUT_THRESHOLD を超えるユーザの投稿は書き込み時に
+配らず、読み出し時に取りに行く (hybrid pull)。フォロワーが減って閾値以下に戻ったら、
+最近の投稿をフォロワーの受信箱へ配り直す。
+"""
+import base64
+import binascii
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+
+from . import cache, shards
+from .models import PostHashtag, TimelineEntry
+from user.models import Follow, Profile
+
+
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_FANOUT_THRESHOLD = 10000
+DEFAULT_FANOUT_BATCH_SIZE = 1000
+DEFAULT_BACKFILL_SIZE = 100
+
+
+def page_size():
+    return getattr(settings, 'TIMELINE_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def fanout_threshold():
+    return getattr(settings, 'TIMELINE_FANOUT_THRESHOLD', DEFAULT_FANOUT_THRESHOLD)
+
+
+def fanout_batch_size():
+    return getattr(settings, 'TIMELINE_FANOUT_BATCH_SIZE', DEFAULT_FANOUT_BATCH_SIZE)
+
+
+def backfill_size():
+    return getattr(settings, 'TIMELINE_BACKFILL_SIZE', DEFAULT_BACKFILL_SIZE)
+
+
+def encode_cursor(created_at, pk):
+    """(created_at, id) を不透明なカーソル文字列にする"""
+    raw = f'{created_at.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """カーソル文字列を (created_at, id) に戻す。不正な値はBadRequest"""
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().split('|')
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest('invalid cursor')
+    if created_at is None:
+        raise BadRequest('invalid cursor')
+    return created_at, pk
+
+
+def before_cursor(cursor, created_at_field='created_at', pk_field='id'):
+    """カーソルより古い行だけを残すQ"""
+    created_at, pk = cursor
+    return (
+        Q(**{f'{created_at_field}__lt': created_at})
+        | Q(**{created_at_field: created_at, f'{pk_field}__lt': pk})
+    )
+
+
+def paginate(queryset, cursor=None, limit=None):
+    """新しい順に1ページ分を返す。戻り値は (rows, next_cursor)"""
+    limit = limit or page_size()
+    if cursor:
+        queryset = queryset.filter(before_cursor(decode_cursor(cursor)))
+    rows = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].pk)
+    return rows, next_cursor
+
+
+def is_pull_author(user_id):
+    """フォロワーが多すぎて書き込み時に配らないユーザか"""
+    return Profile.objects.filter(user_id=user_id, follower_count__gt=fanout_threshold()).exists()
+
+
+def pull_authors(user):
+    """userがフォローしているうち、読み出し時に取りに行くユーザのid"""
+    followees = Follow.objects.filter(following=user).values('follower')
+    return list(
+        Profile.objects
+        .filter(user__in=followees, follower_count__gt=fanout_threshold())
+        .values_list('user_id', flat=True)
+    )
+
+
+def _insert_entries(post, user_ids):
+    entries = [
+        TimelineEntry(user_id=user_id, post=post, author_id=post.author_id, created_at=post.created_at)
+        for user_id in user_ids
+    ]
+    TimelineEntry.objects.bulk_create(entries, ignore_conflicts=True)
+    cache.invalidate_timelines(user_ids)
+
+
+def fan_out(post):
+    """投稿を本人と (pull対象でなければ) 全フォロワーの受信箱に入れる"""
+    add_to_author(post)
+    fan_out_to_followers(post)
+
+
+def add_to_author(post):
+    """本人の受信箱にだけ入れる。投稿した直後に自分のホームに出るよう投稿時に行う"""
+    _insert_entries(post, [post.author_id])
+
+
+def _follower_batches(author_id):
+    """author_idのフォロワーのidを fanout_batch_size 件ずつのリストで返す"""
+    batch_size = fanout_batch_size()
+    followers = (
+        Follow.objects
+        .filter(follower_id=author_id)
+        .values_list('following_id', flat=True)
+        .iterator(chunk_size=batch_size)
+    )
+    batch = []
+    for user_id in followers:
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fan_out_to_followers(post):
+    """pull対象でなければ全フォロワーの受信箱に入れる (timeline.fan_out ジョブ)"""
+    if is_pull_author(post.author_id):
+        return
+    for batch in _follower_batches(post.author_id):
+        _insert_entries(post, batch)
+
+
+def left_pull(before, after):
+    """フォロワー数が before から after に変わってpull対象から外れたか"""
+    return before > fanout_threshold() >= after
+
+
+def backfill_followers(author):
+    """pull対象から外れたユーザの最近の投稿を全フォロワーの受信箱へ入れる (timeline.backfill_followers ジョブ)
+
+    pull対象の間の投稿は受信箱に無いので、入れないと閾値を下回ったときにホームから消える。
+    """
+    if is_pull_author(author.pk):
+        return
+    posts = list(shards.posts_by_author(author.pk).order_by('-created_at', '-id')[:backfill_size()])
+    if not posts:
+        return
+    for batch in _follower_batches(author.pk):
+        TimelineEntry.objects.bulk_create(
+            [
+                TimelineEntry(user_id=user_id, post=post, author=author, created_at=post.created_at)
+                for user_id in batch for post in posts
+            ],
+            ignore_conflicts=True,
+            batch_size=fanout_batch_size(),
+        )
+        cache.invalidate_timelines(batch)
+
+
+def invalidate_readers(post):
+    """postが入っている受信箱の持ち主のキャッシュ済みページを無効化する
+
+    pull対象の投稿は受信箱に無いので、フォロワー側はTTLが切れるまで古いままになる。
+    """
+    batch_size = fanout_batch_size()
+    readers = (
+        TimelineEntry.objects.filter(post=post)
+        .values_list('user_id', flat=True)
+        .iterator(chunk_size=batch_size)
+    )
+    batch = [post.author_id]
+    for user_id in readers:
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            cache.invalidate_timelines(batch)
+            batch = []
+    cache.invalidate_timelines(batch)
+
+
+def retract_post(post):
+    """削除された投稿を全受信箱から取り除く"""
+    invalidate_readers(post)
+    TimelineEntry.objects.filter(post=post).delete()
+    cache.invalidate_post(post)
+
+
+def backfill_follow(user, author):
+    """フォローした直後に相手の最近の投稿を受信箱へ入れる"""
+    if is_pull_author(author.pk):
+        return
+    posts = shards.posts_by_author(author.pk).order_by('-created_at', '-id')[:backfill_size()]
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user=user, post=post, author=author, created_at=post.created_at) for post in posts],
+        ignore_conflicts=True,
+    )
+    cache.invalidate_timelines([user.pk])
+
+
+def retract_follow(user, author):
+    """フォロー解除した相手の投稿を受信箱から取り除く"""
+    TimelineEntry.objects.filter(user=user, author=author).delete()
+    cache.invalidate_timelines([user.pk])
+
+
+def rebuild(user):
+    """受信箱を作り直す。既存データの移行やずれの修復用"""
+    TimelineEntry.objects.filter(user=user).delete()
+    backfill_follow(user, user)
+    for relation in Follow.objects.filter(following=user).select_related('follower'):
+        backfill_follow(user, relation.follower)
+
+
+def home_timeline(user, cursor=None, limit=None):
+    """フォロー中のユーザと自分自身の投稿"""
+    limit = limit or page_size()
+    decoded = decode_cursor(cursor) if cursor else None
+
+    entries = TimelineEntry.objects.filter(user=user)
+    if decoded:
+        entries = entries.filter(before_cursor(decoded, pk_field='post_id'))
+    rows = list(entries.order_by('-created_at', '-post_id').values_list('created_at', 'post_id')[:limit + 1])
+
+    authors = pull_authors(user)
+    if authors:
+        before = before_cursor(decoded) if decoded else None
+        rows += shards.newest_by_authors(authors, before, limit + 1)
+        rows = sorted(set(rows), reverse=True)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*rows[-1])
+    posts = shards.in_bulk([pk for _, pk in rows])
+    return [posts[pk] for _, pk in rows if pk in posts], next_cursor
+
+
+def hashtag_timeline(hashtag, cursor=None, limit=None):
+    """ハッシュタグを含むpostを新しい順に。(hashtag, created_at, post) インデックスの範囲スキャン"""
+    limit = limit or page_size()
+    entries = PostHashtag.objects.filter(hashtag=hashtag)
+    if cursor:
+        entries = entries.filter(before_cursor(decode_cursor(cursor), pk_field='post_id'))
+    rows = list(entries.order_by('-created_at', '-post_id').values_list('created_at', 'post_id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*rows[-1])
+    posts = shards.in_bulk([pk for _, pk in rows])
+    return [posts[pk] for _, pk in rows if pk in posts], next_cursor
+
+
+def cached_home_timeline(user, cursor=None):
+    """home_timeline を短いTTLでキャッシュしたもの"""
+    key = cache.timeline_page_key(user.pk, cursor)
+    page = cache.get_timeline_page(key)
+    if page is None:
+        page = home_timeline(user, cursor)
+        cache.set_timeline_page(key, page)
+    return page
+
+
+def serialize_post(post, liked_ids):
+    return {
+        'id': post.pk,
+        'content': post.content,
+        'author': post.author.username,
+        'created_at': post.created_at.isoformat(),
+        'like_count': post.like_count,
+        'liked': post.pk in liked_ids,
+        'url': reverse('blog:detail', kwargs={'pk': post.pk}),
+    }
@@ -0,0 +1,277 @@
+"""ユーザ、post、Like、フォローのNDJSONでの書き出しと取り込み
+
+1行に1レコード {"model": "post", "id": 1, "author_id": 3, ...} を、参照される側が先に来る
+MODELS の順で並べる。書き出しはidのキーセットでチャンクごとに読み、取り込みは bulk_create を
+バッチごとに行うので、行数によらずメモリは一定で済む。
+
+取り込むidは元のidに「取り込み前のそのテーブルの最大id」を足したものにする (空のDBならidは
+変わらない)。ユーザ名が既にあるユーザは作らず既存のユーザに付け替え、その分だけ IdMap に
+覚える。同じファイルを2回取り込むとpostとLikeは重複する。
+"""
+import gzip
+import io
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from .models import Like, Post
+from user.models import Follow
+
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_PROGRESS_EVERY = 100000
+
+
+class Spec:
+
+    def __init__(self, name, model, fields, references, ignore_conflicts=False):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        # 外部キーの列 -> 参照先の Spec.name
+        self.references = references
+        self.ignore_conflicts = ignore_conflicts
+        self.datetimes = {
+            field for field in fields
+            if model._meta.get_field(field).get_internal_type() == 'DateTimeField'
+        }
+
+
+MODELS = [
+    Spec('user', User, [
+        'username', 'email', 'password', 'first_name', 'last_name',
+        'is_active', 'is_staff', 'is_superuser', 'date_joined', 'last_login',
+    ], {}),
+    Spec('post', Post, ['author_id', 'content', 'created_at', 'like_count', 'version'], {'author_id': 'user'}),
+    Spec('like', Like, ['user_id', 'post_id', 'created_at'], {'user_id': 'user', 'post_id': 'post'},
+         ignore_conflicts=True),
+    Spec('follow', Follow, ['following_id', 'follower_id', 'created_at'],
+         {'following_id': 'user', 'follower_id': 'user'}, ignore_conflicts=True),
+]
+SPECS = {spec.name: spec for spec in MODELS}
+
+
+class TransferError(Exception):
+    pass
+
+
+@contextmanager
+def open_stream(path, mode, compress=None):
+    """テキストのストリームを開く。'-' なら標準入出力、compress が None なら拡張子 .gz で決める"""
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path == '-':
+        raw = sys.stdout.buffer if mode == 'w' else sys.stdin.buffer
+    else:
+        raw = open(path, mode + 'b')
+    binary = gzip.GzipFile(fileobj=raw, mode=mode + 'b', compresslevel=6) if compress else raw
+    stream = io.TextIOWrapper(binary, encoding='utf-8', newline='\n')
+    try:
+        yield stream
+    finally:
+        if mode == 'w':
+            stream.flush()
+        # 標準入出力は閉じない
+        stream.detach()
+        if compress:
+            binary.close()
+        if path == '-':
+            if mode == 'w':
+                raw.flush()
+        else:
+            raw.close()
+
+
+class Progress:
+    """一定行数ごとと最後に件数と1秒あたりの行数を report に渡す"""
+
+    def __init__(self, report, every=DEFAULT_PROGRESS_EVERY):
+        self.report = report
+        self.every = every
+        self.label = None
+
+    def start(self, label):
+        self.label = label
+        self.done = 0
+        self.started = time.perf_counter()
+
+    def add(self, count):
+        before = self.done
+        self.done += count
+        if self.every and before // self.every != self.done // self.every:
+            self._write()
+
+    def finish(self):
+        if self.label is not None:
+            self._write()
+        self.label = None
+
+    def _write(self):
+        elapsed = time.perf_counter() - self.started
+        self.report(f'{self.label}: {self.done} rows in {elapsed:.1f}s ({self.done / max(elapsed, 1e-9):.0f} rows/s)')
+
+
+def _encode(spec, row):
+    record = {'model': spec.name, 'id': row[0]}
+    for field, value in zip(spec.fields, row[1:]):
+        if field in spec.datetimes and value is not None:
+            value = value.isoformat()
+        record[field] = value
+    return record
+
+
+def export(stream, names=None, chunk_size=DEFAULT_CHUNK_SIZE, using=None, progress=None):
+    """names (省略時は全部) のテーブルを stream に書き出す。書き出した行数を名前ごとに返す"""
+    counts = {}
+    for spec in MODELS:
+        if names and spec.name not in names:
+            continue
+        if progress:
+            progress.start(spec.name)
+        rows = spec.model.objects.using(using).order_by('id').values_list('id', *spec.fields)
+        counts[spec.name] = 0
+        last_id = 0
+        while True:
+            chunk = list(rows.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            stream.writelines(
+                json.dumps(_encode(spec, row), ensure_ascii=False, separators=(',', ':')) + '\n' for row in chunk
+            )
+            counts[spec.name] += len(chunk)
+            last_id = chunk[-1][0]
+            if progress:
+                progress.add(len(chunk))
+        if progress:
+            progress.finish()
+    return counts
+
+
+class IdMap:
+    """元のidから取り込み先のidへの対応。大半はoffsetを足すだけで、既存の行に付け替えた分だけ覚える"""
+
+    def __init__(self, offset=0):
+        self.offset = offset
+        self.overrides = {}
+
+    def __getitem__(self, source_id):
+        return self.overrides.get(source_id, source_id + self.offset)
+
+
+class Importer:
+    """feed() にレコードを順に渡し、最後に finish() を呼ぶ"""
+
+    def __init__(self, using, batch_size=DEFAULT_CHUNK_SIZE, progress=None):
+        self.using = using
+        self.batch_size = batch_size
+        self.progress = progress
+        # ファイルに含まれないモデルへの参照はidをそのまま使う
+        self.id_maps = {name: IdMap() for name in SPECS}
+        self.counts = {}
+        self.spec = None
+        self.batch = []
+
+    def feed(self, record):
+        try:
+            spec = SPECS[record['model']]
+        except KeyError:
+            raise TransferError(f"unknown model {record.get('model')!r}")
+        if spec is not self.spec:
+            self._start(spec)
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def finish(self):
+        self._flush()
+        if self.progress:
+            self.progress.finish()
+        self._reset_sequences()
+        return self.counts
+
+    def _start(self, spec):
+        if self.spec is not None and MODELS.index(spec) <= MODELS.index(self.spec):
+            # 参照先より後に来ると、そのidの付け替えが決まっていない
+            raise TransferError(f'{spec.name} records must come before {self.spec.name} records')
+        self._flush()
+        if self.progress:
+            self.progress.finish()
+            self.progress.start(spec.name)
+        self.spec = spec
+        self.counts[spec.name] = 0
+        last_id = spec.model.objects.using(self.using).aggregate(last=Max('id'))['last']
+        self.id_maps[spec.name] = IdMap(last_id or 0)
+
+    def _decode(self, record):
+        spec = self.spec
+        values = {}
+        for field in spec.fields:
+            value = record.get(field)
+            if field in spec.datetimes and value is not None:
+                value = parse_datetime(value)
+            elif field in spec.references:
+                value = self.id_maps[spec.references[field]][value]
+            values[field] = value
+        return spec.model(id=self.id_maps[spec.name][record['id']], **values)
+
+    def _flush(self):
+        if not self.batch:
+            return
+        spec = self.spec
+        records = self.batch
+        self.batch = []
+        with transaction.atomic(using=self.using):
+            if spec.name == 'user':
+                records = self._merge_users(records)
+            spec.model.objects.using(self.using).bulk_create(
+                [self._decode(record) for record in records], ignore_conflicts=spec.ignore_conflicts,
+            )
+        self.counts[spec.name] += len(records)
+        if self.progress:
+            self.progress.add(len(records))
+
+    def _merge_users(self, records):
+        """ユーザ名が既にあるユーザは既存のidに付け替え、作るものだけを返す"""
+        existing = dict(
+            User.objects.using(self.using)
+            .filter(username__in=[record['username'] for record in records])
+            .values_list('username', 'id')
+        )
+        if not existing:
+            return records
+        id_map = self.id_maps['user']
+        for record in records:
+            if record['username'] in existing:
+                id_map.overrides[record['id']] = existing[record['username']]
+        return [record for record in records if record['username'] not in existing]
+
+    def _reset_sequences(self):
+        # idを指定して入れたので、PostgreSQLなどのシーケンスを最大idの後ろに進める
+        models = [SPECS[name].model for name in self.counts]
+        connection = connections[self.using]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+
+def load(stream, using, batch_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """stream のレコードを取り込み、取り込んだ行数を名前ごとに返す"""
+    importer = Importer(using, batch_size, progress)
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise TransferError(f'line {number}: {e}')
+        importer.feed(record)
+    return importer.finish()
@@ -0,0 +1,93 @@
+"""トレンドのハッシュタグ
+
+使用回数を (分, ハッシュタグ) ごとの HashtagBucket に数え、直近 TRENDING_WINDOW_MINUTES 分の
+バケットだけを読んで、古いものほど半減期 TRENDING_HALF_LIFE_MINUTES で減衰させて合計する。
+上位はヒープで取り出し、結果は TRENDING_CACHE_TIMEOUT 秒キャッシュする。
+"""
+import heapq
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Hashtag, HashtagBucket
+
+
+DEFAULT_WINDOW_MINUTES = 60
+DEFAULT_HALF_LIFE_MINUTES = 15
+DEFAULT_CACHE_TIMEOUT = 60
+DEFAULT_SIZE = 10
+
+
+def window_minutes():
+    return getattr(settings, 'TRENDING_WINDOW_MINUTES', DEFAULT_WINDOW_MINUTES)
+
+
+def half_life_minutes():
+    return getattr(settings, 'TRENDING_HALF_LIFE_MINUTES', DEFAULT_HALF_LIFE_MINUTES)
+
+
+def cache_timeout():
+    return getattr(settings, 'TRENDING_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def size():
+    return getattr(settings, 'TRENDING_SIZE', DEFAULT_SIZE)
+
+
+def current_minute(now=None):
+    return (now or timezone.now()).replace(second=0, microsecond=0)
+
+
+def record(hashtag_ids, now=None):
+    """今の分のバケットに1回ずつ足す。タグの数によらず2文で済ませる"""
+    hashtag_ids = list(hashtag_ids)
+    if not hashtag_ids:
+        return
+    minute = current_minute(now)
+    HashtagBucket.objects.bulk_create(
+        [HashtagBucket(hashtag_id=hashtag_id, minute=minute) for hashtag_id in hashtag_ids],
+        ignore_conflicts=True,
+    )
+    HashtagBucket.objects.filter(hashtag_id__in=hashtag_ids, minute=minute).update(count=F('count') + 1)
+
+
+def compute(limit=None, now=None):
+    """窓内のバケットから減衰付きのスコアを出し、上位limit件を返す"""
+    limit = limit or size()
+    now = current_minute(now)
+    buckets = HashtagBucket.objects.filter(minute__gt=now - timedelta(minutes=window_minutes()))
+    scores = defaultdict(float)
+    counts = defaultdict(int)
+    half_life = half_life_minutes()
+    for hashtag_id, minute, count in buckets.values_list('hashtag_id', 'minute', 'count').iterator():
+        age = (now - minute).total_seconds() / 60
+        scores[hashtag_id] += count * 0.5 ** (age / half_life)
+        counts[hashtag_id] += count
+    ranked = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+    names = dict(Hashtag.objects.filter(pk__in=[pk for pk, _ in ranked]).values_list('id', 'name'))
+    return [
+        {'name': names[pk], 'score': round(score, 3), 'count': counts[pk]}
+        for pk, score in ranked if pk in names
+    ]
+
+
+def top(limit=None):
+    """compute() をキャッシュしたもの"""
+    limit = limit or size()
+    key = f'trending:{limit}'
+    result = cache.get(key)
+    if result is None:
+        result = compute(limit)
+        cache.set(key, result, cache_timeout())
+    return result
+
+
+def prune(now=None):
+    """窓から外れたバケットを消す。消した行数を返す"""
+    now = current_minute(now)
+    deleted, _ = HashtagBucket.objects.filter(minute__lte=now - timedelta(minutes=window_minutes())).delete()
+    return deleted
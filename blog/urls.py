@@ -1,13 +1,26 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = 'blog'
 
+# ASGIで動かすときはスレッドに回らない非同期版を使う
+if settings.ASYNC_VIEWS:
+    home_view, detail_view = views.home_view, views.detail_view
+else:
+    home_view, detail_view = views.HomeView.as_view(), views.DetailTweetView.as_view()
+
 urlpatterns = [
-    path('', views.HomeView.as_view(), name="home"),
+    path('', home_view, name="home"),
+    path('timeline/', views.timeline_view, name="timeline"),
+    path('likes/', views.like_state_view, name="like_state"),
+    path('search/', views.search_view, name="search"),
+    path('trending/', views.trending_view, name="trending"),
+    path('hashtag/<str:name>/', views.hashtag_view, name="hashtag"),
+    path('history/<str:username>/', views.history_view, name="history"),
     path('create/', views.CreateTweetView.as_view(), name="create"),
-    path('<int:pk>/', views.DetailTweetView.as_view(), name="detail"),
+    path('<int:pk>/', detail_view, name="detail"),
     path('<int:pk>/update/', views.UpdateTweetView.as_view(), name="update"),
     path('<int:pk>/delete/', views.DeleteTweetView.as_view(), name="delete"),
     path('<int:pk>/like/', views.like_view, name="like"),
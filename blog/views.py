@@ -1,31 +1,147 @@
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.views.generic import CreateView, DetailView, DeleteView, UpdateView, ListView
+from django.views.generic import CreateView, DetailView, DeleteView, UpdateView, TemplateView
 from .forms import PostCreateForm, PostUpdateForm
 from django.urls import reverse_lazy
-from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST
-from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.core.exceptions import BadRequest
+from django.template.response import TemplateResponse
+from django.contrib.auth.models import User
+from django.utils.decorators import method_decorator
+
+
+from .models import Hashtag, Post, Like
+from . import archive, cache, counters, entities, live, search, shards, timeline, trending
+from user import notifications, recommendations
+from user.counters import get_profile
+from user.models import Notification
+from jobs import queue
+from twitter import aio
+from twitter.db import insert_ignore
 
 
-from .models import Post, Like
-from user.models import Follow
+def liked_post_ids(user, post_ids):
+    """post_idsのうちuserがLikeしているもの (ページに出ているpostだけを見る)"""
+    return shards.liked_post_ids(user.pk, post_ids)
 
 
-class HomeView(LoginRequiredMixin, ListView):
-    model = User
+class HomeView(LoginRequiredMixin, TemplateView):
     template_name = "blog/home.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         login_user = self.request.user
-        context['following_count'] = Follow.objects.filter(following=login_user).count()
-        context['follower_count'] = Follow.objects.filter(follower=login_user).count()
-        context['post_list'] = Post.objects.prefetch_related('like_post').select_related('author').all()
-        context['liked_list'] = Like.objects.filter(user=login_user).values_list('post', flat=True)
+        post_list, next_cursor = timeline.cached_home_timeline(login_user, self.request.GET.get('cursor'))
+        cache.attach_fragments(post_list)
+        profile = get_profile(login_user)
+        context['following_count'] = profile.following_count
+        context['follower_count'] = profile.follower_count
+        context['post_list'] = post_list
+        context['next_cursor'] = next_cursor
+        context['liked_list'] = liked_post_ids(login_user, [post.pk for post in post_list])
+        context['recommendations'] = recommendations.for_user(login_user)
+        context['stream_url'] = live.stream_url()
         return context
 
 
+@aio.login_required
+@aio.require_safe
+async def home_view(request):
+    """HomeView の非同期版 (ASYNC_VIEWS)。互いに依存しないクエリを同時に投げる"""
+    login_user = request.user
+    (post_list, next_cursor), profile, recommendation_list = await aio.gather(
+        lambda: timeline.cached_home_timeline(login_user, request.GET.get('cursor')),
+        lambda: get_profile(login_user),
+        lambda: recommendations.for_user(login_user),
+    )
+    # Likeはページに出ているpostだけを見るので、タイムラインの後になる
+    _, liked_list = await aio.gather(
+        lambda: cache.attach_fragments(post_list),
+        lambda: liked_post_ids(login_user, [post.pk for post in post_list]),
+    )
+    context = {
+        'following_count': profile.following_count,
+        'follower_count': profile.follower_count,
+        'post_list': post_list,
+        'next_cursor': next_cursor,
+        'liked_list': liked_list,
+        'recommendations': recommendation_list,
+        'stream_url': live.stream_url(),
+    }
+    return TemplateResponse(request, 'blog/home.html', context)
+
+
+@login_required
+@require_GET
+def timeline_view(request):
+    """ホームタイムラインのJSON版。next_cursorを渡すと続きを返す"""
+    post_list, next_cursor = timeline.cached_home_timeline(request.user, request.GET.get('cursor'))
+    liked_ids = liked_post_ids(request.user, [post.pk for post in post_list])
+    context = {
+        'posts': [timeline.serialize_post(post, liked_ids) for post in post_list],
+        'next_cursor': next_cursor,
+    }
+    return JsonResponse(context)
+
+
+@login_required
+@require_GET
+def search_view(request):
+    """?q= の全文検索。関連度の高い順に返し、next_cursorを渡すと続きを返す"""
+    post_list, next_cursor = search.search(request.GET.get('q', ''), request.GET.get('cursor'))
+    liked_ids = liked_post_ids(request.user, [post.pk for post in post_list])
+    context = {
+        'posts': [timeline.serialize_post(post, liked_ids) for post in post_list],
+        'next_cursor': next_cursor,
+    }
+    return JsonResponse(context)
+
+
+@login_required
+@require_GET
+def trending_view(request):
+    """直近でよく使われているハッシュタグ"""
+    return JsonResponse({'hashtags': trending.top()})
+
+
+@login_required
+@require_GET
+def hashtag_view(request, name):
+    """ハッシュタグを含むpostを新しい順に返す。next_cursorを渡すと続きを返す"""
+    hashtag = get_object_or_404(Hashtag, name=entities.normalize_hashtag(name))
+    post_list, next_cursor = timeline.hashtag_timeline(hashtag, request.GET.get('cursor'))
+    liked_ids = liked_post_ids(request.user, [post.pk for post in post_list])
+    context = {
+        'hashtag': hashtag.name,
+        'posts': [timeline.serialize_post(post, liked_ids) for post in post_list],
+        'next_cursor': next_cursor,
+    }
+    return JsonResponse(context)
+
+
+@login_required
+@require_GET
+def history_view(request, username):
+    """ユーザのpostをアーカイブしたものも含めて新しい順に返す。next_cursorを渡すと続きを返す"""
+    author = get_object_or_404(User, username=username)
+    post_list, next_cursor = archive.history(author, request.GET.get('cursor'))
+    post_ids = [post.pk for post in post_list]
+    liked_ids = liked_post_ids(request.user, post_ids) | archive.liked_post_ids(request.user, post_ids)
+    context = {
+        'posts': [
+            dict(timeline.serialize_post(post, liked_ids), archived=getattr(post, 'archived', False))
+            for post in post_list
+        ],
+        'next_cursor': next_cursor,
+    }
+    return JsonResponse(context)
+
+
+@method_decorator(shards.unavailable_while_moving, name='dispatch')
 class CreateTweetView(LoginRequiredMixin, CreateView):
     """作成"""
     form_class = PostCreateForm
@@ -34,7 +150,18 @@ class CreateTweetView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.author = self.request.user
-        return super().form_valid(form)
+        shards.for_write(self.request.user.pk)
+        form.instance.pk = shards.next_post_id()
+        with transaction.atomic(), shards.atomic_for_author(self.request.user.pk):
+            response = super().form_valid(form)
+            # 本人のホームにはすぐ出し、フォロワーへの配信と索引はジョブに任せる
+            timeline.add_to_author(self.object)
+            queue.enqueue('timeline.fan_out', post_id=self.object.pk)
+            queue.enqueue('search.index', post_id=self.object.pk)
+            # 購読者はwebのプロセスの中にいるので、ワーカーではなくここから送る
+            post = self.object
+            transaction.on_commit(lambda: live.publish_post(post))
+        return response
 
 
 class DetailTweetView(LoginRequiredMixin, DetailView):
@@ -43,7 +170,29 @@ class DetailTweetView(LoginRequiredMixin, DetailView):
     template_name = 'blog/detail.html'
     context_object_name = 'post'
 
+    def get_object(self, queryset=None):
+        # アーカイブしたpostも同じURLで読めるようにする
+        return archive.get_post_or_404(self.kwargs['pk'])
+
+
+@aio.login_required
+@aio.require_safe
+async def detail_view(request, pk):
+    """DetailTweetView の非同期版 (ASYNC_VIEWS)"""
+    post = await aio.run(lambda: archive.get_post_or_404(pk))
+    return TemplateResponse(request, 'blog/detail.html', {'object': post, 'post': post})
+
+
+def _get_own_post(view):
+    """更新・削除するpost。作者のシャードを移している最中なら ShardMoving"""
+    if not hasattr(view, '_post'):
+        view._post = shards.get_post(view.kwargs['pk'])
+        if view._post is None:
+            raise Http404('this post does not exist')
+    return view._post
+
 
+@method_decorator(shards.unavailable_while_moving, name='dispatch')
 class UpdateTweetView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     """更新"""
     model = Post
@@ -51,51 +200,118 @@ class UpdateTweetView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     form_class = PostUpdateForm
     success_url = reverse_lazy('blog:home')
 
+    def get_object(self, queryset=None):
+        return _get_own_post(self)
+
     def test_func(self):
         post = self.get_object()
         return self.request.user == post.author
 
+    def form_valid(self, form):
+        shards.for_write(self.object.author_id)
+        # versionが変わるので描画済みの断片は参照されなくなる
+        cache.invalidate_post(self.object)
+        form.instance.version = F('version') + 1
+        with transaction.atomic(), shards.atomic_for_author(self.object.author_id):
+            response = super().form_valid(form)
+            queue.enqueue('timeline.invalidate_readers', post_id=self.object.pk, author_id=self.object.author_id)
+            queue.enqueue('search.index', post_id=self.object.pk)
+        return response
+
 
+@method_decorator(shards.unavailable_while_moving, name='dispatch')
 class DeleteTweetView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     """削除"""
     model = Post
     success_url = reverse_lazy('blog:home')
     template_name = 'blog/delete.html'
 
+    def get_object(self, queryset=None):
+        return _get_own_post(self)
+
     def test_func(self):
         post = self.get_object()
         return self.request.user == post.author
 
+    def delete(self, request, *args, **kwargs):
+        self.object = post = self.get_object()
+        shards.for_write(post.author_id)
+        success_url = self.get_success_url()
+        with transaction.atomic(), shards.atomic_for_author(post.author_id):
+            timeline.retract_post(post)
+            search.remove_post(post)
+            shards.delete_post(post)
+        return HttpResponseRedirect(success_url)
+
+
+MAX_LIKE_STATE_IDS = 100
+
 
 @login_required
-@require_POST
-def like_view(request, pk):
+@require_GET
+def like_state_view(request):
+    """?ids=1,2,3 のpostについて、自分がLikeしているかとLike数をまとめて返す"""
+    try:
+        post_ids = {int(pk) for pk in request.GET.get('ids', '').split(',') if pk}
+    except ValueError:
+        raise BadRequest('ids must be comma separated integers')
+    if len(post_ids) > MAX_LIKE_STATE_IDS:
+        raise BadRequest(f'at most {MAX_LIKE_STATE_IDS} ids')
+    liked_ids = liked_post_ids(request.user, post_ids)
+    counts = shards.like_counts(post_ids)
+    context = {
+        'posts': {
+            pk: {'liked': pk in liked_ids, 'count': count}
+            for pk, count in counts
+        }
+    }
+    return JsonResponse(context)
+
+
+def _like_count_or_404(pk, using=None):
     try:
-        post = Post.objects.get(pk=pk)
+        return counters.like_count(pk, using=using)
     except Post.DoesNotExist:
         raise Http404('this post does not exist')
-    like = Like.objects.filter(post=post, user=request.user)
-    if not like:
-        Like.objects.create(post=post, user=request.user)
+
+
+@shards.unavailable_while_moving
+@login_required
+@require_POST
+def like_view(request, pk):
+    # Likeはpostと同じシャードに置く
+    alias = shards.for_post_write(pk)
+    with transaction.atomic(), shards.atomic(alias):
+        if insert_ignore(Like, using=alias, post_id=pk, user_id=request.user.pk):
+            if not counters.like_added(pk, using=alias):
+                # 存在しないpostへのLikeはロールバックする
+                raise Http404('this post does not exist')
+            notifications.schedule(Notification.LIKE, pk)
+            # キャッシュ済みのタイムラインページにはLike数が入っている
+            cache.invalidate_timelines([request.user.pk])
+        count = _like_count_or_404(pk, using=alias)
+        transaction.on_commit(lambda: live.publish_like_count(pk, count))
     context = {
         'liked': True,
-        'count': post.like_post.count()
+        'count': count
     }
     return JsonResponse(context)
 
 
+@shards.unavailable_while_moving
 @login_required
 @require_POST
 def unlike_view(request, pk):
-    try:
-        post = Post.objects.get(pk=pk)
-    except Post.DoesNotExist:
-        raise Http404('this post does not exist')
-    like = Like.objects.filter(post=post, user=request.user)
-    if like:
-        like.delete()
+    alias = shards.for_post_write(pk)
+    with transaction.atomic(), shards.atomic(alias):
+        deleted, _ = Like.objects.using(alias).filter(post_id=pk, user=request.user).delete()
+        if deleted:
+            counters.like_removed(pk, using=alias)
+            cache.invalidate_timelines([request.user.pk])
+        count = _like_count_or_404(pk, using=alias)
+        transaction.on_commit(lambda: live.publish_like_count(pk, count))
     context = {
         'liked': False,
-        'count': post.like_post.count()
+        'count': count
     }
     return JsonResponse(context)
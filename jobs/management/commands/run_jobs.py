@@ -0,0 +1,47 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from jobs import queue
+from twitter import db_router
+
+
+class Command(BaseCommand):
+    help = 'バックグラウンドジョブのワーカー。並列に動かすときはプロセスを複数起動する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='1回に取り出す件数 (既定は JOBS_BATCH_SIZE)')
+        parser.add_argument('--kind', action='append', help='実行するジョブの種類 (複数指定可)')
+        parser.add_argument('--poll-interval', type=float, help='ジョブが無いときに待つ秒数')
+        parser.add_argument('--once', action='store_true', help='実行できるジョブが無くなったら終了する')
+        parser.add_argument('--requeue-dead', action='store_true', help='dead のジョブを積み直して終了する')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            count = queue.requeue_dead(options['kind'])
+            self.stdout.write(f'requeued {count} dead jobs')
+            return
+
+        stopping = []
+
+        def stop(signum, frame):
+            # 実行中のバッチを終えてから止まる
+            stopping.append(signum)
+        previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+        # ジョブは直前の書き込みを読むのでレプリカを使わない
+        token = db_router.begin_request(True)
+        try:
+            succeeded, failed = queue.work(
+                batch_size=options['batch_size'],
+                kinds=options['kind'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+                should_stop=lambda: bool(stopping),
+            )
+        finally:
+            db_router.end_request(token)
+            # call_command で呼ばれたときに、呼んだプロセスのハンドラを置き換えたままにしない
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+        self.stdout.write(f'{succeeded} succeeded, {failed} failed')
@@ -0,0 +1,222 @@
+"""DBを使うジョブキュー
+
+リクエストでは enqueue() で Job の行を積むだけにし、run_jobs コマンドのワーカーが取り出して実行する。
+enqueue はリクエストのトランザクションに入るので、ロールバックしたリクエストのジョブは残らない。
+
+- 取り出しは SELECT ... FOR UPDATE SKIP LOCKED が使えればそれで、使えなければ (SQLite)
+  queued のままの行だけを条件付きUPDATEで running にして取り合いを防ぐ。
+- 失敗したジョブは指数バックオフで再実行し、max_attempts 回失敗したら dead にして残す。
+- job(concurrency=N) の種類は、全ワーカー合わせて running がN件を超えないように取り出す。
+  (行ロックまではしないので、ワーカー同士が同時に取り出すと一時的に超えることがある)
+- ロックしたまま JOBS_LOCK_TIMEOUT 秒経った running の行は、ワーカーが落ちたとみなして積み直す。
+"""
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_LOCK_TIMEOUT = 300
+DEFAULT_RETRY_BASE_SECONDS = 5
+DEFAULT_RETRY_MAX_SECONDS = 3600
+# last_error に残すトレースバックの最大文字数
+ERROR_LIMIT = 5000
+
+_registry = {}
+
+
+class UnknownJob(Exception):
+    pass
+
+
+class Handler:
+
+    def __init__(self, kind, func, concurrency, max_attempts):
+        self.kind = kind
+        self.func = func
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+
+def job(kind, concurrency=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """関数をジョブとして登録するデコレータ。引数はJSONにできるキーワード引数で渡す"""
+    def register(func):
+        _registry[kind] = Handler(kind, func, concurrency, max_attempts)
+        return func
+    return register
+
+
+def get_handler(kind):
+    try:
+        return _registry[kind]
+    except KeyError:
+        raise UnknownJob(kind)
+
+
+def concurrency(kind):
+    """kindの同時実行数の上限。JOBS_CONCURRENCY で上書きできる。Noneなら無制限"""
+    overrides = getattr(settings, 'JOBS_CONCURRENCY', {})
+    if kind in overrides:
+        return overrides[kind]
+    handler = _registry.get(kind)
+    return handler.concurrency if handler else None
+
+
+def eager():
+    return getattr(settings, 'JOBS_EAGER', False)
+
+
+def lock_timeout():
+    return timedelta(seconds=getattr(settings, 'JOBS_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT))
+
+
+def retry_delay(attempts):
+    """attempts回目の失敗の後、次に実行するまでの秒数"""
+    base = getattr(settings, 'JOBS_RETRY_BASE_SECONDS', DEFAULT_RETRY_BASE_SECONDS)
+    limit = getattr(settings, 'JOBS_RETRY_MAX_SECONDS', DEFAULT_RETRY_MAX_SECONDS)
+    return min(base * 2 ** (attempts - 1), limit)
+
+
+def _alias():
+    return router.db_for_write(Job)
+
+
+def enqueue(kind, delay=None, **payload):
+    """ジョブを積む。JOBS_EAGER ならその場で実行する (開発・テスト用)"""
+    handler = get_handler(kind)
+    if eager():
+        handler.func(**payload)
+        return None
+    run_at = timezone.now()
+    if delay:
+        run_at += timedelta(seconds=delay)
+    return Job.objects.using(_alias()).create(
+        kind=kind, payload=payload, run_at=run_at, max_attempts=handler.max_attempts,
+    )
+
+
+def requeue_stale(now=None):
+    """ロックが古い running を積み直す。試行回数を使い切っていれば dead にする"""
+    now = now or timezone.now()
+    stale = Job.objects.using(_alias()).filter(status=Job.RUNNING, locked_at__lt=now - lock_timeout())
+    dead = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.DEAD, locked_by='', locked_at=None, last_error='lock timeout',
+    )
+    requeued = stale.update(status=Job.QUEUED, locked_by='', locked_at=None)
+    return requeued + dead
+
+
+def claim(worker, limit=None, kinds=None, now=None):
+    """実行できるジョブを最大limit件 running にして返す"""
+    limit = limit or getattr(settings, 'JOBS_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    now = now or timezone.now()
+    alias = _alias()
+    jobs = Job.objects.using(alias)
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    with transaction.atomic(using=alias):
+        running = dict(
+            jobs.filter(status=Job.RUNNING).values_list('kind').annotate(count=Count('id')).order_by()
+        )
+        full = [kind for kind, count in running.items() if concurrency(kind) is not None and count >= concurrency(kind)]
+        ready = jobs.filter(status=Job.QUEUED, run_at__lte=now).exclude(kind__in=full)
+        if kinds:
+            ready = ready.filter(kind__in=kinds)
+        if connections[alias].features.has_select_for_update_skip_locked:
+            ready = ready.select_for_update(skip_locked=True)
+        # 上限のある種類を飛ばしても limit 件集まるよう多めに読む
+        candidates = ready.order_by('run_at', 'id').values_list('id', 'kind')[:limit * 4]
+        chosen = []
+        taken = Counter()
+        for pk, kind in candidates:
+            cap = concurrency(kind)
+            if cap is not None and running.get(kind, 0) + taken[kind] >= cap:
+                continue
+            chosen.append(pk)
+            taken[kind] += 1
+            if len(chosen) >= limit:
+                break
+        # SKIP LOCKED が無くても、他のワーカーが先に取った行は status の条件で外れる
+        jobs.filter(pk__in=chosen, status=Job.QUEUED).update(
+            status=Job.RUNNING, locked_by=token, locked_at=now, attempts=F('attempts') + 1,
+        )
+    return list(jobs.filter(locked_by=token, status=Job.RUNNING).order_by('run_at', 'id'))
+
+
+def _fail(job, error):
+    jobs = Job.objects.using(_alias()).filter(pk=job.pk, locked_by=job.locked_by)
+    if job.attempts >= job.max_attempts:
+        jobs.update(status=Job.DEAD, locked_by='', locked_at=None, last_error=error)
+        logger.error('job %s gave up after %d attempts', job, job.attempts)
+        return
+    run_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+    jobs.update(status=Job.QUEUED, locked_by='', locked_at=None, run_at=run_at, last_error=error)
+
+
+def run_job(job):
+    """取り出したジョブを1件実行する。成功したらTrue"""
+    try:
+        handler = get_handler(job.kind)
+        # 途中で失敗したジョブの書き込みは残さない
+        with transaction.atomic(using=_alias()):
+            handler.func(**job.payload)
+    except Exception:
+        logger.warning('job %s failed', job, exc_info=True)
+        _fail(job, traceback.format_exc()[-ERROR_LIMIT:])
+        return False
+    Job.objects.using(_alias()).filter(pk=job.pk, locked_by=job.locked_by).delete()
+    return True
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def work(worker=None, batch_size=None, kinds=None, poll_interval=None, once=False, should_stop=lambda: False):
+    """ジョブを取り出して実行し続ける。once=True なら実行できるジョブが無くなったら戻る
+
+    戻り値は (成功数, 失敗数)。
+    """
+    worker = worker or worker_name()
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'JOBS_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    succeeded = failed = 0
+    while not should_stop():
+        requeue_stale()
+        jobs = claim(worker, batch_size, kinds)
+        for job in jobs:
+            if run_job(job):
+                succeeded += 1
+            else:
+                failed += 1
+        # トランザクションの中から呼ばれたとき (テストなど) は接続を閉じない
+        if not connections[_alias()].in_atomic_block:
+            close_old_connections()
+        if not jobs:
+            if once:
+                break
+            time.sleep(poll_interval)
+    return succeeded, failed
+
+
+def requeue_dead(kinds=None):
+    """dead のジョブを試行回数を戻して積み直す"""
+    dead = Job.objects.using(_alias()).filter(status=Job.DEAD)
+    if kinds:
+        dead = dead.filter(kind__in=kinds)
+    return dead.update(status=Job.QUEUED, attempts=0, run_at=timezone.now(), last_error='')
@@ -0,0 +1,167 @@
+import signal
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import queue
+from .models import Job
+from blog.models import Post, TimelineEntry
+from user.models import Follow
+
+
+calls = []
+
+
+@queue.job('test.record')
+def record(value):
+    calls.append(value)
+
+
+@queue.job('test.fail', max_attempts=2)
+def fail():
+    User.objects.create_user('rolled-back')
+    raise ValueError('boom')
+
+
+@queue.job('test.limited', concurrency=1)
+def limited():
+    pass
+
+
+@override_settings(JOBS_EAGER=False)
+class QueueTest(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_enqueue_and_work(self):
+        queue.enqueue('test.record', value=1)
+        queue.enqueue('test.record', value=2)
+        self.assertEqual(queue.work(once=True), (2, 0))
+        self.assertEqual(calls, [1, 2])
+        self.assertFalse(Job.objects.exists())
+
+    def test_enqueue_rolls_back_with_request(self):
+        '''リクエストがロールバックしたらジョブも残らない'''
+        try:
+            with transaction.atomic():
+                queue.enqueue('test.record', value=1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(Job.objects.exists())
+
+    def test_unknown_kind(self):
+        with self.assertRaises(queue.UnknownJob):
+            queue.enqueue('test.unknown')
+
+    def test_delay(self):
+        queue.enqueue('test.record', delay=60, value=1)
+        self.assertEqual(queue.claim('w'), [])
+        self.assertEqual(len(queue.claim('w', now=timezone.now() + timedelta(seconds=61))), 1)
+
+    @override_settings(JOBS_RETRY_BASE_SECONDS=10)
+    def test_retry_then_dead(self):
+        '''失敗したら書き込みを戻してバックオフ後に再実行し、max_attempts 回で dead にする'''
+        queue.enqueue('test.fail')
+        self.assertEqual(queue.work(once=True), (0, 1))
+        self.assertFalse(User.objects.filter(username='rolled-back').exists())
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('boom', job.last_error)
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=9))
+
+        [job] = queue.claim('w', now=job.run_at)
+        self.assertFalse(queue.run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 2))
+        self.assertEqual(queue.work(once=True), (0, 0))
+
+        out = StringIO()
+        call_command('run_jobs', requeue_dead=True, stdout=out)
+        self.assertIn('requeued 1 dead jobs', out.getvalue())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 0))
+
+    def test_claim_is_exclusive(self):
+        for value in range(3):
+            queue.enqueue('test.record', value=value)
+        first = queue.claim('a', limit=2)
+        second = queue.claim('b', limit=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+
+    def test_concurrency_limit(self):
+        '''種類ごとの上限を超えて running にしない'''
+        queue.enqueue('test.limited')
+        queue.enqueue('test.limited')
+        queue.enqueue('test.record', value=1)
+        claimed = queue.claim('a', limit=10)
+        self.assertEqual(sorted(job.kind for job in claimed), ['test.limited', 'test.record'])
+        self.assertEqual(queue.claim('b', limit=10), [])
+        with self.settings(JOBS_CONCURRENCY={'test.limited': 2}):
+            self.assertEqual(len(queue.claim('b', limit=10)), 1)
+
+    @override_settings(JOBS_LOCK_TIMEOUT=60)
+    def test_requeue_stale(self):
+        '''ワーカーが落ちてロックが古くなったジョブは積み直す'''
+        queue.enqueue('test.record', value=1)
+        queue.claim('crashed')
+        self.assertEqual(queue.requeue_stale(), 0)
+        self.assertEqual(queue.requeue_stale(now=timezone.now() + timedelta(seconds=61)), 1)
+        self.assertEqual(queue.work(once=True), (1, 0))
+
+    @override_settings(JOBS_EAGER=True)
+    def test_eager(self):
+        self.assertIsNone(queue.enqueue('test.record', value=1))
+        self.assertEqual(calls, [1])
+        self.assertFalse(Job.objects.exists())
+
+    def test_command(self):
+        queue.enqueue('test.record', value=1)
+        out = StringIO()
+        call_command('run_jobs', once=True, stdout=out)
+        self.assertIn('1 succeeded, 0 failed', out.getvalue())
+        self.assertEqual(calls, [1])
+
+    def test_command_restores_signal_handlers(self):
+        '''call_command で呼んだプロセスのシグナルハンドラを元に戻す'''
+        handlers = [signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)]
+        call_command('run_jobs', once=True, stdout=StringIO())
+        self.assertEqual([signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)], handlers)
+
+
+@override_settings(JOBS_EAGER=False)
+class ViewJobsTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'example@gmail.com', 'example13046')
+        self.reader = User.objects.create_user('reader', 'example@gmail.com', 'example13046')
+
+    def test_views_only_enqueue(self):
+        '''リクエストではジョブを積むだけで、フォロワーへの配信はワーカーが行う'''
+        self.client.login(username='reader', password='example13046')
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+        self.client.login(username='author', password='example13046')
+        self.client.post(reverse('blog:create'), {'content': 'hello'})
+        kinds = sorted(Job.objects.values_list('kind', flat=True))
+        self.assertEqual(kinds, ['search.index', 'timeline.backfill_follow', 'timeline.fan_out'])
+        post = Post.objects.get()
+        self.assertEqual(list(TimelineEntry.objects.values_list('user', flat=True)), [self.author.pk])
+        queue.work(once=True)
+        self.assertTrue(TimelineEntry.objects.filter(user=self.reader, post=post).exists())
+
+    def test_backfill_skips_unfollowed(self):
+        Post.objects.create(author=self.author, content='hello')
+        self.client.login(username='reader', password='example13046')
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+        Follow.objects.all().delete()
+        queue.work(once=True)
+        self.assertFalse(TimelineEntry.objects.exists())
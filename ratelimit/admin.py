@@ -0,0 +1,4 @@
+from django.contrib import admin
+from ratelimit.models import Counter
+
+admin.site.register(Counter)
@@ -0,0 +1,164 @@
+"""回数制限のカウンタの置き場所
+
+どのバックエンドも整数のカウンタに incr / get / set / touch を持つ。incr はアトミックで、
+期限 (ttl秒) は作ったときに決まり、incr では延びない。set は期限を置き直し、touch は値を
+変えずに期限だけを置き直す。
+
+- local: プロセス内の辞書。プロセスごとに別々に数える (開発用、単一プロセス用)
+- cache: Djangoのキャッシュ (RATELIMIT_CACHE_ALIAS)。memcached / Redis なら全プロセスで共有する
+- db: Counter の表。UPDATE ... SET value = value + n で増やす
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Counter
+from twitter.db import insert_ignore
+
+
+DEFAULT_CACHE_ALIAS = 'default'
+# local でこれより多くのキーを持ったら期限切れのものを捨てる
+LOCAL_MAX_KEYS = 100000
+
+
+class LocalBackend:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (value, 期限の time.monotonic())
+        self._values = {}
+
+    def incr(self, key, delta, ttl):
+        now = time.monotonic()
+        with self._lock:
+            value, expires = self._values.get(key, (0, 0))
+            if expires <= now:
+                value, expires = 0, now + ttl
+                if len(self._values) >= LOCAL_MAX_KEYS:
+                    self._prune(now)
+            value += delta
+            self._values[key] = (value, expires)
+            return value
+
+    def get(self, key):
+        value, expires = self._values.get(key, (0, 0))
+        return value if expires > time.monotonic() else 0
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl)
+
+    def touch(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            value, expires = self._values.get(key, (0, 0))
+            if expires > now:
+                self._values[key] = (value, now + ttl)
+
+    def _prune(self, now):
+        for key in [key for key, (_, expires) in self._values.items() if expires <= now]:
+            del self._values[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class CacheBackend:
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'RATELIMIT_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def incr(self, key, delta, ttl):
+        cache = self.cache
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            # まだ無いか期限切れ。同時に作られたらそちらに足す
+            if cache.add(key, delta, ttl):
+                return delta
+            return cache.incr(key, delta)
+
+    def get(self, key):
+        return self.cache.get(key, 0)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def touch(self, key, ttl):
+        self.cache.touch(key, ttl)
+
+
+class DatabaseBackend:
+
+    def _alias(self):
+        # ルータを通すと数えただけのリクエストもプライマリに固定されるので、直接プライマリに書く
+        return DEFAULT_DB_ALIAS
+
+    def incr(self, key, delta, ttl):
+        alias = self._alias()
+        now = timezone.now()
+        counters = Counter.objects.using(alias).filter(key=key, expires_at__gt=now)
+        # UPDATE の行ロックを SELECT まで持ち、他のリクエストの分が混ざらない値を返す
+        with transaction.atomic(using=alias):
+            if not counters.update(value=F('value') + delta):
+                Counter.objects.using(alias).filter(key=key, expires_at__lte=now).delete()
+                expires_at = now + timedelta(seconds=ttl)
+                if insert_ignore(Counter, using=alias, key=key, value=delta, expires_at=expires_at):
+                    return delta
+                counters.update(value=F('value') + delta)
+            return counters.values_list('value', flat=True).get()
+
+    def get(self, key):
+        value = (
+            Counter.objects.using(self._alias()).filter(key=key, expires_at__gt=timezone.now())
+            .values_list('value', flat=True).first()
+        )
+        return value or 0
+
+    def set(self, key, value, ttl):
+        alias = self._alias()
+        expires_at = timezone.now() + timedelta(seconds=ttl)
+        if not Counter.objects.using(alias).filter(key=key).update(value=value, expires_at=expires_at):
+            if not insert_ignore(Counter, using=alias, key=key, value=value, expires_at=expires_at):
+                Counter.objects.using(alias).filter(key=key).update(value=value, expires_at=expires_at)
+
+    def touch(self, key, ttl):
+        now = timezone.now()
+        Counter.objects.using(self._alias()).filter(key=key, expires_at__gt=now).update(
+            expires_at=now + timedelta(seconds=ttl),
+        )
+
+    def prune(self, now=None):
+        """期限切れの行を消し、消した行数を返す"""
+        deleted, _ = Counter.objects.using(self._alias()).filter(expires_at__lte=now or timezone.now()).delete()
+        return deleted
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'cache': CacheBackend,
+    'db': DatabaseBackend,
+}
+_instances = {}
+
+
+def get_backend(name=None):
+    """RATELIMIT_BACKEND のバックエンド。local の値がプロセス内で続くよう、名前ごとに1つ作って使い回す"""
+    name = name or getattr(settings, 'RATELIMIT_BACKEND', 'cache')
+    if name not in _instances:
+        try:
+            _instances[name] = BACKENDS[name]()
+        except KeyError:
+            raise ValueError(f'unknown RATELIMIT_BACKEND {name!r} (choose from {", ".join(BACKENDS)})')
+    return _instances[name]
@@ -0,0 +1,185 @@
+"""書き込みの回数制限
+
+規則は RATELIMIT_RULES に名前ごとに書く。
+
+    'like': {
+        'views': ['blog:like', 'blog:unlike'],  # RateLimitMiddleware でかけるview名
+        'methods': ['POST'],                    # 省略すると全メソッド
+        'algorithm': 'token_bucket',            # または 'sliding_window'
+        'rate': '120/m',                        # 回数/期間 (s, m, h, d。'100/15m' のように倍数も書ける)
+        'burst': 30,                            # token_bucket で続けて使える回数 (省略すると rate の回数)
+        'key': 'user',                          # 'user' (未ログインならIP) か 'ip'
+    }
+
+- token_bucket は GCRA で、1つのカウンタに「次に空く時刻」(マイクロ秒) を持つ。incr で1回分
+  進めて、進めすぎていたら戻すので、混み合っているときも取り合いにならない。
+- sliding_window は今の窓と1つ前の窓の2つのカウンタから、直近の期間の回数を
+  前の窓の残り割合で重み付けして見積もる。
+
+超えたリクエストには 429 と Retry-After を返し、metrics の ratelimit_rejected_total に数える。
+"""
+import math
+import re
+import time
+from collections import namedtuple
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .backends import get_backend
+from twitter import metrics
+
+
+TOKEN_BUCKET = 'token_bucket'
+SLIDING_WINDOW = 'sliding_window'
+KEY_USER = 'user'
+KEY_IP = 'ip'
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+DEFAULT_IP_META = 'REMOTE_ADDR'
+
+_RATE = re.compile(r'^(\d+)/(\d*)([smhd])$')
+
+# remaining はこのリクエストの後に使える回数、retry_after は次に使えるまでの秒数
+Decision = namedtuple('Decision', 'allowed remaining retry_after')
+
+
+def parse_rate(rate):
+    """'10/m' -> (10, 60.0)"""
+    match = _RATE.match(rate.strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f'invalid rate {rate!r} (expected e.g. "10/m" or "100/15m")')
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * UNITS[unit]
+
+
+class Rule:
+
+    def __init__(self, name, rate, algorithm=TOKEN_BUCKET, burst=None, key=KEY_USER, methods=None, views=()):
+        if algorithm not in (TOKEN_BUCKET, SLIDING_WINDOW):
+            raise ValueError(f'unknown algorithm {algorithm!r}')
+        if key not in (KEY_USER, KEY_IP):
+            raise ValueError(f'unknown key {key!r}')
+        self.name = name
+        self.count, self.period = parse_rate(rate)
+        self.algorithm = algorithm
+        self.burst = burst or self.count
+        self.key = key
+        self.methods = {method.upper() for method in methods} if methods else None
+        self.views = tuple(views)
+
+    def applies_to(self, request):
+        return self.methods is None or request.method in self.methods
+
+
+def enabled():
+    return getattr(settings, 'RATELIMIT_ENABLED', True)
+
+
+_parsed = (None, {})
+
+
+def rules():
+    """{名前: Rule}。RATELIMIT_RULES が変わったときだけ読み直す"""
+    global _parsed
+    source = getattr(settings, 'RATELIMIT_RULES', {})
+    if _parsed[0] is not source:
+        _parsed = (source, {name: Rule(name, **options) for name, options in source.items()})
+    return _parsed[1]
+
+
+def client_ip(request):
+    """RATELIMIT_IP_META のヘッダから。X-Forwarded-For なら最後のプロキシが見た末尾のアドレスを使う"""
+    value = request.META.get(getattr(settings, 'RATELIMIT_IP_META', DEFAULT_IP_META), '')
+    return value.rsplit(',', 1)[-1].strip() or 'unknown'
+
+
+def _identity(request, rule):
+    user = getattr(request, 'user', None)
+    if rule.key == KEY_USER and user is not None and user.is_authenticated:
+        return f'u{user.pk}'
+    return f'ip{client_ip(request)}'
+
+
+def _now():
+    return int(time.time() * 1000000)
+
+
+def token_bucket(backend, key, count, period, burst, now=None):
+    now = _now() if now is None else now
+    interval = int(period * 1000000 / count)
+    capacity = burst * interval
+    ttl = math.ceil((capacity + interval) / 1000000) + 1
+    tat = backend.incr(key, interval, ttl)
+    if tat - interval < now:
+        # しばらく使われずバケットが満タン。同時に来た分は数え落とすが、どれも通してよい
+        backend.set(key, now + interval, ttl)
+        return Decision(True, burst - 1, 0)
+    if tat - now <= capacity:
+        # 期限は作ったときから数えるので、使われ続けている間は延ばす (切れると満タンに戻ってしまう)
+        backend.touch(key, ttl)
+        return Decision(True, (now + capacity - tat) // interval, 0)
+    backend.incr(key, -interval, ttl)
+    return Decision(False, 0, (tat - capacity - now) / 1000000)
+
+
+def sliding_window(backend, key, count, period, now=None):
+    now = _now() if now is None else now
+    window = int(period * 1000000)
+    index, offset = divmod(now, window)
+    elapsed = offset / window
+    ttl = math.ceil(period * 2) + 1
+    current_key = f'{key}:{index}'
+    current = backend.incr(current_key, 1, ttl)
+    previous = backend.get(f'{key}:{index - 1}')
+    estimate = previous * (1 - elapsed) + current
+    if estimate <= count:
+        return Decision(True, int(count - estimate), 0)
+    # 超えた分は数えない
+    backend.incr(current_key, -1, ttl)
+    if current > count or not previous:
+        retry_after = 1 - elapsed
+    else:
+        # 前の窓の重みが (count - current) / previous まで下がるのを待つ
+        retry_after = max(0, 1 - (count - current) / previous - elapsed)
+    return Decision(False, 0, retry_after * period)
+
+
+def check(request, rule, backend=None):
+    backend = backend or get_backend()
+    key = f'ratelimit:{rule.name}:{_identity(request, rule)}'
+    if rule.algorithm == TOKEN_BUCKET:
+        return token_bucket(backend, key, rule.count, rule.period, rule.burst)
+    return sliding_window(backend, key, rule.count, rule.period)
+
+
+def enforce(request, rule):
+    """ruleを超えていれば429のレスポンス、超えていなければNone"""
+    if not rule.applies_to(request):
+        return None
+    decision = check(request, rule)
+    if decision.allowed:
+        return None
+    metrics.increment('ratelimit_rejected_total', rule.name)
+    response = HttpResponse('too many requests. try again later', status=429)
+    response['Retry-After'] = str(max(1, math.ceil(decision.retry_after)))
+    return response
+
+
+def ratelimit(name=None, **options):
+    """viewに回数制限をかけるデコレータ
+
+    name で RATELIMIT_RULES の規則を使うか、Rule の引数 (rate, algorithm, ...) をその場で書く。
+    """
+    inline = Rule(name or 'inline', **options) if options else None
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if enabled():
+                response = enforce(request, inline or rules()[name])
+                if response is not None:
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
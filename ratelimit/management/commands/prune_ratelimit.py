@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from ratelimit.backends import DatabaseBackend
+
+
+class Command(BaseCommand):
+    help = "RATELIMIT_BACKEND = 'db' のときに期限切れのカウンタを消す (cronで定期的に実行する)"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'deleted {DatabaseBackend().prune()} counters')
@@ -0,0 +1,27 @@
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import limiter
+from twitter.middleware import SyncAndAsyncMiddleware
+
+
+class RateLimitMiddleware(SyncAndAsyncMiddleware):
+    """RATELIMIT_RULES の views に書いたview名へのリクエストに回数制限をかける
+
+    request.user を使うので AuthenticationMiddleware より後に置く。
+    """
+
+    def __init__(self, get_response):
+        if not limiter.enabled():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None:
+            return None
+        for rule in limiter.rules().values():
+            if match.view_name in rule.views:
+                response = limiter.enforce(request, rule)
+                if response is not None:
+                    return response
+        return None
@@ -0,0 +1,14 @@
+from django.db import models
+
+
+class Counter(models.Model):
+    """RATELIMIT_BACKEND = 'db' のときのカウンタ。期限切れの行は prune_ratelimit コマンドで消す"""
+    key = models.CharField(max_length=200, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key}={self.value}"
+
+    class Meta:
+        db_table = 'ratelimit_counter'
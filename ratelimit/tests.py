@@ -0,0 +1,189 @@
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache as default_cache
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import limiter
+from .backends import CacheBackend, DatabaseBackend, LocalBackend
+from .models import Counter
+from blog.models import Post
+from twitter import metrics
+
+
+SECOND = 1000000
+
+
+class BackendTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+
+    def check_backend(self, backend):
+        self.assertEqual(backend.get('a'), 0)
+        self.assertEqual(backend.incr('a', 5, 60), 5)
+        self.assertEqual(backend.incr('a', -2, 60), 3)
+        self.assertEqual(backend.get('a'), 3)
+        backend.set('a', 10, 60)
+        self.assertEqual(backend.incr('a', 1, 60), 11)
+        backend.touch('a', 60)
+        self.assertEqual(backend.get('a'), 11)
+        self.assertEqual(backend.get('b'), 0)
+
+    def test_local(self):
+        self.check_backend(LocalBackend())
+
+    def test_cache(self):
+        self.check_backend(CacheBackend())
+
+    def test_db(self):
+        self.check_backend(DatabaseBackend())
+        self.assertEqual(Counter.objects.get(key='a').value, 11)
+
+    def test_local_expires(self):
+        backend = LocalBackend()
+        backend.incr('a', 5, 60)
+        with mock.patch('ratelimit.backends.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(backend.get('a'), 0)
+            self.assertEqual(backend.incr('a', 1, 60), 1)
+
+    def test_db_expires_and_prune(self):
+        '''期限切れの行は数え直し、prune_ratelimit で消える'''
+        backend = DatabaseBackend()
+        backend.incr('a', 5, 60)
+        backend.incr('b', 5, 60)
+        Counter.objects.filter(key='a').update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(backend.get('a'), 0)
+        self.assertEqual(backend.incr('a', 1, 60), 1)
+        Counter.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('prune_ratelimit', stdout=out)
+        self.assertIn('deleted 2 counters', out.getvalue())
+        self.assertFalse(Counter.objects.exists())
+
+
+class AlgorithmTest(TestCase):
+
+    def setUp(self):
+        self.backend = LocalBackend()
+
+    def test_token_bucket_burst_and_refill(self):
+        '''burst回まで続けて通り、その後は1回分たまるのを待つ'''
+        now = 1000 * SECOND
+        # 10/m (6秒に1回)、burst 3
+        decisions = [limiter.token_bucket(self.backend, 'k', 10, 60, 3, now) for _ in range(4)]
+        self.assertEqual([d.allowed for d in decisions], [True, True, True, False])
+        self.assertEqual([d.remaining for d in decisions[:3]], [2, 1, 0])
+        self.assertAlmostEqual(decisions[3].retry_after, 6)
+        # 拒否した分は数えないので、6秒後には1回通る
+        self.assertTrue(limiter.token_bucket(self.backend, 'k', 10, 60, 3, now + 6 * SECOND).allowed)
+        self.assertFalse(limiter.token_bucket(self.backend, 'k', 10, 60, 3, now + 6 * SECOND).allowed)
+        # 十分待てば満タンに戻る
+        decision = limiter.token_bucket(self.backend, 'k', 10, 60, 3, now + 60 * SECOND)
+        self.assertEqual(decision.remaining, 2)
+
+    def test_token_bucket_saturated_past_ttl(self):
+        '''使われ続けているバケットは期限を過ぎても満タンに戻らない'''
+        start = time.monotonic()
+        allowed = 0
+        # 120/m、burst 30 に10回/秒で60秒
+        for i in range(600):
+            with mock.patch('ratelimit.backends.time.monotonic', return_value=start + i / 10):
+                allowed += limiter.token_bucket(self.backend, 'k', 120, 60, 30, 1000 * SECOND + i * SECOND // 10).allowed
+        self.assertLessEqual(allowed, 30 + 120 + 1)
+
+    def test_sliding_window(self):
+        now = 1000 * 60 * SECOND
+        decisions = [limiter.sliding_window(self.backend, 'k', 3, 60, now) for _ in range(4)]
+        self.assertEqual([d.allowed for d in decisions], [True, True, True, False])
+        self.assertAlmostEqual(decisions[3].retry_after, 60)
+        # 次の窓の半ばでは前の窓の3回が1.5回に数えられる
+        half = now + 90 * SECOND
+        self.assertTrue(limiter.sliding_window(self.backend, 'k', 3, 60, half).allowed)
+        decision = limiter.sliding_window(self.backend, 'k', 3, 60, half)
+        self.assertFalse(decision.allowed)
+        self.assertAlmostEqual(decision.retry_after, 10)
+        self.assertTrue(limiter.sliding_window(self.backend, 'k', 3, 60, half + 10 * SECOND).allowed)
+
+    def test_parse_rate(self):
+        self.assertEqual(limiter.parse_rate('10/m'), (10, 60))
+        self.assertEqual(limiter.parse_rate('100/15m'), (100, 900))
+        with self.assertRaises(ValueError):
+            limiter.parse_rate('10 per minute')
+
+
+@override_settings(RATELIMIT_RULES={
+    'like': {'views': ['blog:like'], 'algorithm': 'token_bucket', 'rate': '2/m'},
+})
+class MiddlewareTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        metrics.reset()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+        self.post = Post.objects.create(content='hello', author=self.user)
+
+    def test_rejects_over_limit(self):
+        url = reverse('blog:like', kwargs={'pk': self.post.pk})
+        self.assertEqual(self.client.post(url).status_code, 200)
+        self.assertEqual(self.client.post(url).status_code, 200)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertIn('twitter_ratelimit_rejected_total{rule="like"} 1', metrics.render_prometheus())
+        # ほかのユーザは別に数える
+        User.objects.create_user('other', 'other@gmail.com', 'example13046')
+        self.client.login(username='other', password='example13046')
+        self.assertEqual(self.client.post(url).status_code, 200)
+
+    def test_other_views_are_not_limited(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get(reverse('blog:home')).status_code, 200)
+
+
+class DecoratorTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.factory = RequestFactory()
+
+    def test_ip_key(self):
+        @limiter.ratelimit(name='test', rate='1/m', algorithm='sliding_window', key='ip')
+        def view(request):
+            return HttpResponse('ok')
+        self.assertEqual(view(self.factory.post('/', REMOTE_ADDR='10.0.0.1')).status_code, 200)
+        self.assertEqual(view(self.factory.post('/', REMOTE_ADDR='10.0.0.1')).status_code, 429)
+        self.assertEqual(view(self.factory.post('/', REMOTE_ADDR='10.0.0.2')).status_code, 200)
+
+    @override_settings(RATELIMIT_IP_META='HTTP_X_FORWARDED_FOR')
+    def test_forwarded_for_uses_last_address(self):
+        request = self.factory.post('/', HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.3')
+        self.assertEqual(limiter.client_ip(request), '10.0.0.3')
+
+    @override_settings(RATELIMIT_RULES={'named': {'rate': '1/m', 'methods': ['POST']}})
+    def test_named_rule_and_methods(self):
+        @limiter.ratelimit('named')
+        def view(request):
+            return HttpResponse('ok')
+        for _ in range(2):
+            self.assertEqual(view(self.factory.get('/')).status_code, 200)
+        self.assertEqual(view(self.factory.post('/')).status_code, 200)
+        self.assertEqual(view(self.factory.post('/')).status_code, 429)
+
+    def test_check_is_fast(self):
+        '''1回のチェックは1ミリ秒よりずっと短い (CI の揺れを見込んで緩めに見る)'''
+        rule = limiter.Rule('fast', '1000000/s', key='ip')
+        request = self.factory.post('/')
+        backend = LocalBackend()
+        started = time.perf_counter()
+        for _ in range(1000):
+            limiter.check(request, rule, backend)
+        self.assertLess((time.perf_counter() - started) / 1000, 0.001)
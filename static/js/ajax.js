@@ -64,3 +64,63 @@ $("[data-action='like']").on('click', function(event){
     }
     postData()
 });
+
+// 表示中のpostのLike状態と数を1リクエストでまとめて取り直す
+function refreshLikes(){
+    const buttons = $("[data-action='like']");
+    const ids = buttons.map(function(){ return $(this).attr('data-store-id') }).get();
+    if(ids.length === 0){
+        return
+    }
+    fetch('/blog/likes/?ids=' + ids.join(','), {
+        headers: {'X-CSRFToken': csrftoken},
+    }).then(response => {
+        return response.json()
+    }).then(response => {
+        buttons.each(function(){
+            const el = $(this)
+            const state = response.posts[el.attr('data-store-id')]
+            if(!state){
+                return
+            }
+            const split_url = el.attr('data-url').split('/');
+            if(state.liked){
+                el.attr('data-url', el.attr('data-url').replace(split_url[3], 'unlike'));
+                el.children('i').attr('class', "fas fa-lg fa-heart like-red")
+            } else {
+                el.attr('data-url', el.attr('data-url').replace(split_url[3], 'like'));
+                el.children('i').attr('class', "far fa-lg fa-heart")
+            }
+            $(document.getElementsByName("count_" + el.attr('data-store-id'))).text(state.count);
+        })
+    })
+}
+window.addEventListener('pageshow', function(event){
+    // bfcacheから戻ったときは表示が古いので取り直す
+    if(event.persisted){
+        refreshLikes()
+    }
+});
+
+// 新しい投稿とLike数の変化をServer-Sent Eventsで受け取る (ASGIで動かしていて data-stream-url があるときだけ)
+function openStream(){
+    const timeline = document.getElementById('timeline');
+    if(!timeline || !timeline.dataset.streamUrl || !window.EventSource){
+        return
+    }
+    const ids = $("[data-action='like']").map(function(){ return $(this).attr('data-store-id') }).get();
+    const source = new EventSource(timeline.dataset.streamUrl + '?posts=' + ids.join(','));
+    let newPosts = 0;
+    source.addEventListener('post', function(){
+        newPosts += 1;
+        $('#new-posts .count').text(newPosts);
+        $('#new-posts').prop('hidden', false);
+    });
+    source.addEventListener('like', function(event){
+        const data = JSON.parse(event.data);
+        $(document.getElementsByName("count_" + data.id)).text(data.count);
+    });
+    // 取りこぼしたときはまとめて取り直す
+    source.addEventListener('reset', refreshLikes);
+}
+openStream();
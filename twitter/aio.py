@@ -0,0 +1,68 @@
+"""非同期viewの補助
+
+Django 3.2 のORMは同期専用なので、クエリは sync_to_async で回す。
+ASYNC_PARALLEL_QUERIES なら互いに依存しないクエリをそれぞれ別スレッドの接続で同時に投げ、
+そうでなければ同期viewと同じ1本のスレッドで順に投げる。並列にするとスレッドごとに接続を持つので、
+CONN_MAX_AGE で使い回さないとリクエストごとに接続を開き直すことになる。
+"""
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed
+
+
+DEFAULT_PARALLEL_QUERIES = False
+
+
+def parallel_queries():
+    return getattr(settings, 'ASYNC_PARALLEL_QUERIES', DEFAULT_PARALLEL_QUERIES)
+
+
+def _in_own_thread(func):
+    def run():
+        try:
+            return func()
+        finally:
+            # 使い回されるスレッドの接続は CONN_MAX_AGE に従って閉じる
+            close_old_connections()
+    return run
+
+
+async def gather(*funcs):
+    """引数なしの同期関数を実行し、結果を引数の順に返す"""
+    if parallel_queries():
+        return await asyncio.gather(*(
+            sync_to_async(_in_own_thread(func), thread_sensitive=False)() for func in funcs
+        ))
+    return [await sync_to_async(func)() for func in funcs]
+
+
+async def run(func):
+    """引数なしの同期関数を1つ gather と同じスレッドの選び方で実行する"""
+    result, = await gather(func)
+    return result
+
+
+def login_required(view):
+    """django.contrib.auth.decorators.login_required の非同期view版"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # request.user の読み込みはDBを引くのでスレッドで済ませておく
+        if not await run(lambda: request.user.is_authenticated):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def require_safe(view):
+    """GETとHEADだけを受け付ける (TemplateView と同じ)"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+        return await view(request, *args, **kwargs)
+    return wrapper
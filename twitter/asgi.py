@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'twitter.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# アプリの読み込みが終わってから import する
+from blog import live  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """SSEのストリームだけDjangoを通さずに扱う"""
+    if scope['type'] == 'http' and scope['path'] == live.STREAM_PATH:
+        await live.stream_app(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
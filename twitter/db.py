@@ -0,0 +1,32 @@
+"""ORMでは書けないDB操作の小さなヘルパ"""
+from django.db import connections, router
+from django.db.models import AutoField
+
+
+def insert_ignore(model, using=None, **values):
+    """一意制約に当たる行は捨てる1文のINSERT。挿入できたらTrueを返す
+
+    values にはattname (user_id など) で値を渡す。省略したフィールドはデフォルト値になる。
+    using を省略するとルータで決める。
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    ops = connection.ops
+    fields = [
+        field for field in model._meta.concrete_fields
+        if not isinstance(field, AutoField)
+    ]
+    params = []
+    for field in fields:
+        value = values[field.attname] if field.attname in values else field.get_default()
+        params.append(field.get_db_prep_save(value, connection))
+    sql = '%s %s (%s) VALUES (%s) %s' % (
+        ops.insert_statement(ignore_conflicts=True),
+        ops.quote_name(model._meta.db_table),
+        ', '.join(ops.quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+        ops.ignore_conflicts_suffix_sql(ignore_conflicts=True),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount > 0
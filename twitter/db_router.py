@@ -0,0 +1,67 @@
+"""プライマリ/レプリカのDBルータ
+
+書き込みは常にプライマリ (default)、読み出しは DATABASE_REPLICAS からランダムに選ぶ。
+REPLICA_PIN_APPS のモデル (ユーザに見える内容) に書き込んだリクエストの残りと、その後
+REPLICA_PIN_SECONDS の間のリクエストはプライマリから読む (ReplicaPinningMiddleware がcookieで引き継ぐ)。
+セッション、ジョブ、回数制限のカウンタなどの書き込みでは固定しない。
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+DEFAULT_PIN_APPS = ('auth', 'blog', 'user')
+
+# リクエストごとの {'pinned': bool, 'wrote': bool}。sync_to_async で別スレッドから
+# 書き込んでもリクエスト側に伝わるよう、値を差し替えずに中身を書き換える
+_state = ContextVar('primary_state', default=None)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def begin_request(pinned):
+    """リクエスト開始時に状態を設定する。戻り値は end_request に渡す"""
+    return _state.set({'pinned': pinned, 'wrote': False})
+
+
+def end_request(token):
+    """このリクエストで書き込みがあったかを返し、状態を戻す"""
+    wrote = _state.get()['wrote']
+    _state.reset(token)
+    return wrote
+
+
+def pins(model):
+    """modelへの書き込みで読み出しをプライマリに固定するか"""
+    return model._meta.app_label in getattr(settings, 'REPLICA_PIN_APPS', DEFAULT_PIN_APPS)
+
+
+def mark_wrote(model):
+    """書き込んだ後の読み出しはレプリカの遅延に関係なく自分の書き込みを見せる
+
+    リクエストの外 (begin_request していないとき) は何もしない。
+    """
+    state = _state.get()
+    if state is not None and pins(model):
+        state['pinned'] = state['wrote'] = True
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (state and state['pinned']) or not replicas():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        mark_wrote(model)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製なので、どのDBから読んだ行同士でも関連づけてよい
+        return True
@@ -0,0 +1,220 @@
+"""プロセス内のpub/subブローカー
+
+接続ごとの Subscription はトピックの集合と、キーで上書きされる上限付きの未送信イベントを持つ。
+上限を超えたら溜まったイベントを捨てて reset を1つだけ送り、クライアントに取り直させる。
+送信が詰まっている接続の分だけメモリが増えることはない。
+
+バックエンドは EVENTS_BACKEND で選ぶ。
+- local: 同じプロセスの購読者にだけ配る
+- file: EVENTS_FILE に1行1イベントで追記し、各プロセスが末尾を読んで配る
+  (複数ワーカーでイベントを共有するための、Redisなどの代わりの手元用)
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_POLL_INTERVAL = 0.2
+DEFAULT_FILE_MAX_BYTES = 16 * 1024 * 1024
+
+BACKENDS = {
+    'local': 'twitter.events.LocalBackend',
+    'file': 'twitter.events.FileBackend',
+}
+
+RESET = 'reset'
+
+
+class Subscription:
+    """1接続分の購読。イベントはイベントループのスレッドでだけ積む"""
+    __slots__ = ('topics', 'loop', 'pending', 'overflowed', 'ready', 'max_pending')
+
+    def __init__(self, topics, loop, max_pending):
+        self.topics = frozenset(topics)
+        self.loop = loop
+        self.pending = OrderedDict()
+        self.overflowed = False
+        self.ready = asyncio.Event()
+        self.max_pending = max_pending
+
+    def push(self, key, name, data):
+        if self.overflowed:
+            return
+        if key in self.pending:
+            # 同じキー (同じpostのLike数など) は最新の値だけ送る
+            self.pending[key] = (name, data)
+        elif len(self.pending) >= self.max_pending:
+            self.pending.clear()
+            self.overflowed = True
+        else:
+            self.pending[key] = (name, data)
+        self.ready.set()
+
+    def drain(self):
+        """送るイベントの [(name, data)]。溢れていたら reset だけ"""
+        if self.overflowed:
+            events = [(RESET, {})]
+        else:
+            events = list(self.pending.values())
+        self.pending.clear()
+        self.overflowed = False
+        self.ready.clear()
+        return events
+
+
+class Broker:
+
+    def __init__(self, backend=None, max_pending=None):
+        self.max_pending = max_pending or getattr(settings, 'SSE_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        self._topics = {}
+        self._lock = threading.Lock()
+        self.backend = backend or LocalBackend()
+        self.backend.attach(self)
+
+    def subscribe(self, topics):
+        """イベントループの中で呼ぶ"""
+        loop = asyncio.get_running_loop()
+        self.backend.start(loop)
+        subscription = Subscription(topics, loop, self.max_pending)
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._topics.values() for subscription in subscribers})
+
+    def publish(self, topic, name, data, key=None):
+        """どのスレッドからでも呼べる。key (文字列) が同じ未送信イベントは上書きされる"""
+        self.backend.publish(topic, name, data, key)
+
+    def deliver(self, topic, name, data, key=None):
+        """このプロセスの購読者に配る (バックエンドから呼ばれる)"""
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        if not subscribers:
+            return
+        # keyの無いイベントは上書きしない
+        key = key or object()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        for subscription in subscribers:
+            if running is subscription.loop:
+                subscription.push(key, name, data)
+            elif not subscription.loop.is_closed():
+                subscription.loop.call_soon_threadsafe(subscription.push, key, name, data)
+
+
+class LocalBackend:
+    """同じプロセスの購読者にだけ配る"""
+
+    def attach(self, broker):
+        self.broker = broker
+
+    def start(self, loop):
+        pass
+
+    def publish(self, topic, name, data, key):
+        self.broker.deliver(topic, name, data, key)
+
+
+class FileBackend:
+    """ファイルに追記し、各プロセスが末尾を追いかけて配る
+
+    O_APPENDの小さな書き込みは行単位で混ざらないことを前提にする。
+    EVENTS_FILE_MAX_BYTES を超えたら書き手が切り詰め、読み手は先頭から読み直す。
+    """
+
+    def __init__(self, path=None, poll_interval=None):
+        self.path = path or getattr(settings, 'EVENTS_FILE', None) or os.path.join(
+            tempfile.gettempdir(), 'twitter-events.log')
+        self.poll_interval = poll_interval or getattr(settings, 'EVENTS_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        self.max_bytes = getattr(settings, 'EVENTS_FILE_MAX_BYTES', DEFAULT_FILE_MAX_BYTES)
+        self._readers = {}
+
+    def attach(self, broker):
+        self.broker = broker
+
+    def start(self, loop):
+        """ループごとに1つ読み手のタスクを起こす"""
+        reader = self._readers.get(loop)
+        if reader is None or reader.done():
+            try:
+                offset = os.path.getsize(self.path)
+            except FileNotFoundError:
+                offset = 0
+            self._readers[loop] = loop.create_task(self._follow(offset))
+
+    def stop(self):
+        for task in self._readers.values():
+            task.cancel()
+        self._readers.clear()
+
+    def publish(self, topic, name, data, key):
+        line = json.dumps({'topic': topic, 'name': name, 'data': data, 'key': key}, ensure_ascii=False) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size > self.max_bytes:
+                os.ftruncate(fd, 0)
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def _read_from(self, offset):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0, []
+        if size < offset:
+            offset = 0
+        if size == offset:
+            return offset, []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(size - offset)
+        # 書きかけの行は次回に回す
+        end = chunk.rfind(b'\n') + 1
+        return offset + end, chunk[:end].splitlines()
+
+    async def _follow(self, offset):
+        while True:
+            offset, lines = self._read_from(offset)
+            for line in lines:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                self.broker.deliver(event['topic'], event['name'], event['data'], event['key'])
+            await asyncio.sleep(self.poll_interval)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            name = getattr(settings, 'EVENTS_BACKEND', 'local')
+            _broker = Broker(import_string(BACKENDS.get(name, name))())
+        return _broker
@@ -0,0 +1,233 @@
+"""リクエストごとの計測値をview名ごとのヒストグラムに集める
+
+値はプロセス内に持つので、複数ワーカーで動かす場合は各プロセスの /metrics/ を
+それぞれ取得して集約する。
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+DEFAULT_SLOW_REQUEST_MS = 500
+DEFAULT_SLOW_TRACE_LIMIT = 50
+# 遅いリクエストのトレースに残すSQLの最大数
+TRACE_QUERY_LIMIT = 50
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1000, 10000, 100000, 1000000)
+
+HISTOGRAMS = {
+    'request_duration_seconds': TIME_BUCKETS,
+    'request_sql_queries': COUNT_BUCKETS,
+    'request_sql_duration_seconds': TIME_BUCKETS,
+    'request_template_duration_seconds': TIME_BUCKETS,
+    'response_size_bytes': SIZE_BUCKETS,
+}
+
+_current = contextvars.ContextVar('metrics_request', default=None)
+_lock = threading.Lock()
+_histograms = {}
+_counters = Counter()
+_slow_traces = deque(maxlen=DEFAULT_SLOW_TRACE_LIMIT)
+
+
+def slow_request_seconds():
+    return getattr(settings, 'METRICS_SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS) / 1000
+
+
+class Histogram:
+    """Prometheus形式の累積バケット付きヒストグラム"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(上限, 件数)]。最後の上限は '+Inf'"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RequestStats:
+    """1リクエストの間に集めた値。非同期viewでは複数のスレッドからSQLが数えられる"""
+
+    def __init__(self):
+        self._sql_lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.cache = Counter()
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._sql_lock:
+                self.sql_count += 1
+                self.sql_time += elapsed
+                if len(self.queries) < TRACE_QUERY_LIMIT:
+                    self.queries.append({'sql': sql, 'ms': round(elapsed * 1000, 3)})
+
+
+def _execute(execute, sql, params, many, context):
+    """全接続に入れる execute_wrapper。実行中のリクエストがあればそこに数える"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def install(connection):
+    # execute_wrapper() は with を抜けるときに末尾を外すので、先頭に入れる
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _execute)
+
+
+def _connection_created(sender, connection, **kwargs):
+    install(connection)
+
+
+# 接続はスレッドごとなので、sync_to_async のスレッドで開いた接続にもここで入る
+connection_created.connect(_connection_created)
+
+
+def begin_request():
+    # このモジュールを読み込む前に開いていた接続の分
+    for connection in connections.all():
+        install(connection)
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_cache(name, hits, misses):
+    """現在のリクエストにキャッシュのヒット/ミスを足す。リクエスト外なら何もしない"""
+    stats = _current.get()
+    if stats is not None:
+        stats.cache[(name, 'hit')] += hits
+        stats.cache[(name, 'miss')] += misses
+
+
+def increment(name, *labels, value=1):
+    """リクエストによらないカウンタを足す。name は COUNTER_LABELS に書いておく"""
+    with _lock:
+        _counters[(name, *labels)] += value
+
+
+def observe(view, status, stats, size):
+    global _slow_traces
+    duration = time.perf_counter() - stats.started
+    values = {
+        'request_duration_seconds': duration,
+        'request_sql_queries': stats.sql_count,
+        'request_sql_duration_seconds': stats.sql_time,
+        'request_template_duration_seconds': stats.template_time,
+    }
+    if size is not None:
+        values['response_size_bytes'] = size
+    with _lock:
+        for metric, value in values.items():
+            key = (metric, view)
+            if key not in _histograms:
+                _histograms[key] = Histogram(HISTOGRAMS[metric])
+            _histograms[key].observe(value)
+        _counters[('requests_total', view, str(status))] += 1
+        for (name, result), count in stats.cache.items():
+            _counters[('cache_requests_total', view, name, result)] += count
+        if duration >= slow_request_seconds():
+            limit = getattr(settings, 'METRICS_SLOW_TRACE_LIMIT', DEFAULT_SLOW_TRACE_LIMIT)
+            if _slow_traces.maxlen != limit:
+                _slow_traces = deque(_slow_traces, maxlen=limit)
+            _slow_traces.append({
+                'view': view,
+                'status': status,
+                'duration_ms': round(duration * 1000, 3),
+                'sql_count': stats.sql_count,
+                'sql_ms': round(stats.sql_time * 1000, 3),
+                'template_ms': round(stats.template_time * 1000, 3),
+                'queries': stats.queries,
+                'at': time.time(),
+            })
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _slow_traces.clear()
+
+
+def snapshot():
+    """JSONで返す形の集計値"""
+    with _lock:
+        views = {}
+        for (metric, view), histogram in _histograms.items():
+            views.setdefault(view, {})[metric] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': {str(bound): count for bound, count in histogram.cumulative()},
+            }
+        counters = [{'name': key[0], 'labels': key[1:], 'value': value} for key, value in _counters.items()]
+        return {'views': views, 'counters': counters, 'slow_traces': list(_slow_traces)}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+COUNTER_LABELS = {
+    'requests_total': ('view', 'status'),
+    'cache_requests_total': ('view', 'cache', 'result'),
+    'ratelimit_rejected_total': ('rule',),
+}
+
+
+def render_prometheus():
+    """Prometheusのテキスト形式"""
+    lines = []
+    with _lock:
+        by_metric = {}
+        for (metric, view), histogram in sorted(_histograms.items()):
+            by_metric.setdefault(metric, []).append((view, histogram))
+        for metric, histograms in by_metric.items():
+            lines.append(f'# TYPE twitter_{metric} histogram')
+            for view, histogram in histograms:
+                label = f'view="{_escape(view)}"'
+                for bound, count in histogram.cumulative():
+                    lines.append(f'twitter_{metric}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'twitter_{metric}_sum{{{label}}} {histogram.sum}')
+                lines.append(f'twitter_{metric}_count{{{label}}} {histogram.count}')
+        for name, label_names in COUNTER_LABELS.items():
+            rows = sorted((key[1:], value) for key, value in _counters.items() if key[0] == name)
+            if not rows:
+                continue
+            lines.append(f'# TYPE twitter_{name} counter')
+            for labels, count in rows:
+                label = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(label_names, labels))
+                lines.append(f'twitter_{name}{{{label}}} {count}')
+    return '\n'.join(lines) + '\n'
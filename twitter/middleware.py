@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import db_router, metrics
+
+
+DEFAULT_REPLICA_PIN_SECONDS = 10
+
+
+class SyncAndAsyncMiddleware:
+    """ASGIで非同期viewをスレッドに回さずに通せるよう、同期/非同期どちらのチェーンにも入る
+
+    __call__ で前後の処理を分け、非同期のときは __acall__ から同じ処理を呼ぶ。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # MiddlewareMixin と同じく、ハンドラにコルーチン関数として扱わせる
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state = self.before(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.finish(request, state)
+        return self.after(request, response, state)
+
+    async def __acall__(self, request):
+        state = self.before(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.finish(request, state)
+        return self.after(request, response, state)
+
+    def before(self, request):
+        return None
+
+    def finish(self, request, state):
+        pass
+
+    def after(self, request, response, state):
+        return response
+
+
+class ReplicaPinningMiddleware(SyncAndAsyncMiddleware):
+    """書き込みをしたクライアントの読み出しを一定時間プライマリに固定する"""
+    cookie_name = 'primary_pin'
+
+    def _pinned_until(self, request):
+        try:
+            return float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            return 0
+
+    def before(self, request):
+        return {'token': db_router.begin_request(self._pinned_until(request) > time.time())}
+
+    def finish(self, request, state):
+        state['wrote'] = db_router.end_request(state['token'])
+
+    def after(self, request, response, state):
+        if state['wrote']:
+            seconds = getattr(settings, 'REPLICA_PIN_SECONDS', DEFAULT_REPLICA_PIN_SECONDS)
+            response.set_cookie(
+                self.cookie_name, str(time.time() + seconds),
+                max_age=seconds, httponly=True, samesite='Lax',
+            )
+        return response
+
+
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+    """view名ごとに処理時間、SQL、テンプレート描画時間、キャッシュ、レスポンスサイズを記録する
+
+    SQLは各接続に入れた metrics の execute_wrapper が数えるので、
+    sync_to_async で別スレッドから投げたSQLも同じリクエストに入る。
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def before(self, request):
+        stats, token = metrics.begin_request()
+        request._metrics = stats
+        return token
+
+    def finish(self, request, token):
+        metrics.end_request(token)
+
+    def after(self, request, response, token):
+        stats = request._metrics
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        size = None if response.streaming else len(response.content)
+        metrics.observe(view, response.status_code, stats, size)
+        return response
+
+    def process_template_response(self, request, response):
+        # MIDDLEWAREの先頭近くに置くので最後に呼ばれ、この直後に描画が始まる
+        stats = request._metrics
+        started = time.perf_counter()
+
+        def rendered(response):
+            stats.template_time += time.perf_counter() - started
+        response.add_post_render_callback(rendered)
+        return response
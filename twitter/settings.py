@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -24,9 +25,10 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-kgc&o8-46+c%=c+j1gx=bl4c%96(%xc)!-q^vi!bdt5!-t)-u+'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# TWITTER_DEBUG=0 で本番相当 (debug_toolbarも外れる)。その場合 TWITTER_ALLOWED_HOSTS をカンマ区切りで指定する
+DEBUG = os.environ.get('TWITTER_DEBUG', '1') == '1'
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.environ.get('TWITTER_ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -40,21 +42,29 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'user',
     'blog',
+    'jobs',
+    'ratelimit',
     'widget_tweaks',
-    'debug_toolbar',
 ]
 
 MIDDLEWARE = [
+    'twitter.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'twitter.middleware.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'ratelimit.middleware.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
+# debug_toolbarは開発時だけ使う
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'twitter.urls'
 
 TEMPLATES = [
@@ -83,9 +93,62 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('TWITTER_REPLICA_DB', BASE_DIR / 'db.replica.sqlite3'),
+    },
+}
+
+# 読み出しを振り分けるレプリカ。TWITTER_REPLICA_DB を指定したときだけ使う
+DATABASE_REPLICAS = ['replica'] if os.environ.get('TWITTER_REPLICA_DB') else []
+
+# postとLikeを作者ごとに分けて置くDB (blog.shards)。TWITTER_POST_SHARDS=N のときだけ使う。
+# 各シャードにも migrate --database shardN でスキーマを作っておく
+POST_SHARD_COUNT = int(os.environ.get('TWITTER_POST_SHARDS', '0'))
+for _i in range(max(POST_SHARD_COUNT, 2)):
+    DATABASES[f'shard{_i}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db.shard{_i}.sqlite3',
     }
+POST_SHARDS = [f'shard{i}' for i in range(POST_SHARD_COUNT)]
+# 作者ごとのシャードの割り当てをキャッシュする秒数。reshard_user はこの秒数だけ待って切り替える
+POST_SHARD_CACHE_TIMEOUT = 60
+
+DATABASE_ROUTERS = ['blog.shards.ShardRouter', 'twitter.db_router.PrimaryReplicaRouter']
+
+# これらのアプリのモデルに書き込んだ後、この秒数の間はそのクライアントの読み出しをプライマリに固定する
+REPLICA_PIN_SECONDS = 10
+REPLICA_PIN_APPS = ['auth', 'blog', 'user']
+
+
+# Cache
+# TWITTER_CACHE_BACKEND で locmem (既定) / file / redis を切り替える。
+# redis を使う場合は django-redis を別途インストールする。
+
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('TWITTER_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'twitter_cache')),
+    },
+    'redis': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('TWITTER_CACHE_LOCATION', 'redis://127.0.0.1:6379/1'),
+    },
+}
+
+CACHES = {
+    'default': CACHE_BACKENDS[os.environ.get('TWITTER_CACHE_BACKEND', 'locmem')],
 }
 
+# 描画済みpost断片とタイムラインページのTTL (秒)。0でタイムラインはキャッシュしない
+POST_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+TIMELINE_CACHE_TIMEOUT = 15
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -105,6 +168,23 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# TWITTER_FAST_PASSWORD_HASHER=1 ならパスワードをMD5でハッシュする (テストと負荷試験のデータ作り用。
+# 例: TWITTER_FAST_PASSWORD_HASHER=1 python manage.py test)。本番では使わない。
+# これで作ったユーザはこの設定が無いとログインできない
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+if os.environ.get('TWITTER_FAST_PASSWORD_HASHER') == '1':
+    PASSWORD_HASHERS.insert(0, 'django.contrib.auth.hashers.MD5PasswordHasher')
+
+# セッションはキャッシュから読み、変更はキャッシュとDBの両方に書く。request.user もキャッシュから読む (user.backends)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+AUTHENTICATION_BACKENDS = ['user.backends.CachedModelBackend']
+USER_CACHE_TIMEOUT = 300
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
@@ -147,3 +227,101 @@ NOSE_ARGS = [
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
+
+# ホーム、詳細、フォロー一覧に非同期viewを使う (ASGIで動かすとき TWITTER_ASYNC_VIEWS=1)。
+# TWITTER_ASYNC_PARALLEL_QUERIES=1 なら互いに依存しないクエリを別スレッドの接続で同時に投げる。
+# スレッドごとに接続を持つので、そのときは CONN_MAX_AGE で接続を使い回す。
+# SQLite では同じファイルを取り合うだけなので、PostgreSQL / MySQL のときに使う
+ASYNC_VIEWS = os.environ.get('TWITTER_ASYNC_VIEWS') == '1'
+ASYNC_PARALLEL_QUERIES = os.environ.get('TWITTER_ASYNC_PARALLEL_QUERIES') == '1'
+if ASYNC_PARALLEL_QUERIES:
+    for _database in DATABASES.values():
+        _database.setdefault('CONN_MAX_AGE', 60)
+
+# /metrics/ に出すリクエスト計測。これより遅いリクエストはSQL付きのトレースを残す
+METRICS_ENABLED = True
+METRICS_SLOW_REQUEST_MS = 500
+METRICS_SLOW_TRACE_LIMIT = 50
+
+# ホームタイムライン1ページあたりの件数
+TIMELINE_PAGE_SIZE = 20
+
+# フォロワー数がこれを超えるユーザの投稿は配らず、読み出し時に取りに行く。
+# 変えたときは rebuild_timeline で受信箱を作り直す
+TIMELINE_FANOUT_THRESHOLD = 10000
+TIMELINE_FANOUT_BATCH_SIZE = 1000
+
+# ホーム画面のServer-Sent Events。ストリームは twitter/asgi.py にしか無いので、ASGIで動かすとき
+# TWITTER_SSE=1 にする (WSGIや runserver では開かない)。EVENTS_BACKEND = 'file' で複数ワーカーに配る
+SSE_ENABLED = os.environ.get('TWITTER_SSE') == '1'
+EVENTS_BACKEND = 'local'
+EVENTS_FILE = os.path.join(tempfile.gettempdir(), 'twitter-events.log')
+SSE_QUEUE_SIZE = 100
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_CONNECTIONS = 10000
+SSE_MAX_POSTS = 100
+
+# バックグラウンドジョブ。本番では python manage.py run_jobs でワーカーを動かす (フォロワーへの配信、
+# 検索の索引、通知はワーカーが行う)。JOBS_EAGER ならワーカー無しで enqueue した場でジョブを実行する。
+# 既定は DEBUG のときだけ (TWITTER_JOBS_EAGER=0/1 で上書き)
+JOBS_EAGER = os.environ.get('TWITTER_JOBS_EAGER', '1' if DEBUG else '0') == '1'
+JOBS_BATCH_SIZE = 10
+JOBS_POLL_INTERVAL = 1.0
+JOBS_LOCK_TIMEOUT = 300
+JOBS_RETRY_BASE_SECONDS = 5
+JOBS_RETRY_MAX_SECONDS = 3600
+# 種類ごとの同時実行数の上限 (tasks.py の job(concurrency=...) を上書きする)
+JOBS_CONCURRENCY = {}
+
+# 通知は対象ごとにこの秒数の間の出来事を1回の書き込みにまとめる
+NOTIFICATION_FLUSH_SECONDS = 10
+NOTIFICATION_PAGE_SIZE = 20
+NOTIFICATION_UNREAD_CACHE_TIMEOUT = 300
+
+# フォローしている人とフォロワーのidの配列 (user.graph) をキャッシュする秒数と、キャッシュする最大の人数
+FOLLOW_GRAPH_CACHE_TIMEOUT = 3600
+FOLLOW_GRAPH_MAX_IDS = 100000
+# フォロー中 / フォロワーの一覧の1ページの人数
+FOLLOW_LIST_PAGE_SIZE = 50
+
+# フォローのおすすめ (compute_recommendations) はユーザごとに上位 RECOMMENDATION_SIZE 人を保存し、
+# ホームに RECOMMENDATION_DISPLAY_SIZE 人出す。これより多い隣接リストは辿らない
+RECOMMENDATION_SIZE = 20
+RECOMMENDATION_DISPLAY_SIZE = 3
+RECOMMENDATION_FANOUT_CAP = 5000
+
+# 書き込みの回数制限 (ratelimit)。カウンタは RATELIMIT_BACKEND ('local', 'cache', 'db') に置く。
+# 'cache' は RATELIMIT_CACHE_ALIAS のキャッシュが全プロセスで共有されるときだけ正しく数える。
+# プロキシの後ろで動かすときは RATELIMIT_IP_META = 'HTTP_X_FORWARDED_FOR' にする
+RATELIMIT_ENABLED = os.environ.get('TWITTER_RATELIMIT', '1') == '1'
+RATELIMIT_BACKEND = 'cache'
+RATELIMIT_CACHE_ALIAS = 'default'
+RATELIMIT_IP_META = 'REMOTE_ADDR'
+RATELIMIT_RULES = {
+    'post': {
+        'views': ['blog:create'], 'methods': ['POST'],
+        'algorithm': 'token_bucket', 'rate': '60/h', 'burst': 20,
+    },
+    'like': {
+        'views': ['blog:like', 'blog:unlike'],
+        'algorithm': 'token_bucket', 'rate': '120/m', 'burst': 30,
+    },
+    'follow': {
+        'views': ['user:follow', 'user:unfollow'],
+        'algorithm': 'sliding_window', 'rate': '200/h',
+    },
+    'login': {
+        'views': ['user:login', 'user:signup'], 'methods': ['POST'],
+        'algorithm': 'sliding_window', 'rate': '20/m', 'key': 'ip',
+    },
+}
+
+# トレンドは直近60分の1分ごとの使用回数を、半減期15分で減衰させて合計する
+TRENDING_WINDOW_MINUTES = 60
+TRENDING_HALF_LIFE_MINUTES = 15
+TRENDING_CACHE_TIMEOUT = 60
+TRENDING_SIZE = 10
+
+# この日数より古いpostは archive_posts でLikeと一緒にアーカイブ表へ移す
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_BATCH_SIZE = 1000
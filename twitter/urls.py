@@ -17,8 +17,11 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 
+from . import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('', include('user.urls')),
     path('blog/', include('blog.urls'))
 ]
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
+
+from . import metrics
+
+
+@require_GET
+def metrics_view(request):
+    """計測値。スタッフか INTERNAL_IPS からだけ見られる"""
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+        raise PermissionDenied()
+    if request.GET.get('format') == 'json':
+        return JsonResponse(metrics.snapshot())
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import Follow
+from .models import Follow, Profile
 
 admin.site.register(Follow)
+admin.site.register(Profile)
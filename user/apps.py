@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class UserConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+
+        from . import backends
+        # CachedModelBackend のキャッシュを消す
+        post_save.connect(backends.user_changed, sender=User, dispatch_uid='user.backends.user_changed')
+        post_delete.connect(backends.user_changed, sender=User, dispatch_uid='user.backends.user_changed')
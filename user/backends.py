@@ -0,0 +1,42 @@
+"""request.user をキャッシュから読む認証バックエンド
+
+ModelBackend.get_user はリクエストごとに auth_user を1回読む。CachedModelBackend は読んだ User を
+USER_CACHE_TIMEOUT 秒キャッシュし、User を save / delete したら消す (UserConfig.ready でつなぐ)。
+パスワード (セッションの検証に使う) や is_active の変更も save を通るので古い値は残らない。
+QuerySet.update で変えたときは invalidate を呼ぶ。
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+
+DEFAULT_TIMEOUT = 300
+
+
+def timeout():
+    return getattr(settings, 'USER_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def invalidate(user_id):
+    cache.delete(_key(user_id))
+
+
+def user_changed(sender, instance, **kwargs):
+    invalidate(instance.pk)
+
+
+class CachedModelBackend(ModelBackend):
+
+    def get_user(self, user_id):
+        key = _key(user_id)
+        user = cache.get(key)
+        if user is None:
+            # 存在しないか is_active でないユーザはキャッシュしない
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, timeout())
+        return user
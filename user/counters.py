@@ -0,0 +1,76 @@
+"""Profileのフォロー数カウンタ。Followの作成・削除と同じトランザクションで更新する"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import Follow, Profile
+
+
+def _count(**filters):
+    return (
+        Follow.objects.filter(**filters).order_by()
+        .values(*filters).annotate(count=Count('id')).values('count')
+    )
+
+
+def _create_profile(user_id, **fields):
+    try:
+        with transaction.atomic():
+            return Profile.objects.create(
+                user_id=user_id,
+                following_count=Follow.objects.filter(following_id=user_id).count(),
+                follower_count=Follow.objects.filter(follower_id=user_id).count(),
+                **fields,
+            )
+    except IntegrityError:
+        return Profile.objects.get(user_id=user_id)
+
+
+def get_profile(user):
+    try:
+        return Profile.objects.get(user=user)
+    except Profile.DoesNotExist:
+        return _create_profile(user.pk)
+
+
+def _adjust(user_id, field, delta, **fields):
+    """fields は同じUPDATEで一緒に書く値"""
+    profiles = Profile.objects.filter(user_id=user_id)
+    if delta < 0:
+        profiles = profiles.filter(**{f'{field}__gt': 0})
+    if not profiles.update(**{field: F(field) + delta}, **fields):
+        # Profileがまだ無い場合は実数から作る (作成済みのFollowも数えられる)
+        _create_profile(user_id, **fields)
+
+
+def follow_added(following_id, follower_id):
+    # フォローした側のおすすめは次の compute_recommendations --incremental で計算し直す
+    _adjust(following_id, 'following_count', 1, follows_changed_at=timezone.now())
+    _adjust(follower_id, 'follower_count', 1)
+
+
+def follow_removed(following_id, follower_id):
+    """フォローされていた側の follower_count の (変更前, 変更後) を返す"""
+    _adjust(following_id, 'following_count', -1, follows_changed_at=timezone.now())
+    _adjust(follower_id, 'follower_count', -1)
+    # 減らしたUPDATEで行はロックされているので、同じトランザクション内なら読み直した値が確定値
+    after = Profile.objects.filter(user_id=follower_id).values_list('follower_count', flat=True).get()
+    return after + 1, after
+
+
+def reconcile(start, stop):
+    """user_idが [start, stop) の範囲のProfileを実数に合わせる。修正した行数を返す"""
+    users = User.objects.filter(id__gte=start, id__lt=stop, profile__isnull=True)
+    Profile.objects.bulk_create(
+        [Profile(user_id=user_id) for user_id in users.values_list('id', flat=True)],
+        ignore_conflicts=True,
+    )
+    following = Coalesce(Subquery(_count(following=OuterRef('user_id'))), Value(0))
+    follower = Coalesce(Subquery(_count(follower=OuterRef('user_id'))), Value(0))
+    profiles = Profile.objects.filter(user_id__gte=start, user_id__lt=stop)
+    return (
+        profiles.exclude(following_count=following, follower_count=follower)
+        .update(following_count=following, follower_count=follower)
+    )
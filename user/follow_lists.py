@@ -0,0 +1,75 @@
+"""フォロー中 / フォロワーの一覧のページ分け
+
+フォローした日時の新しい順に (created_at, id) のキーセットで1ページずつ読み、ページに出る
+ユーザのフォロー数と閲覧者との関係 (フォローしているか、フォローされているか) をまとめて付ける。
+クエリはフォロワーの数によらず、一覧、Profile、閲覧者のフォローのグラフ (user.graph、
+キャッシュになければ2) だけで済む。
+"""
+from collections import namedtuple
+
+from django.conf import settings
+
+from . import graph
+from .models import Follow, Profile
+from blog import timeline
+
+
+DEFAULT_PAGE_SIZE = 50
+
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+# 方向 -> (一覧の持ち主を指すフィールド, 一覧に出るユーザのフィールド)
+_FIELDS = {
+    FOLLOWING: ('following', 'follower'),
+    FOLLOWERS: ('follower', 'following'),
+}
+
+# followed は閲覧者がuserをフォローしているか、follows_you はuserが閲覧者をフォローしているか
+Entry = namedtuple('Entry', 'user followed_at following_count follower_count followed follows_you')
+
+
+def page_size():
+    return getattr(settings, 'FOLLOW_LIST_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def page(owner, direction, viewer, cursor=None, limit=None):
+    """ownerのフォロー中 (FOLLOWING) かフォロワー (FOLLOWERS) の1ページ分。戻り値は (entries, next_cursor)"""
+    limit = limit or page_size()
+    field, other = _FIELDS[direction]
+    rows = Follow.objects.filter(**{field: owner}).select_related(other)
+    if cursor:
+        rows = rows.filter(timeline.before_cursor(timeline.decode_cursor(cursor)))
+    rows = list(rows.order_by('-created_at', '-id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = timeline.encode_cursor(rows[-1].created_at, rows[-1].pk)
+    user_ids = [getattr(row, f'{other}_id') for row in rows]
+    counts = {}
+    if user_ids:
+        counts = {
+            user_id: (following_count, follower_count)
+            for user_id, following_count, follower_count in Profile.objects.filter(user_id__in=user_ids)
+            .values_list('user_id', 'following_count', 'follower_count')
+        }
+    followed = graph.following_among(viewer.pk, user_ids)
+    follows_you = graph.followers_among(viewer.pk, user_ids)
+    entries = [
+        Entry(
+            getattr(row, other), row.created_at, *counts.get(user_id, (0, 0)),
+            user_id in followed, user_id in follows_you,
+        )
+        for row, user_id in zip(rows, user_ids)
+    ]
+    return entries, next_cursor
+
+
+def serialize(entry):
+    return {
+        'username': entry.user.username,
+        'followed_at': entry.followed_at.isoformat(),
+        'following_count': entry.following_count,
+        'follower_count': entry.follower_count,
+        'followed': entry.followed,
+        'follows_you': entry.follows_you,
+    }
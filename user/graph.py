@@ -0,0 +1,134 @@
+"""フォローのグラフ
+
+ユーザごとにフォローしている人とフォロワーのidを、昇順に並べた array('q') にしてキャッシュする
+(1人8バイトで、モデルのインスタンスやsetより小さい)。所属の確認は bisect で O(log n)、
+N人のうちフォローしている人はN回の二分探索で、どちらもキャッシュにあればクエリは投げない。
+
+follow_view / unfollow_view はコミット後に follow_added / follow_removed で両方の配列を捨てる。
+書き換えないので同時のフォローで片方が失われることはなく、有名人の大きな配列を書き直すこともない。
+捨てた後 STALE_SECONDS の間は印を置いてDBに聞き、その間に終わらなかった古い読み出しが
+古い配列をキャッシュに入れないようにする (読み出しは cache.add で、印を上書きしない)。
+配列はレプリカの遅れを持ち込まないようプライマリから読む。
+FOLLOW_GRAPH_MAX_IDS 人を超える配列 (有名人のフォロワーなど) はキャッシュせず、毎回DBに聞く。
+その印はフォローが変わっても捨てず、キャッシュの期限まで残す (その間に減っても結果は正しい)。
+"""
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Follow
+
+
+DEFAULT_CACHE_TIMEOUT = 3600
+DEFAULT_MAX_IDS = 100000
+
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+# 方向 -> (そのユーザを指す列, 相手の列)
+_COLUMNS = {
+    FOLLOWING: ('following_id', 'follower_id'),
+    FOLLOWERS: ('follower_id', 'following_id'),
+}
+# 大きすぎてキャッシュしないことを覚えておく印
+_TOO_LARGE = 'too large'
+# 変わったばかりでまだキャッシュしない印と、その秒数
+_CHANGED = 'changed'
+STALE_SECONDS = 5
+
+
+def cache_timeout():
+    return getattr(settings, 'FOLLOW_GRAPH_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def max_ids():
+    return getattr(settings, 'FOLLOW_GRAPH_MAX_IDS', DEFAULT_MAX_IDS)
+
+
+def _key(direction, user_id):
+    return f'graph:{direction}:{user_id}'
+
+
+def _query(direction, user_id):
+    column, other = _COLUMNS[direction]
+    return Follow.objects.filter(**{column: user_id}).values_list(other, flat=True)
+
+
+def _load(direction, user_id):
+    """キャッシュした昇順の配列。大きすぎてキャッシュしないならNone"""
+    cached = cache.get(_key(direction, user_id))
+    if cached == _TOO_LARGE or cached == _CHANGED:
+        return None
+    if cached is not None:
+        ids = array('q')
+        ids.frombytes(cached)
+        return ids
+    limit = max_ids()
+    rows = _query(direction, user_id).using(DEFAULT_DB_ALIAS).order_by(_COLUMNS[direction][1])
+    ids = array('q', rows[:limit + 1])
+    if len(ids) > limit:
+        cache.add(_key(direction, user_id), _TOO_LARGE, cache_timeout())
+        return None
+    cache.add(_key(direction, user_id), ids.tobytes(), cache_timeout())
+    return ids
+
+
+def _contains(ids, value):
+    index = bisect_left(ids, value)
+    return index < len(ids) and ids[index] == value
+
+
+def following_ids(user_id):
+    """userがフォローしている人のid (昇順)"""
+    ids = _load(FOLLOWING, user_id)
+    return ids if ids is not None else array('q', _query(FOLLOWING, user_id).order_by('follower_id'))
+
+
+def follower_ids(user_id):
+    """userのフォロワーのid (昇順)"""
+    ids = _load(FOLLOWERS, user_id)
+    return ids if ids is not None else array('q', _query(FOLLOWERS, user_id).order_by('following_id'))
+
+
+def is_following(user_id, other_id):
+    """userがotherをフォローしているか"""
+    return bool(following_among(user_id, [other_id]))
+
+
+def _among(direction, user_id, other_ids):
+    other_ids = set(other_ids)
+    if not other_ids:
+        return set()
+    ids = _load(direction, user_id)
+    if ids is None:
+        other = _COLUMNS[direction][1]
+        return set(_query(direction, user_id).filter(**{f'{other}__in': other_ids}))
+    return {other_id for other_id in other_ids if _contains(ids, other_id)}
+
+
+def following_among(user_id, other_ids):
+    """other_idsのうちuserがフォローしている人"""
+    return _among(FOLLOWING, user_id, other_ids)
+
+
+def followers_among(user_id, other_ids):
+    """other_idsのうちuserをフォローしている人"""
+    return _among(FOLLOWERS, user_id, other_ids)
+
+
+def _changed(following_id, follower_id):
+    keys = [_key(FOLLOWING, following_id), _key(FOLLOWERS, follower_id)]
+    # 大きすぎる印は残す。消すと次の読み出しで毎回 FOLLOW_GRAPH_MAX_IDS 件読み直してしまう
+    too_large = {key for key, value in cache.get_many(keys).items() if value == _TOO_LARGE}
+    cache.set_many({key: _CHANGED for key in keys if key not in too_large}, STALE_SECONDS)
+
+
+def follow_added(following_id, follower_id):
+    """following が follower をフォローした (コミット後に呼ぶ)"""
+    _changed(following_id, follower_id)
+
+
+def follow_removed(following_id, follower_id):
+    _changed(following_id, follower_id)
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def create_profiles(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    Follow = apps.get_model('user', 'Follow')
+    Profile = apps.get_model('user', 'Profile')
+
+    def count(field):
+        return Coalesce(Subquery(
+            Follow.objects.filter(**{field: OuterRef('user_id')}).order_by()
+            .values(field).annotate(count=Count('id')).values('count')
+        ), Value(0))
+
+    Profile.objects.bulk_create(
+        (Profile(user_id=user_id) for user_id in User.objects.values_list('id', flat=True).iterator()),
+        batch_size=1000,
+    )
+    Profile.objects.update(following_count=count('following'), follower_count=count('follower'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('user', '0002_auto_20211225_0951'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='profile', serialize=False, to='auth.user')),
+                ('following_count', models.PositiveIntegerField(default=0)),
+                ('follower_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'profile',
+            },
+        ),
+        migrations.RunPython(create_profiles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:06
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def dedupe_follows(apps, schema_editor):
+    """同じ (following, follower) のFollowは最も古い1行だけ残し、Profileを数え直す"""
+    Follow = apps.get_model('user', 'Follow')
+    Profile = apps.get_model('user', 'Profile')
+    duplicates = (
+        Follow.objects.order_by().values('following', 'follower')
+        .annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    )
+    user_ids = set()
+    for row in duplicates.iterator():
+        Follow.objects.filter(following=row['following'], follower=row['follower']).exclude(id=row['keep']).delete()
+        user_ids.update((row['following'], row['follower']))
+
+    def count(field):
+        return Coalesce(Subquery(
+            Follow.objects.filter(**{field: OuterRef('user_id')}).order_by()
+            .values(field).annotate(count=Count('id')).values('count')
+        ), Value(0))
+
+    user_ids = sorted(user_ids)
+    for i in range(0, len(user_ids), 500):
+        Profile.objects.filter(user_id__in=user_ids[i:i + 500]).update(
+            following_count=count('following'), follower_count=count('follower'),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('user', '0003_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_follows, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='follow',
+            name='follower',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='follower', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='follow',
+            name='following',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='following', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['follower', 'following'], name='follow_follower_following_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='follow',
+            constraint=models.UniqueConstraint(fields=('following', 'follower'), name='follow_unique_following_follower'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0008_follow_list_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='first_event_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
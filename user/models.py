@@ -4,8 +4,8 @@ from django.utils import timezone
 
 
 class Follow(models.Model):
-    following = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following")
-    follower = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follower")
+    following = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following", db_index=False)
+    follower = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follower", db_index=False)
     created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
@@ -13,3 +13,88 @@ class Follow(models.Model):
 
     class Meta:
         db_table = 'follow'
+        constraints = [
+            models.UniqueConstraint(fields=['following', 'follower'], name='follow_unique_following_follower'),
+        ]
+        indexes = [
+            models.Index(fields=['follower', 'following'], name='follow_follower_following_idx'),
+            # 通知の集計でフォローされた側ごとに新しいフォローだけを読む
+            models.Index(fields=['follower', 'created_at'], name='follow_follower_created_idx'),
+            # フォロー中の一覧をフォローした日時の新しい順に読む
+            models.Index(fields=['following', 'created_at'], name='follow_following_created_idx'),
+        ]
+
+
+class Profile(models.Model):
+    """フォロー数などの非正規化カウンタ"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='profile')
+    following_count = models.PositiveIntegerField(default=0)
+    follower_count = models.PositiveIntegerField(default=0)
+    # フォローしている人が最後に変わった日時と、おすすめを最後に計算した日時 (user.recommendations)
+    follows_changed_at = models.DateTimeField(null=True, blank=True)
+    recommended_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user} profile"
+
+    class Meta:
+        db_table = 'profile'
+
+
+class Notification(models.Model):
+    """Like、フォロー、メンションの通知。未読の間に届いた同じ種類の出来事は1行にまとめる
+
+    Likeはpostごと、フォローとメンションは受け取るユーザごとにまとめる。
+    actor は最後の相手、actor_count はまとめた相手の人数 (同じ人の Like のやり直しなどは1人と数える)。
+    """
+    LIKE = 'like'
+    FOLLOW = 'follow'
+    MENTION = 'mention'
+    VERB_CHOICES = [
+        (LIKE, 'like'),
+        (FOLLOW, 'follow'),
+        (MENTION, 'mention'),
+    ]
+
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_index=False)
+    verb = models.CharField(max_length=10, choices=VERB_CHOICES)
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    post = models.ForeignKey('blog.Post', on_delete=models.CASCADE, related_name='+', null=True, blank=True, db_constraint=False)
+    actor_count = models.PositiveIntegerField(default=1)
+    unread = models.BooleanField(default=True)
+    # まとめた出来事のうち最も古いものと新しいものの時刻。次の集計は last_event_at より後の出来事を見て、
+    # 未読の間は first_event_at からの相手の人数を数え直す
+    first_event_at = models.DateTimeField(null=True, blank=True)
+    last_event_at = models.DateTimeField()
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.actor} {self.verb} -> {self.recipient} ({self.actor_count})"
+
+    class Meta:
+        db_table = 'notification'
+        indexes = [
+            models.Index(fields=['recipient', '-updated_at', '-id'], name='notification_recipient_idx'),
+            models.Index(fields=['recipient', 'verb', 'post'], name='notification_group_idx'),
+        ]
+
+
+class Recommendation(models.Model):
+    """フォローをおすすめするユーザ。compute_recommendations コマンドで事前に計算する"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recommendations', db_index=False)
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    # userがフォローしている人のうち、candidateをフォローしている人の数
+    mutual_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.candidate} for {self.user}"
+
+    class Meta:
+        db_table = 'recommendation'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'candidate'], name='recommendation_unique_user_candidate'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-score'], name='recommendation_user_score_idx'),
+        ]
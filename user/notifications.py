@@ -0,0 +1,182 @@
+"""Like、フォロー、メンションの通知
+
+リクエストでは出来事ごとに通知の行を書かず、schedule() でまとめ役のジョブを
+NOTIFICATION_FLUSH_SECONDS 後に1つだけ積む (同じ対象の2回目以降はキャッシュで弾く)。
+ジョブは Like / Follow / Mention の行のうち前回の集計より新しいものがあれば、未読の通知の
+相手の人数をその通知の最初の出来事から数え直し、未読の通知がなければ1行作る。同じ人が
+Likeやフォローをやり直しても1人と数える。人気のpostにLikeが殺到しても通知の書き込みは
+対象ごとに NOTIFICATION_FLUSH_SECONDS に1回で済む。
+キャッシュが消えたりジョブが失われても、出来事の行は残っているので次の集計で拾われる。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .models import Follow, Notification
+from blog import shards, timeline
+from blog.models import Like, Mention
+from jobs import queue
+
+
+DEFAULT_FLUSH_SECONDS = 10
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_UNREAD_CACHE_TIMEOUT = 300
+# まだ通知の無い対象は、これより古い出来事を数えない
+DEFAULT_LOOKBACK_HOURS = 24
+
+
+def flush_seconds():
+    return getattr(settings, 'NOTIFICATION_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS)
+
+
+def page_size():
+    return getattr(settings, 'NOTIFICATION_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def unread_cache_timeout():
+    return getattr(settings, 'NOTIFICATION_UNREAD_CACHE_TIMEOUT', DEFAULT_UNREAD_CACHE_TIMEOUT)
+
+
+def lookback():
+    return timedelta(hours=getattr(settings, 'NOTIFICATION_LOOKBACK_HOURS', DEFAULT_LOOKBACK_HOURS))
+
+
+def schedule(verb, target_id):
+    """target (likeならpost、それ以外は受け取るユーザ) の集計ジョブを積む。積み済みなら何もしない"""
+    if cache.add(f'notifications:scheduled:{verb}:{target_id}', True, flush_seconds()):
+        queue.enqueue('notifications.flush', delay=flush_seconds(), verb=verb, target_id=target_id)
+
+
+def schedule_mentions(user_ids):
+    for user_id in user_ids:
+        schedule(Notification.MENTION, user_id)
+
+
+def _events(verb, target_id):
+    """(受け取るユーザのid, 出来事のqueryset, 相手のフィールド, postのフィールド)"""
+    if verb == Notification.LIKE:
+        recipient_id = shards.post_author(target_id)
+        # Likeはpostと同じシャードにある
+        alias = shards.for_author(recipient_id) if recipient_id is not None else None
+        events = Like.objects.using(alias).filter(post_id=target_id).exclude(user_id=recipient_id)
+        return recipient_id, events, 'user_id', 'post_id'
+    if verb == Notification.FOLLOW:
+        return target_id, Follow.objects.filter(follower_id=target_id), 'following_id', None
+    events = Mention.objects.filter(user_id=target_id).exclude(post__author_id=target_id)
+    return target_id, events, 'post__author_id', 'post_id'
+
+
+def flush(verb, target_id, now=None):
+    """targetの新しい出来事を通知にまとめる。まとめた出来事の数を返す"""
+    now = now or timezone.now()
+    recipient_id, events, actor_field, post_field = _events(verb, target_id)
+    if recipient_id is None:
+        return 0
+    group = Notification.objects.filter(recipient_id=recipient_id, verb=verb)
+    if verb == Notification.LIKE:
+        group = group.filter(post_id=target_id)
+    watermark = group.aggregate(last=Max('last_event_at'))['last'] or now - lookback()
+    new_events = events.filter(created_at__gt=watermark)
+    summary = new_events.aggregate(
+        count=Count('pk'), actors=Count(actor_field, distinct=True), first=Min('created_at'), last=Max('created_at'),
+    )
+    if not summary['count']:
+        return 0
+    fields = [actor_field] + ([post_field] if post_field else [])
+    latest = new_events.order_by('-created_at', '-id').values_list(*fields).first()
+    values = {
+        'actor_id': latest[0],
+        'post_id': latest[1] if post_field else None,
+        'last_event_at': summary['last'],
+        'updated_at': now,
+    }
+    unread = group.filter(unread=True).order_by('-updated_at').first()
+    if unread is None:
+        Notification.objects.create(
+            recipient_id=recipient_id, verb=verb, actor_count=summary['actors'], first_event_at=summary['first'],
+            **values,
+        )
+    else:
+        for name, value in values.items():
+            setattr(unread, name, value)
+        if unread.first_event_at is None:
+            # first_event_at が無い古い行は足すしかない
+            unread.actor_count += summary['actors']
+        else:
+            unread.actor_count = events.filter(
+                created_at__gte=unread.first_event_at, created_at__lte=summary['last'],
+            ).aggregate(actors=Count(actor_field, distinct=True))['actors']
+        unread.save(update_fields=[*values, 'actor_count'])
+    cache.delete(unread_count_key(recipient_id))
+    return summary['count']
+
+
+def unread_count_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def unread_count(user):
+    """未読の通知 (まとめた行) の数。キャッシュする"""
+    key = unread_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(recipient=user, unread=True).count()
+        cache.set(key, count, unread_cache_timeout())
+    return count
+
+
+def mark_read(user):
+    """全部既読にする。既読にした行数を返す"""
+    count = Notification.objects.filter(recipient=user, unread=True).update(unread=False)
+    cache.set(unread_count_key(user.pk), 0, unread_cache_timeout())
+    return count
+
+
+def inbox(user, cursor=None, limit=None):
+    """新しく更新された順に1ページ分を返す。戻り値は (notifications, next_cursor)
+
+    まとめられた通知は updated_at が新しくなって先頭に移るので、読んでいる途中に
+    更新された通知は次のページに出ないことがある。
+    """
+    limit = limit or page_size()
+    rows = Notification.objects.filter(recipient=user).select_related('actor')
+    if cursor:
+        rows = rows.filter(timeline.before_cursor(timeline.decode_cursor(cursor), created_at_field='updated_at'))
+    rows = list(rows.order_by('-updated_at', '-id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = timeline.encode_cursor(rows[-1].updated_at, rows[-1].pk)
+    return rows, next_cursor
+
+
+MESSAGES = {
+    Notification.LIKE: 'liked your post',
+    Notification.FOLLOW: 'followed you',
+    Notification.MENTION: 'mentioned you',
+}
+
+
+def describe(notification):
+    """「X and 41 others liked your post」の形の文"""
+    actor = notification.actor.username
+    others = notification.actor_count - 1
+    if others:
+        actor = f"{actor} and {others} {'other' if others == 1 else 'others'}"
+    return f'{actor} {MESSAGES[notification.verb]}'
+
+
+def serialize(notification):
+    return {
+        'id': notification.pk,
+        'verb': notification.verb,
+        'actor': notification.actor.username,
+        'count': notification.actor_count,
+        'post': notification.post_id,
+        'text': describe(notification),
+        'unread': notification.unread,
+        'updated_at': notification.updated_at.isoformat(),
+    }
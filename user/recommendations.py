@@ -0,0 +1,229 @@
+"""フォローのおすすめ
+
+compute_recommendations コマンドでユーザごとの上位の候補を Recommendation の表に書いておき、
+ホームはそれを1クエリで読むだけにする。候補の点数は次の2つの和。
+
+- フォローしている人 v がフォローしている人 (友達の友達)。1/log(2 + vのフォロー数) ずつ足す
+- フォローしている人 v を同じくフォローしている人 (共通のフォロー)。COFOLLOW_WEIGHT/log(2 + vのフォロワー数) ずつ足す
+
+RECOMMENDATION_FANOUT_CAP 人より多い隣接リスト (有名人のフォロワーなど) は読み込まず、
+辿りもしない。それより多くフォローしているユーザは、フォローしている人を間引いて辿る。
+
+グラフは chunk_size × processes 人ずつ、そのユーザたちから2歩先までの隣接リストを昇順の
+array('q') で読み込み、fork したワーカープロセスがそれを共有してチャンクごとに計算する。
+結果はチャンクごとに書き、グラフは次のユーザたちを読む前に捨てるので、メモリに持つのは
+それだけのユーザの2歩先までのグラフと1チャンク分の結果で済み、辺の総数には比例しない。
+--incremental は前回の計算よりあとにフォローを変えたユーザだけを計算し直す。フォローしている人の
+フォローが変わっただけのユーザは、次の全体の計算まで前の結果のままになる。
+"""
+import heapq
+import math
+import multiprocessing
+import signal
+from array import array
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import graph
+from .models import Follow, Profile, Recommendation
+
+
+DEFAULT_SIZE = 20
+DEFAULT_DISPLAY_SIZE = 3
+DEFAULT_FANOUT_CAP = 5000
+DEFAULT_CHUNK_SIZE = 500
+# 共通のフォローの重み (友達の友達を1とする)
+COFOLLOW_WEIGHT = 0.5
+
+_EMPTY = array('q')
+# ワーカープロセスが fork で受け継ぐグラフ
+_graph = None
+
+
+def size():
+    return getattr(settings, 'RECOMMENDATION_SIZE', DEFAULT_SIZE)
+
+
+def display_size():
+    return getattr(settings, 'RECOMMENDATION_DISPLAY_SIZE', DEFAULT_DISPLAY_SIZE)
+
+
+def fanout_cap():
+    return getattr(settings, 'RECOMMENDATION_FANOUT_CAP', DEFAULT_FANOUT_CAP)
+
+
+class Graph:
+    """おすすめの計算に使う部分グラフ"""
+
+    def __init__(self):
+        # user_id -> フォローしている人 / フォロワーのid (昇順)
+        self.following = {}
+        self.followers = {}
+
+
+def _lists(column, other, user_ids, chunk_size, lists=None):
+    """user_ids の各ユーザの辺を {user_id: 昇順の array('q')} に読む"""
+    lists = {} if lists is None else lists
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), chunk_size):
+        rows = (
+            Follow.objects.filter(**{f'{column}__in': user_ids[start:start + chunk_size]})
+            .order_by(column, other).values_list(column, other)
+        )
+        for user_id, other_id in rows.iterator(chunk_size=10000):
+            lists.setdefault(user_id, array('q')).append(other_id)
+    return lists
+
+
+def _small(user_ids, field, cap, chunk_size):
+    """user_ids のうち Profile の field が cap 以下のユーザ (Profileが無ければ含める)"""
+    user_ids = sorted(user_ids)
+    large = set()
+    for start in range(0, len(user_ids), chunk_size):
+        large.update(
+            Profile.objects.filter(user_id__in=user_ids[start:start + chunk_size], **{f'{field}__gt': cap})
+            .values_list('user_id', flat=True)
+        )
+    return [user_id for user_id in user_ids if user_id not in large]
+
+
+def load_graph(user_ids, cap=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """user_ids のおすすめの計算に要る、2歩先までの隣接リストを読む"""
+    cap = cap or fanout_cap()
+    result = Graph()
+    _lists('following_id', 'follower_id', user_ids, chunk_size, result.following)
+    intermediates = set()
+    for ids in result.following.values():
+        intermediates.update(ids)
+    missing = intermediates.difference(result.following)
+    _lists('following_id', 'follower_id', _small(missing, 'following_count', cap, chunk_size), chunk_size,
+           result.following)
+    _lists('follower_id', 'following_id', _small(intermediates, 'follower_count', cap, chunk_size), chunk_size,
+           result.followers)
+    return result
+
+
+def recommend(graph, user_id, limit=None, cap=None):
+    """userのおすすめ [(candidate_id, score, mutual_count)] を点数の高い順に最大limit件"""
+    limit = limit or size()
+    cap = cap or fanout_cap()
+    followed = graph.following.get(user_id, _EMPTY)
+    excluded = set(followed)
+    excluded.add(user_id)
+    if len(followed) > cap:
+        followed = followed[::math.ceil(len(followed) / cap)]
+    scores = {}
+    mutual = {}
+    for via in followed:
+        ids = graph.following.get(via, _EMPTY)
+        if len(ids) <= cap:
+            weight = 1 / math.log(2 + len(ids))
+            for candidate in ids:
+                if candidate not in excluded:
+                    scores[candidate] = scores.get(candidate, 0) + weight
+                    mutual[candidate] = mutual.get(candidate, 0) + 1
+        ids = graph.followers.get(via, _EMPTY)
+        if len(ids) <= cap:
+            weight = COFOLLOW_WEIGHT / math.log(2 + len(ids))
+            for candidate in ids:
+                if candidate not in excluded:
+                    scores[candidate] = scores.get(candidate, 0) + weight
+    # 同点なら古いユーザを先にして結果を決まったものにする
+    top = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+    return [(candidate, score, mutual.get(candidate, 0)) for candidate, score in top]
+
+
+def _init_worker():
+    # 親のハンドラ (run_jobs などが置いたもの) を受け継ぐと terminate() で止まらなくなる
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _work(task):
+    user_ids, limit, cap = task
+    return [(user_id, recommend(_graph, user_id, limit, cap)) for user_id in user_ids]
+
+
+def compute(user_ids, processes=1, chunk_size=DEFAULT_CHUNK_SIZE, limit=None, cap=None):
+    """user_ids のおすすめを計算し、チャンクごとに [(user_id, [(candidate_id, score, mutual_count)])] を返す"""
+    global _graph
+    limit = limit or size()
+    cap = cap or fanout_cap()
+    parallel = processes > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    batch_size = chunk_size * processes if parallel else chunk_size
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        _graph = load_graph(batch, cap, chunk_size)
+        tasks = [(batch[i:i + chunk_size], limit, cap) for i in range(0, len(batch), chunk_size)]
+        try:
+            if parallel:
+                # ワーカーはDBに触らず、fork で受け継いだグラフだけを読む
+                pool = multiprocessing.get_context('fork').Pool(processes, initializer=_init_worker)
+                try:
+                    yield from pool.imap_unordered(_work, tasks)
+                except BaseException:
+                    # 例外や途中で読むのをやめた (GeneratorExit) ときだけ止める
+                    pool.terminate()
+                    raise
+                else:
+                    pool.close()
+                finally:
+                    pool.join()
+            else:
+                for task in tasks:
+                    yield _work(task)
+        finally:
+            _graph = None
+
+
+def store(results, computed_at):
+    """1チャンク分の結果で、そのユーザたちのおすすめを置き換える"""
+    user_ids = [user_id for user_id, _ in results]
+    with transaction.atomic():
+        Recommendation.objects.filter(user_id__in=user_ids).delete()
+        Recommendation.objects.bulk_create([
+            Recommendation(user_id=user_id, candidate_id=candidate, score=score, mutual_count=mutual_count)
+            for user_id, rows in results
+            for candidate, score, mutual_count in rows
+        ])
+        Profile.objects.filter(user_id__in=user_ids).update(recommended_at=computed_at)
+
+
+def stale_user_ids():
+    """前回の計算よりあとにフォローを変えたユーザのid"""
+    changed = Q(recommended_at__isnull=True) | Q(follows_changed_at__gt=F('recommended_at'))
+    return list(
+        Profile.objects.filter(follows_changed_at__isnull=False).filter(changed)
+        .order_by('user_id').values_list('user_id', flat=True)
+    )
+
+
+def run(incremental=False, processes=1, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """おすすめを計算して書く。計算したユーザの数を返す"""
+    computed_at = timezone.now()
+    if incremental:
+        user_ids = stale_user_ids()
+    else:
+        user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    if progress:
+        progress.start('recommendations')
+    for results in compute(user_ids, processes, chunk_size):
+        store(results, computed_at)
+        if progress:
+            progress.add(len(results))
+    if progress:
+        progress.finish()
+    return len(user_ids)
+
+
+def for_user(user, limit=None):
+    """ホームに出すおすすめ。計算した後にフォローした人は除く"""
+    limit = limit or display_size()
+    rows = list(
+        Recommendation.objects.filter(user=user).select_related('candidate').order_by('-score')[:limit * 2]
+    )
+    followed = graph.following_among(user.pk, [row.candidate_id for row in rows])
+    return [row for row in rows if row.candidate_id not in followed][:limit]
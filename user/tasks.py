@@ -0,0 +1,22 @@
+"""userのバックグラウンドジョブ (jobs.queue.enqueue で積む)"""
+from django.contrib.auth.models import User
+
+from jobs.queue import job
+
+from . import notifications
+from .models import Follow
+from blog import timeline
+
+
+@job('timeline.backfill_follow', concurrency=4)
+def backfill_follow(user_id, author_id):
+    """フォローした相手の最近の投稿を受信箱へ入れる。実行までにフォロー解除されていれば何もしない"""
+    if not Follow.objects.filter(following_id=user_id, follower_id=author_id).exists():
+        return
+    timeline.backfill_follow(User(pk=user_id), User(pk=author_id))
+
+
+@job('notifications.flush', concurrency=4)
+def flush_notifications(verb, target_id):
+    notifications.flush(verb, target_id)
+
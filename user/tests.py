@@ -1,7 +1,24 @@
-from django.test import TestCase, Client
+from django.test import AsyncRequestFactory, TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.http import Http404
+from django.core.cache import cache as default_cache
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from asgiref.sync import sync_to_async
+from unittest import mock
+
+from .models import Follow, Notification, Profile, Recommendation
+from . import backends, counters, graph, notifications, recommendations, views
+from blog.models import Like, Post
+from jobs import queue
+from jobs.models import Job
 
 
 class HomeViewTests(TestCase):
@@ -304,3 +321,425 @@ class UnFollowTest(TestCase):
         following_list = self.user1.following.values_list('follower')
         following_count = User.objects.filter(id__in=following_list).count()
         self.assertEqual(following_count, 0)
+
+
+class FollowCounterTest(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user('user1', 'example@gmail.com', 'example13046')
+        self.user2 = User.objects.create_user('user2', 'example@gmail.com', 'example13046')
+        self.client.login(username='user1', password='example13046')
+
+    def test_follow_and_unfollow_update_counter(self):
+        self.client.post(reverse('user:follow', kwargs={'username': 'user2'}))
+        self.assertEqual(Profile.objects.get(user=self.user1).following_count, 1)
+        self.assertEqual(Profile.objects.get(user=self.user2).follower_count, 1)
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual(response.context['following_count'], 1)
+        self.assertEqual(response.context['follower_count'], 0)
+
+        self.client.post(reverse('user:unfollow', kwargs={'username': 'user2'}))
+        self.assertEqual(Profile.objects.get(user=self.user1).following_count, 0)
+        self.assertEqual(Profile.objects.get(user=self.user2).follower_count, 0)
+
+    def test_follow_twice(self):
+        self.client.post(reverse('user:follow', kwargs={'username': 'user2'}))
+        self.client.post(reverse('user:follow', kwargs={'username': 'user2'}))
+        self.assertEqual(Follow.objects.count(), 1)
+        self.assertEqual(Profile.objects.get(user=self.user1).following_count, 1)
+
+    def test_reconcile_counters(self):
+        Follow.objects.create(following=self.user1, follower=self.user2)
+        Profile.objects.create(user=self.user1, following_count=5)
+        call_command('reconcile_counters', stdout=StringIO())
+        self.assertEqual(Profile.objects.get(user=self.user1).following_count, 1)
+        self.assertEqual(Profile.objects.get(user=self.user2).follower_count, 1)
+
+
+@override_settings(ASYNC_PARALLEL_QUERIES=False)
+class FollowListTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.owner = User.objects.create_user('owner', 'owner@gmail.com', 'example13046')
+        self.viewer = User.objects.create_user('viewer', 'viewer@gmail.com', 'example13046')
+        self.fans = [User.objects.create_user(f'fan{i}', f'fan{i}@gmail.com', 'example13046') for i in range(5)]
+        now = timezone.now()
+        # fan0 が最初にフォローし、fan4 が最後にフォローした
+        for i, fan in enumerate(self.fans):
+            Follow.objects.create(following=fan, follower=self.owner, created_at=now - timedelta(minutes=10 - i))
+            counters.follow_added(fan.pk, self.owner.pk)
+        Follow.objects.create(following=self.viewer, follower=self.fans[4])
+        Follow.objects.create(following=self.fans[3], follower=self.viewer)
+        self.client.force_login(self.viewer)
+
+    @override_settings(FOLLOW_LIST_PAGE_SIZE=2)
+    def test_pagination_and_flags(self):
+        url = reverse('user:follower_json', kwargs={'username': 'owner'})
+        users = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {'cursor': cursor} if cursor else {}).json()
+            users += response['users']
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual([user['username'] for user in users], [f'fan{i}' for i in range(4, -1, -1)])
+        self.assertEqual([(user['followed'], user['follows_you']) for user in users[:2]], [(True, False), (False, True)])
+        self.assertEqual(users[0]['following_count'], 1)
+        response = self.client.get(reverse('user:following_json', kwargs={'username': 'fan0'})).json()
+        self.assertEqual([user['username'] for user in response['users']], ['owner'])
+        self.assertEqual(response['users'][0]['follower_count'], 5)
+        self.assertEqual(self.client.get(url, {'cursor': 'broken'}).status_code, 400)
+
+    def test_page_queries_do_not_grow(self):
+        url = reverse('user:follower', kwargs={'username': 'owner'})
+        response = self.client.get(url)
+        self.assertEqual([entry.user for entry in response.context['entries']], self.fans[::-1])
+        self.assertContains(response, 'フォローされています')
+        for i in range(5, 10):
+            fan = User.objects.create_user(f'fan{i}', f'fan{i}@gmail.com', 'example13046')
+            Follow.objects.create(following=fan, follower=self.owner)
+        # 一覧の持ち主、一覧、Profile (セッション、ユーザ、閲覧者のグラフはキャッシュ済み)
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['entries']), 10)
+
+
+# 別スレッドの接続からはテストのトランザクションの中のデータが見えない
+@override_settings(ASYNC_PARALLEL_QUERIES=False)
+class AsyncFollowListTest(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user('user1', 'example@gmail.com', 'example13046')
+        self.user2 = User.objects.create_user('user2', 'example@gmail.com', 'example13046')
+        Follow.objects.create(following=self.user1, follower=self.user2)
+
+    def _request(self, name, username):
+        request = AsyncRequestFactory().get(reverse(name, kwargs={'username': username}))
+        request.user = self.user1
+        return request
+
+    async def test_following_and_follower(self):
+        response = await views.following_view(self._request('user:following', 'user1'), username='user1')
+        await sync_to_async(response.render)()
+        self.assertEqual([entry.user for entry in response.context_data['entries']], [self.user2])
+        self.assertContains(response, 'user2')
+        response = await views.follower_view(self._request('user:follower', 'user2'), username='user2')
+        self.assertEqual([entry.user for entry in response.context_data['entries']], [self.user1])
+
+    async def test_unknown_user(self):
+        with self.assertRaises(Http404):
+            await views.following_view(self._request('user:following', 'nobody'), username='nobody')
+
+
+class FollowGraphTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.alice, self.bob, self.carol, self.dave = [
+            User.objects.create_user(name, f'{name}@gmail.com', 'example13046')
+            for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+        # alice は bob と carol をフォローし、dave は alice をフォローしている
+        for following, follower in ((self.alice, self.carol), (self.alice, self.bob), (self.dave, self.alice)):
+            Follow.objects.create(following=following, follower=follower)
+
+    def test_membership(self):
+        self.assertEqual(list(graph.following_ids(self.alice.pk)), sorted([self.bob.pk, self.carol.pk]))
+        self.assertEqual(list(graph.follower_ids(self.alice.pk)), [self.dave.pk])
+        others = [self.bob.pk, self.carol.pk, self.dave.pk]
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.following_among(self.alice.pk, others), {self.bob.pk, self.carol.pk})
+            self.assertEqual(graph.followers_among(self.alice.pk, others), {self.dave.pk})
+            self.assertTrue(graph.is_following(self.alice.pk, self.bob.pk))
+            self.assertFalse(graph.is_following(self.alice.pk, self.dave.pk))
+
+    def test_follow_and_unfollow_invalidate_cache(self):
+        graph.following_ids(self.alice.pk)
+        graph.follower_ids(self.dave.pk)
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('user:follow', kwargs={'username': 'dave'}))
+        self.assertTrue(graph.is_following(self.alice.pk, self.dave.pk))
+        self.assertEqual(graph.followers_among(self.dave.pk, [self.alice.pk]), {self.alice.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('user:unfollow', kwargs={'username': 'bob'}))
+        self.assertEqual(list(graph.following_ids(self.alice.pk)), sorted([self.carol.pk, self.dave.pk]))
+        response = self.client.get(reverse('user:follow_index', kwargs={'username': 'carol'}))
+        self.assertTrue(response.context['has_followed'])
+
+    def test_interleaved_updates(self):
+        '''同時のフォローはどちらも残り、その間に読んだ古い配列はキャッシュに入らない'''
+        graph.follower_ids(self.alice.pk)
+        Follow.objects.create(following=self.bob, follower=self.alice)
+        Follow.objects.create(following=self.carol, follower=self.alice)
+        graph.follow_added(self.carol.pk, self.alice.pk)
+        graph.follow_added(self.bob.pk, self.alice.pk)
+        expected = sorted([self.bob.pk, self.carol.pk, self.dave.pk])
+        self.assertEqual(list(graph.follower_ids(self.alice.pk)), expected)
+
+        # 読み出しがDBを読んでからキャッシュに入れるまでの間に、フォロー解除がコミットされる
+        default_cache.clear()
+        add = default_cache.add
+
+        def add_after_unfollow(*args, **kwargs):
+            Follow.objects.filter(following=self.carol, follower=self.alice).delete()
+            graph.follow_removed(self.carol.pk, self.alice.pk)
+            return add(*args, **kwargs)
+        with mock.patch.object(graph.cache, 'add', side_effect=add_after_unfollow):
+            self.assertEqual(list(graph.follower_ids(self.alice.pk)), expected)
+        self.assertEqual(list(graph.follower_ids(self.alice.pk)), sorted([self.bob.pk, self.dave.pk]))
+
+    @override_settings(FOLLOW_GRAPH_MAX_IDS=1)
+    def test_large_sets_are_not_cached(self):
+        """上限を超える配列はキャッシュせずDBに聞く"""
+        self.assertEqual(graph.following_among(self.alice.pk, [self.bob.pk, self.dave.pk]), {self.bob.pk})
+        with self.assertNumQueries(1):
+            self.assertEqual(graph.following_among(self.alice.pk, [self.bob.pk, self.dave.pk]), {self.bob.pk})
+        self.assertEqual(list(graph.follower_ids(self.alice.pk)), [self.dave.pk])
+
+    @override_settings(FOLLOW_GRAPH_MAX_IDS=1)
+    def test_large_sets_stay_uncached_after_follow(self):
+        """フォローが変わっても大きすぎる印は残り、上限まで読み直さない"""
+        graph.following_ids(self.alice.pk)
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('user:follow', kwargs={'username': 'dave'}))
+        self.assertEqual(default_cache.get(graph._key(graph.FOLLOWING, self.alice.pk)), graph._TOO_LARGE)
+        with self.assertNumQueries(1):
+            self.assertEqual(graph.following_among(self.alice.pk, [self.bob.pk, self.dave.pk]), {self.bob.pk, self.dave.pk})
+        # 小さい側は捨てられて読み直す
+        self.assertEqual(graph.followers_among(self.dave.pk, [self.alice.pk]), {self.alice.pk})
+
+
+@override_settings(JOBS_EAGER=False)
+class NotificationTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.author = User.objects.create_user('author', 'example@gmail.com', 'example13046')
+        self.fans = [User.objects.create_user(f'fan{i}', 'example@gmail.com', 'example13046') for i in range(3)]
+        self.post = Post.objects.create(author=self.author, content='hello')
+
+    def _like(self, user):
+        self.client.force_login(user)
+        self.client.post(reverse('blog:like', kwargs={'pk': self.post.pk}))
+
+    def test_like_burst_is_coalesced(self):
+        '''続けて来たLikeはジョブ1つ、通知1行にまとまる'''
+        for fan in self.fans:
+            self._like(fan)
+        self._like(self.author)
+        self.assertEqual(Job.objects.filter(kind='notifications.flush').count(), 1)
+        self.assertFalse(Notification.objects.exists())
+
+        [job] = queue.claim('w', now=timezone.now() + timedelta(seconds=notifications.flush_seconds() + 1))
+        self.assertTrue(queue.run_job(job))
+        notification = Notification.objects.get()
+        self.assertEqual((notification.recipient, notification.actor, notification.actor_count),
+                         (self.author, self.fans[-1], 3))
+        self.assertEqual(notifications.describe(notification), 'fan2 and 2 others liked your post')
+
+        # 未読の間は同じ行にまとめ (まとめ済みの人のやり直しは数えない)、既読にした後は新しい行にする
+        Like.objects.filter(user=self.fans[0]).delete()
+        self._like(self.fans[0])
+        self.assertEqual(notifications.flush(Notification.LIKE, self.post.pk), 1)
+        self.assertEqual(Notification.objects.get().actor_count, 3)
+        notifications.mark_read(self.author)
+        Like.objects.filter(user=self.fans[1]).delete()
+        self._like(self.fans[1])
+        notifications.flush(Notification.LIKE, self.post.pk)
+        self.assertEqual(list(Notification.objects.order_by('id').values_list('actor_count', 'unread')),
+                         [(3, False), (1, True)])
+
+    def test_repeated_actions_count_people(self):
+        '''Likeやフォローのやり直し、同じ人の2回のメンションは、未読の通知の中で1人と数える'''
+        self.client.force_login(self.fans[0])
+        self.client.post(reverse('blog:like', kwargs={'pk': self.post.pk}))
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+        notifications.flush(Notification.LIKE, self.post.pk)
+        notifications.flush(Notification.FOLLOW, self.author.pk)
+        for _ in range(2):
+            self.client.post(reverse('blog:unlike', kwargs={'pk': self.post.pk}))
+            self.client.post(reverse('blog:like', kwargs={'pk': self.post.pk}))
+            self.client.post(reverse('user:unfollow', kwargs={'username': 'author'}))
+            self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+            self.client.post(reverse('blog:create'), {'content': 'hi @author'})
+        self._like(self.fans[1])
+        for verb, target_id in ((Notification.LIKE, self.post.pk), (Notification.FOLLOW, self.author.pk),
+                                (Notification.MENTION, self.author.pk)):
+            notifications.flush(verb, target_id)
+        counts = dict(Notification.objects.values_list('verb', 'actor_count'))
+        self.assertEqual(counts, {Notification.LIKE: 2, Notification.FOLLOW: 1, Notification.MENTION: 1})
+
+    def test_follow_and_mention(self):
+        self.client.force_login(self.fans[0])
+        self.client.post(reverse('user:follow', kwargs={'username': 'author'}))
+        self.client.post(reverse('blog:create'), {'content': 'hi @author'})
+        notifications.flush(Notification.FOLLOW, self.author.pk)
+        notifications.flush(Notification.MENTION, self.author.pk)
+        texts = {notifications.describe(n) for n in Notification.objects.filter(recipient=self.author)}
+        self.assertEqual(texts, {'fan0 followed you', 'fan0 mentioned you'})
+
+    def test_inbox(self):
+        '''新しい順にキーセットでページを返し、未読数はキャッシュする'''
+        for i, fan in enumerate(self.fans):
+            Notification.objects.create(
+                recipient=self.author, verb=Notification.FOLLOW, actor=fan,
+                last_event_at=timezone.now(), updated_at=timezone.now() + timedelta(seconds=i),
+            )
+        self.client.force_login(self.author)
+        with self.settings(NOTIFICATION_PAGE_SIZE=2):
+            first = self.client.get(reverse('user:notifications')).json()
+            second = self.client.get(reverse('user:notifications'), {'cursor': first['next_cursor']}).json()
+        self.assertEqual([n['actor'] for n in first['notifications'] + second['notifications']], ['fan2', 'fan1', 'fan0'])
+        self.assertIsNone(second['next_cursor'])
+        self.assertEqual(first['unread_count'], 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(notifications.unread_count(self.author), 3)
+
+        self.client.post(reverse('user:notifications_read'))
+        self.assertEqual(self.client.get(reverse('user:notifications')).json()['unread_count'], 0)
+        self.assertFalse(Notification.objects.filter(unread=True).exists())
+
+
+class RecommendationTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.users = {
+            name: User.objects.create_user(name, f'{name}@gmail.com', 'example13046')
+            for name in ('alice', 'bob', 'carol', 'dave', 'erin', 'frank')
+        }
+        for following, follower in (
+            ('alice', 'bob'), ('alice', 'carol'), ('bob', 'dave'), ('bob', 'erin'), ('carol', 'dave'), ('frank', 'bob'),
+        ):
+            self._follow(following, follower)
+
+    def _follow(self, following, follower):
+        Follow.objects.create(following=self.users[following], follower=self.users[follower])
+        counters.follow_added(self.users[following].pk, self.users[follower].pk)
+
+    def _names(self, rows):
+        names = {user.pk: name for name, user in self.users.items()}
+        return [names[row[0]] for row in rows]
+
+    def test_two_hop_and_co_follow(self):
+        users = [user.pk for user in self.users.values()]
+        computed = dict(result for chunk in recommendations.compute(users) for result in chunk)
+        alice = computed[self.users['alice'].pk]
+        # dave は2人経由、erin は1人経由の友達の友達、frank は bob を共通にフォローしている
+        self.assertEqual(self._names(alice), ['dave', 'erin', 'frank'])
+        self.assertEqual([mutual for _, _, mutual in alice], [2, 1, 0])
+        # fork したワーカーで計算しても同じ
+        parallel = dict(
+            result for chunk in recommendations.compute(users, processes=2, chunk_size=2) for result in chunk
+        )
+        self.assertEqual(parallel, computed)
+        # 途中で読むのをやめてもワーカーは止まる
+        chunks = recommendations.compute(users, processes=2, chunk_size=2)
+        next(chunks)
+        chunks.close()
+
+    def test_graph_per_chunk(self):
+        '''グラフは全員分ではなく、計算するチャンクのユーザの分だけを読む'''
+        users = [user.pk for user in self.users.values()]
+        with mock.patch.object(recommendations, 'load_graph', wraps=recommendations.load_graph) as load:
+            computed = dict(result for chunk in recommendations.compute(users, chunk_size=2) for result in chunk)
+        self.assertEqual([call.args[0] for call in load.call_args_list], [users[0:2], users[2:4], users[4:6]])
+        self.assertEqual(computed, dict(result for chunk in recommendations.compute(users) for result in chunk))
+
+    def test_command_and_home(self):
+        out = StringIO()
+        call_command('compute_recommendations', processes=1, stdout=out)
+        self.assertIn('computed recommendations for 6 users', out.getvalue())
+        self.assertEqual(Recommendation.objects.filter(user=self.users['alice']).count(), 3)
+        self.client.force_login(self.users['alice'])
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual([row.candidate.username for row in response.context['recommendations']], ['dave', 'erin', 'frank'])
+
+        # 計算の後にフォローした人は出さず、フォローを変えたユーザだけを計算し直す
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('user:follow', kwargs={'username': 'dave'}))
+        response = self.client.get(reverse('blog:home'))
+        self.assertEqual([row.candidate.username for row in response.context['recommendations']], ['erin', 'frank'])
+        self.assertEqual(recommendations.stale_user_ids(), [self.users['alice'].pk])
+        call_command('compute_recommendations', incremental=True, processes=1, stdout=out)
+        self.assertIn('computed recommendations for 1 users', out.getvalue())
+        self.assertEqual(recommendations.stale_user_ids(), [])
+        self.assertFalse(Recommendation.objects.filter(user=self.users['alice'], candidate=self.users['dave']).exists())
+
+    @override_settings(RECOMMENDATION_FANOUT_CAP=1)
+    def test_fanout_cap(self):
+        """上限より多い隣接リストは読み込まない"""
+        alice = self.users['alice'].pk
+        loaded = recommendations.load_graph([alice])
+        self.assertNotIn(self.users['bob'].pk, loaded.following)
+        self.assertNotIn(self.users['bob'].pk, loaded.followers)
+        self.assertEqual(self._names(recommendations.recommend(loaded, alice)), [])
+
+
+class CachedSessionTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.client.login(username='ytaisei', password='example13046')
+        self.key = self.client.session.session_key
+
+    def _stored(self):
+        """DBにあるセッションの内容"""
+        return Session.objects.get(session_key=self.key).get_decoded()
+
+    def test_login_is_written_through(self):
+        """キャッシュが消えてもDBから読んでログインしたまま"""
+        self.assertIn(SESSION_KEY, self._stored())
+        default_cache.clear()
+        self.assertEqual(self.client.get(reverse('blog:home')).status_code, 200)
+
+    def test_changes_are_written_through(self):
+        session = self.client.session
+        session['theme'] = 1
+        session.save()
+        self.assertEqual(self._stored()['theme'], 1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_logout_deletes(self):
+        self.client.get(reverse('user:logout'))
+        self.assertFalse(Session.objects.filter(session_key=self.key).exists())
+
+
+class CachedUserTest(TestCase):
+
+    def setUp(self):
+        default_cache.clear()
+        self.user = User.objects.create_user('ytaisei', 'example@gmail.com', 'example13046')
+        self.backend = backends.CachedModelBackend()
+
+    def test_user_is_cached(self):
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user(self.user.pk).username, 'ytaisei')
+        self.assertIsNone(self.backend.get_user(self.user.pk + 100))
+
+    def test_save_invalidates(self):
+        """パスワードを変えると古いセッションは使えず、無効にしたユーザは読めない"""
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('blog:home')).status_code, 200)
+        self.user.set_password('changed13046')
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('blog:home')).status_code, 302)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_home_reads_no_session_or_user(self):
+        """2回目以降のホームではセッションとユーザを読まない"""
+        self.client.force_login(self.user)
+        self.client.get(reverse('blog:home'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('blog:home'))
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('django_session', tables)
+        self.assertNotIn('FROM "auth_user" WHERE "auth_user"."id"', tables)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth import views as auth_views
 
@@ -5,13 +6,23 @@ from . import views
 
 app_name = 'user'
 
+# ASGIで動かすときはスレッドに回らない非同期版を使う
+if settings.ASYNC_VIEWS:
+    following_view, follower_view = views.following_view, views.follower_view
+else:
+    following_view, follower_view = views.FollowingListView.as_view(), views.FollowerListView.as_view()
+
 urlpatterns = [
     path('', views.SignUpView.as_view(), name="signup"),
     path('login/', auth_views.LoginView.as_view(template_name='user/login.html'), name="login"),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
+    path('notifications/', views.notifications_view, name='notifications'),
+    path('notifications/read/', views.notifications_read_view, name='notifications_read'),
     path('<str:username>/follow/index/', views.FollowIndexView.as_view(), name="follow_index"),
-    path('<str:username>/following/', views.FollowingListView.as_view(), name="following"),
-    path('<str:username>/follower/', views.FollowerListView.as_view(), name="follower"),
+    path('<str:username>/following/', following_view, name="following"),
+    path('<str:username>/follower/', follower_view, name="follower"),
+    path('<str:username>/following/json/', views.following_json_view, name="following_json"),
+    path('<str:username>/follower/json/', views.follower_json_view, name="follower_json"),
     path('<str:username>/follow/', views.follow_view, name="follow"),
     path('<str:username>/unfollow/', views.unfollow_view, name="unfollow"),
 ]
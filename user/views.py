@@ -1,4 +1,4 @@
-from django.views.generic import CreateView, ListView, TemplateView
+from django.views.generic import CreateView, TemplateView
 from django.contrib.auth import login
 from django.urls import reverse, reverse_lazy
 from django.shortcuts import get_object_or_404, redirect
@@ -6,10 +6,19 @@ from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseRedirect, Http404
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.views.decorators.http import require_GET, require_POST
+from django.http import JsonResponse
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.template.response import TemplateResponse
 
 from .forms import SignUpForm
-from .models import Follow
+from .models import Follow, Notification
+from . import counters, follow_lists, graph, notifications
+from blog import timeline
+from jobs import queue
+from twitter import aio
+from twitter.db import insert_ignore
 
 
 class SignUpView(CreateView):
@@ -24,28 +33,68 @@ class SignUpView(CreateView):
 		return HttpResponseRedirect(self.get_success_url())
 
 
-class FollowingListView(LoginRequiredMixin, ListView):
-	model = Follow
+def _follow_list_context(request, username, direction):
+	owner = get_object_or_404(User, username=username)
+	entries, next_cursor = follow_lists.page(owner, direction, request.user, request.GET.get('cursor'))
+	return {'owner': owner, 'entries': entries, 'next_cursor': next_cursor}
+
+
+class FollowingListView(LoginRequiredMixin, TemplateView):
 	template_name = 'follow/following.html'
 
 	def get_context_data(self, **kwargs):
 		context = super().get_context_data(**kwargs)
-		user = get_object_or_404(User, username=self.kwargs['username'])
-		context['following_list'] = user.following.all().select_related('follower')
+		context.update(_follow_list_context(self.request, self.kwargs['username'], follow_lists.FOLLOWING))
 		return context
 
 
-class FollowerListView(LoginRequiredMixin, ListView):
-	model = Follow
+class FollowerListView(LoginRequiredMixin, TemplateView):
 	template_name = 'follow/follower.html'
 
 	def get_context_data(self, **kwargs):
 		context = super().get_context_data(**kwargs)
-		user = get_object_or_404(User, username=self.kwargs['username'])
-		context['follower_list'] = user.follower.all().select_related('following')
+		context.update(_follow_list_context(self.request, self.kwargs['username'], follow_lists.FOLLOWERS))
 		return context
 
 
+@aio.login_required
+@aio.require_safe
+async def following_view(request, username):
+	"""FollowingListView の非同期版 (ASYNC_VIEWS)"""
+	context = await aio.run(lambda: _follow_list_context(request, username, follow_lists.FOLLOWING))
+	return TemplateResponse(request, 'follow/following.html', context)
+
+
+@aio.login_required
+@aio.require_safe
+async def follower_view(request, username):
+	"""FollowerListView の非同期版 (ASYNC_VIEWS)"""
+	context = await aio.run(lambda: _follow_list_context(request, username, follow_lists.FOLLOWERS))
+	return TemplateResponse(request, 'follow/follower.html', context)
+
+
+def _follow_list_json(request, username, direction):
+	context = _follow_list_context(request, username, direction)
+	return JsonResponse({
+		'users': [follow_lists.serialize(entry) for entry in context['entries']],
+		'next_cursor': context['next_cursor'],
+	})
+
+
+@login_required
+@require_GET
+def following_json_view(request, username):
+	"""フォロー中の一覧のJSON版。next_cursorを渡すと続きを返す"""
+	return _follow_list_json(request, username, follow_lists.FOLLOWING)
+
+
+@login_required
+@require_GET
+def follower_json_view(request, username):
+	"""フォロワーの一覧のJSON版。next_cursorを渡すと続きを返す"""
+	return _follow_list_json(request, username, follow_lists.FOLLOWERS)
+
+
 class FollowIndexView(LoginRequiredMixin, TemplateView):
 	template_name = 'follow/follow_index.html'
 
@@ -53,7 +102,7 @@ class FollowIndexView(LoginRequiredMixin, TemplateView):
 		context = super().get_context_data(**kwargs)
 		login_user = self.request.user
 		target_user = get_object_or_404(User, username=self.kwargs['username'])
-		has_followed = Follow.objects.filter(follower=target_user, following=login_user).exists()
+		has_followed = graph.is_following(login_user.pk, target_user.pk)
 		is_same_user = login_user == target_user
 		context['target_user'] = target_user
 		context['has_followed'] = has_followed
@@ -70,10 +119,12 @@ def follow_view(request, *args, **kwargs):
 		raise Http404('this user does not exist.')
 	if follower == following:
 		raise PermissionDenied()
-	follow_relation = Follow.objects.filter(follower=follower, following=following)
-	if not follow_relation.exists():
-		new_follow = Follow(follower=follower, following=following)
-		new_follow.save()
+	with transaction.atomic():
+		if insert_ignore(Follow, follower_id=follower.pk, following_id=following.pk):
+			counters.follow_added(following.pk, follower.pk)
+			notifications.schedule(Notification.FOLLOW, follower.pk)
+			queue.enqueue('timeline.backfill_follow', user_id=following.pk, author_id=follower.pk)
+			transaction.on_commit(lambda: graph.follow_added(following.pk, follower.pk))
 	return redirect('blog:home')
 
 
@@ -84,7 +135,33 @@ def unfollow_view(request, *args, **kwargs):
 		follower = User.objects.get(username=kwargs['username'])
 	except User.DoesNotExist:
 		raise Http404('this user does not exist.')
-	follow_relation = Follow.objects.filter(follower=follower, following=following)
-	if follow_relation.exists():
-		follow_relation.delete()
+	with transaction.atomic():
+		deleted, _ = Follow.objects.filter(follower=follower, following=following).delete()
+		if deleted:
+			if timeline.left_pull(*counters.follow_removed(following.pk, follower.pk)):
+				# pull対象の間の投稿はフォロワーの受信箱に無いので配り直す
+				queue.enqueue('timeline.backfill_followers', author_id=follower.pk)
+			timeline.retract_follow(following, follower)
+			transaction.on_commit(lambda: graph.follow_removed(following.pk, follower.pk))
 	return redirect('blog:home')
+
+
+@login_required
+@require_GET
+def notifications_view(request):
+	"""自分宛ての通知を新しい順に返す。next_cursorを渡すと続きを返す"""
+	notification_list, next_cursor = notifications.inbox(request.user, request.GET.get('cursor'))
+	context = {
+		'notifications': [notifications.serialize(notification) for notification in notification_list],
+		'unread_count': notifications.unread_count(request.user),
+		'next_cursor': next_cursor,
+	}
+	return JsonResponse(context)
+
+
+@login_required
+@require_POST
+def notifications_read_view(request):
+	"""通知を全部既読にする"""
+	notifications.mark_read(request.user)
+	return JsonResponse({'unread_count': 0})